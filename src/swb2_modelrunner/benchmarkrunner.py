@@ -0,0 +1,301 @@
+import site
+site.addsitedir('.')  # Always appends to end
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import stats_functions as sf
+import make_summary_dataset as sd
+import zone_index_functions as zi
+import netcdf_io_functions as nio
+import synthetic_data_functions as syn
+
+"""
+Benchmarks of the post-processing code, run against synthetic swb2 output so that results can be compared from
+one machine, or one version of the code, to the next. Daily output files (named as swb2 names them) and a zone
+mask with a chosen number of zones are generated in a scratch directory, and the following are timed:
+
+  summarize__<summary_type>      - stats_functions.summarize_array_values, for each summary type
+  summarize_multi                - stats_functions.summarize_array_values_multi, every summary type at once
+  zonal_statistics               - stats_functions.calculate_zonal_statistics on an annual grid
+  spatial_statistics             - make_summary_dataset.calculate_spatial_statistics, read to zonal statistics
+  outputrunner                   - a full outputrunner pass over all of the synthetic files
+
+Each benchmark runs in a new process, so that its peak memory use can be measured on its own. Results (best and
+mean time, throughput in millions of cell-days per second, peak and baseline resident memory) are printed as a
+table and appended, one JSON object per benchmark, to a results file.
+"""
+
+SUMMARY_TYPES = ['monthly_sum', 'annual_sum', 'mean_monthly_sum', 'mean_annual_sum',
+                 'water_year_sum', 'mean_water_year_sum']
+
+PROJECT_CRS = 5070
+
+def _proc_status_mb(field):
+    # a memory field of /proc/self/status (Linux), in MB
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return float('nan')
+
+def _peak_rss_mb():
+    # the high-water mark of this process (VmHWM) starts afresh when a process is started; 'ru_maxrss' is carried
+    # over from the parent process, so it is used only where /proc is not available
+    peak_rss_mb = _proc_status_mb('VmHWM')
+    if np.isnan(peak_rss_mb):
+        # 'ru_maxrss' is in kilobytes on Linux, and in bytes on macOS
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024**2 if sys.platform == 'darwin' else 1024)
+    return peak_rss_mb
+
+def _peak_child_rss_mb():
+    # largest peak resident memory of any child process waited for (Linux: kilobytes)
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / (1024**2 if sys.platform == 'darwin' else 1024)
+
+def _setup_summarize(netcdf_filename, variable_name, summary_type):
+    xarray_dataset = nio.read_variable(netcdf_filename, variable_name)
+    return lambda: sf.summarize_array_values(xarray_dataset, variable_name, summary_type, crs=PROJECT_CRS)
+
+def _setup_summarize_multi(netcdf_filename, variable_name, summary_types):
+    xarray_dataset = nio.read_variable(netcdf_filename, variable_name)
+    return lambda: sf.summarize_array_values_multi(xarray_dataset, variable_name, summary_types, crs=PROJECT_CRS)
+
+def _setup_zonal_statistics(netcdf_filename, variable_name, mask_filename):
+    xarray_dataset = nio.read_variable(netcdf_filename, variable_name)
+    annual_dataset = sf.summarize_array_values(xarray_dataset, variable_name, 'annual_sum')
+    zone_index = zi.load_zone_index(mask_filename)
+    return lambda: sf.calculate_zonal_statistics(annual_dataset[variable_name], mask_dataarray=None,
+                                                 zone_index=zone_index, summary_type='annual_sum',
+                                                 num_zone_chars=4)
+
+def _setup_spatial_statistics(netcdf_filename, variable_name, mask_filename, summary_type):
+    zi.load_zone_index(mask_filename)
+    return lambda: sd.calculate_spatial_statistics(netcdf_filename=netcdf_filename,
+                                                   mask_filename=mask_filename,
+                                                   scenario_name='benchmark',
+                                                   variable_name=variable_name,
+                                                   weather_data_name='synthetic',
+                                                   zone_char_width=4,
+                                                   summary_type=summary_type,
+                                                   crs=PROJECT_CRS)
+
+def _setup_outputrunner(script_dir, run_dir, run_control_filename, output_control_filename):
+    command = [sys.executable, str(Path(script_dir) / 'outputrunner.py'),
+               str(run_control_filename), str(output_control_filename)]
+    environment = {**os.environ, 'PYTHONPATH': os.pathsep.join([str(script_dir), os.environ.get('PYTHONPATH', '')])}
+    return lambda: subprocess.run(command, cwd=run_dir, env=environment, check=True,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+SETUP_FUNCTIONS = {'summarize': _setup_summarize,
+                   'summarize_multi': _setup_summarize_multi,
+                   'zonal_statistics': _setup_zonal_statistics,
+                   'spatial_statistics': _setup_spatial_statistics,
+                   'outputrunner': _setup_outputrunner}
+
+def run_benchmark(setup_name, setup_kwargs, repeat):
+    """Set up and time one benchmark 'repeat' times. Runs in its own process.
+
+    Returns:
+        dict: best and mean time (seconds), resident memory before setup and peak resident memory (MB) of this
+              process, and (for the outputrunner pass) the largest peak resident memory of its child processes
+    """
+    baseline_rss_mb = _proc_status_mb('VmRSS')
+    function = SETUP_FUNCTIONS[setup_name](**setup_kwargs)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'best_s': min(times),
+            'mean_s': float(np.mean(times)),
+            'baseline_rss_mb': baseline_rss_mb,
+            'peak_rss_mb': _peak_rss_mb(),
+            'peak_child_rss_mb': _peak_child_rss_mb() if setup_name == 'outputrunner' else None}
+
+def make_synthetic_run(bench_dir, nrows, ncols, n_years, n_zones, n_files, variable_names):
+    """Generate synthetic swb2 output, a zone mask, and the control files needed for an outputrunner pass.
+
+    Returns:
+        dict: names of the files and directories created
+    """
+    bench_dir = Path(bench_dir)
+    start_date = '2040-01-01'
+    end_date = f"{2040 + n_years - 1}-12-31"
+    run_dir = bench_dir / 'repo' / 'python'
+    gridded_data_dir = bench_dir / 'repo' / 'swb_input' / 'input_grids'
+    run_dir.mkdir(parents=True, exist_ok=True)
+    (bench_dir / 'repo' / 'swb_input' / 'templates').mkdir(parents=True, exist_ok=True)
+
+    mask_filename = syn.write_zone_mask(gridded_data_dir / 'synthetic_zone_mask.asc',
+                                        syn.make_zone_mask(nrows, ncols, n_zones))
+
+    weather_data_names = [f"gcm{i:02d}" for i in range(n_files)]
+    netcdf_filenames = []
+    for i, weather_data_name in enumerate(weather_data_names):
+        simulation_dir = bench_dir / 'top' / 'swb_runs' / f"ssp245__{weather_data_name}__2040-{2040 + n_years - 1}"
+        for j, variable_name in enumerate(variable_names):
+            netcdf_filenames.append(syn.write_output_file(simulation_dir / 'output', 'ssp245', weather_data_name,
+                                                          variable_name, start_date, end_date, nrows, ncols,
+                                                          seed=100 * i + j))
+
+    run_control_filename = bench_dir / 'run_control.toml'
+    run_control_filename.write_text(f"""[working_directories]
+top_level_dir = "{bench_dir / 'top'}"
+gcm_runs_dir = "."
+logfiles_dir = "logfiles"
+swb_work_dir = "swb_runs"
+data_summary_dir = "data_summaries"
+plot_dir = "plots"
+grid_stats_dir = "grid_statistics"
+tif_image_dir = "tif_images"
+
+[data_directories]
+swb_tabular_data_dir = "swb_input/lookup_tables"
+swb_gridded_data_dir = "swb_input/input_grids"
+swb_templates_dir = "swb_input/templates"
+weather_data_dir = "{bench_dir / 'weather'}"
+
+[input_tables]
+lu_lookup_table_name = "lu_lookup_table.txt"
+irr_lookup_table_name = "irr_lookup_table.txt"
+""")
+    (bench_dir / 'top' / 'logfiles').mkdir(parents=True, exist_ok=True)
+
+    output_control_filename = bench_dir / 'output_control.toml'
+    output_control_filename.write_text(f"""[geospatial]
+project_crs = {PROJECT_CRS}
+
+[variables]
+grid_vars = {json.dumps(variable_names)}
+
+[input_grids]
+zone_mask_file = "{Path(mask_filename).name}"
+
+[scenarios_and_periods]
+scenario_names = ['ssp245']
+weather_data_names = {json.dumps(weather_data_names)}
+time_periods = ['2040-{2040 + n_years - 1}']
+summary_types = ['mean_monthly', 'mean_annual', 'annual', 'monthly']
+
+[zonal_stats_output]
+formats = ['parquet']
+store_dir = 'zonal_stats_store'
+""")
+
+    return {'run_dir': run_dir,
+            'mask_filename': str(mask_filename),
+            'netcdf_filenames': [str(f) for f in netcdf_filenames],
+            'run_control_filename': run_control_filename,
+            'output_control_filename': output_control_filename,
+            'n_days': len(pd.date_range(start_date, end_date, freq='D'))}
+
+def add_execution_section(output_control_filename, backend, n_workers):
+    with open(output_control_filename, 'a') as f:
+        f.write(f"\n[execution]\nbackend = '{backend}'\nn_workers = {n_workers}\nthreads_per_worker = 1\n")
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Time the swb2 post-processing code against synthetic swb2 output')
+    parser.add_argument("bench_dir",
+                        help="scratch directory for the synthetic files; its contents are overwritten")
+    parser.add_argument("--nrows", type=int, default=620, help="number of grid rows (default: 620)")
+    parser.add_argument("--ncols", type=int, default=688, help="number of grid columns (default: 688)")
+    parser.add_argument("--n_years", type=int, default=2, help="number of years of daily output (default: 2)")
+    parser.add_argument("--n_zones", type=int, default=100, help="number of zones in the zone mask (default: 100)")
+    parser.add_argument("--n_files", type=int, default=2,
+                        help="number of synthetic weather drivers (output files per variable) for the outputrunner pass")
+    parser.add_argument("--variables", default="net_infiltration,tmax",
+                        help="comma-separated swb2 variable names (default: net_infiltration,tmax)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed repetitions of each benchmark")
+    parser.add_argument("--benchmarks", default="summarize,summarize_multi,zonal_statistics,spatial_statistics,outputrunner",
+                        help="comma-separated list of benchmarks to run")
+    parser.add_argument("--outputrunner_backend", default='process',
+                        help="executor backend used for the outputrunner pass (default: process)")
+    parser.add_argument("--n_workers", type=int, default=0,
+                        help="number of workers used for the outputrunner pass (default: one per core)")
+    parser.add_argument("--results_file", default=None,
+                        help="JSON lines file the results are appended to (default: <bench_dir>/benchmark_results.jsonl)")
+
+    args = parser.parse_args()
+
+    bench_dir = Path(args.bench_dir).resolve()
+    variable_names = args.variables.split(',')
+    benchmarks = args.benchmarks.split(',')
+    results_filename = Path(args.results_file) if args.results_file else bench_dir / 'benchmark_results.jsonl'
+
+    print(f"generating synthetic output in {bench_dir} ...")
+    synthetic_run = make_synthetic_run(bench_dir, args.nrows, args.ncols, args.n_years, args.n_zones,
+                                       args.n_files, variable_names)
+    add_execution_section(synthetic_run['output_control_filename'], args.outputrunner_backend, args.n_workers)
+
+    netcdf_filename = synthetic_run['netcdf_filenames'][0]
+    variable_name = variable_names[0]
+    cell_days = args.nrows * args.ncols * synthetic_run['n_days']
+
+    # (name, setup function, setup arguments, cell-days processed per repetition)
+    cases = []
+    if 'summarize' in benchmarks:
+        for summary_type in SUMMARY_TYPES:
+            cases.append((f"summarize__{summary_type}", 'summarize',
+                          dict(netcdf_filename=netcdf_filename, variable_name=variable_name, summary_type=summary_type),
+                          cell_days))
+    if 'summarize_multi' in benchmarks:
+        cases.append(('summarize_multi', 'summarize_multi',
+                      dict(netcdf_filename=netcdf_filename, variable_name=variable_name, summary_types=SUMMARY_TYPES),
+                      cell_days))
+    if 'zonal_statistics' in benchmarks:
+        cases.append(('zonal_statistics', 'zonal_statistics',
+                      dict(netcdf_filename=netcdf_filename, variable_name=variable_name,
+                           mask_filename=synthetic_run['mask_filename']),
+                      args.nrows * args.ncols * args.n_years))
+    if 'spatial_statistics' in benchmarks:
+        cases.append(('spatial_statistics', 'spatial_statistics',
+                      dict(netcdf_filename=netcdf_filename, variable_name=variable_name,
+                           mask_filename=synthetic_run['mask_filename'], summary_type='monthly_sum'),
+                      cell_days))
+    if 'outputrunner' in benchmarks:
+        cases.append(('outputrunner', 'outputrunner',
+                      dict(script_dir=str(Path(__file__).resolve().parent),
+                           run_dir=str(synthetic_run['run_dir']),
+                           run_control_filename=str(synthetic_run['run_control_filename']),
+                           output_control_filename=str(synthetic_run['output_control_filename'])),
+                      cell_days * len(synthetic_run['netcdf_filenames'])))
+
+    run_details = {'timestamp': dt.datetime.now().isoformat(timespec='seconds'),
+                   'host': platform.node(),
+                   'python': platform.python_version(),
+                   'n_cpus': os.cpu_count(),
+                   'nrows': args.nrows, 'ncols': args.ncols, 'n_years': args.n_years,
+                   'n_zones': args.n_zones, 'n_files': len(synthetic_run['netcdf_filenames']),
+                   'outputrunner_backend': args.outputrunner_backend}
+
+    results = []
+    # each benchmark runs in a freshly started process, so that peak memory is measured for it alone
+    context = multiprocessing.get_context('spawn')
+    for name, setup_name, setup_kwargs, case_cell_days in cases:
+        print(f"running {name} ...", flush=True)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            timing = executor.submit(run_benchmark, setup_name, setup_kwargs, args.repeat).result()
+        result = {'benchmark': name, **run_details, **timing, 'repeat': args.repeat,
+                  'mcell_days_per_s': case_cell_days / timing['best_s'] / 1e6}
+        results.append(result)
+        with open(results_filename, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+    results_df = pd.DataFrame(results)[['benchmark', 'best_s', 'mean_s', 'mcell_days_per_s', 'peak_rss_mb', 'baseline_rss_mb', 'peak_child_rss_mb']]
+    print(results_df.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    print(f"results appended to {results_filename}")
@@ -0,0 +1,187 @@
+import logging
+import os
+import sqlite3
+from pathlib import Path
+import pandas as pd
+
+"""
+Functions used to keep a catalog of swb2 output files in an SQLite database in the swb2 work directory. modelrunner
+adds the netCDF files written by each simulation as soon as it finishes, and outputrunner selects the files it
+needs with indexed queries rather than crawling the work directory. The catalog is reconciled with the work
+directory (reopening only files that are new or have changed) when it is first built, or when asked to.
+
+The swb output files are assumed to be named as follows:
+
+  scenario_name__weather_data_name__short_time_period__swb_variable_name__time_period__spatial_coverage.nc
+
+  ex. ssp245__bcc_csm2-mr__2040-2059__runoff__2040-01-01_to_2059-12-31__688_by_620.nc
+
+Files whose names do not follow this convention are left out of the catalog.
+"""
+
+CATALOG_FILENAME = 'output_catalog.sqlite'
+
+FILENAME_FIELDS = ['scenario_name', 'weather_data_name', 'short_time_period', 'swb_variable_name',
+                   'time_period', 'spatial_coverage']
+
+logger = logging.getLogger(__name__)
+
+def parse_output_filename(nc_filename):
+    """Split an swb output file name into its parts.
+
+    Returns:
+        dict: the parts named in 'FILENAME_FIELDS', or None if the name does not follow the naming convention
+    """
+    name = Path(nc_filename).name
+    if not name.endswith('.nc'):
+        return None
+    parts = name[:-len('.nc')].split('__')
+    if len(parts) != len(FILENAME_FIELDS) or not all(parts):
+        return None
+    return dict(zip(FILENAME_FIELDS, parts))
+
+def read_time_extent(nc_filename):
+    """Return the first and last dates (as 'YYYY-MM-DD' strings) and the number of time steps of a netCDF file;
+    (None, None, 0) if the file has no readable time axis."""
+    # imported here, so that opening the catalog (ex. to list what modelrunner has run) does not load xarray
+    import xarray as xr
+    try:
+        with xr.open_dataset(nc_filename) as ds:
+            if 'time' not in ds.coords or ds.sizes['time'] == 0:
+                return None, None, 0
+            times = ds['time'].values
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"could not read the time axis of {nc_filename}: {e}")
+        return None, None, 0
+    return (pd.Timestamp(times[0]).strftime('%Y-%m-%d'), pd.Timestamp(times[-1]).strftime('%Y-%m-%d'), len(times))
+
+def open_catalog(catalog_filename):
+    """Open (creating if needed) the output file catalog; returns an sqlite3 connection."""
+    connection = sqlite3.connect(catalog_filename)
+    connection.row_factory = sqlite3.Row
+    connection.execute("""CREATE TABLE IF NOT EXISTS output_files (
+                              path TEXT PRIMARY KEY,
+                              simulation_name TEXT,
+                              scenario_name TEXT,
+                              weather_data_name TEXT,
+                              short_time_period TEXT,
+                              swb_variable_name TEXT,
+                              time_period TEXT,
+                              spatial_coverage TEXT,
+                              size INTEGER,
+                              mtime REAL,
+                              time_start TEXT,
+                              time_end TEXT,
+                              n_times INTEGER)""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS output_files_selection
+                              ON output_files (swb_variable_name, scenario_name, weather_data_name)""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS output_files_simulation
+                              ON output_files (simulation_name)""")
+    connection.commit()
+    return connection
+
+def catalog_output_files(connection, output_dir, simulation_name):
+    """Add (or refresh) the netCDF files found in one simulation's output directory, and drop any catalog entries
+    for that simulation whose files no longer exist. Files already cataloged with the same size and modification
+    time are not reopened.
+
+    Returns:
+        int: number of files cataloged for the simulation
+    """
+    known = {row['path']: (row['size'], row['mtime'])
+             for row in connection.execute("SELECT path, size, mtime FROM output_files WHERE simulation_name = ?",
+                                           (simulation_name,))}
+    found = set()
+    output_path = Path(output_dir)
+    nc_files = sorted(output_path.glob('*.nc')) if output_path.is_dir() else []
+    for nc_file in nc_files:
+        fields = parse_output_filename(nc_file.name)
+        if fields is None:
+            logger.warning(f"skipping {nc_file}: name does not follow the swb output file naming convention")
+            continue
+        path = str(nc_file.resolve())
+        stat_result = os.stat(path)
+        found.add(path)
+        if known.get(path) == (stat_result.st_size, stat_result.st_mtime):
+            continue
+        time_start, time_end, n_times = read_time_extent(path)
+        connection.execute("INSERT OR REPLACE INTO output_files VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                           (path, simulation_name, *[fields[field] for field in FILENAME_FIELDS],
+                            stat_result.st_size, stat_result.st_mtime, time_start, time_end, n_times))
+
+    stale_paths = [(path,) for path in known if path not in found]
+    connection.executemany("DELETE FROM output_files WHERE path = ?", stale_paths)
+    connection.commit()
+    return len(found)
+
+def remove_simulation(connection, simulation_name):
+    """Drop every catalog entry for a simulation (for example, one whose swb2 run failed)."""
+    connection.execute("DELETE FROM output_files WHERE simulation_name = ?", (simulation_name,))
+    connection.commit()
+
+def catalog_work_dir(connection, work_dir):
+    """Catalog the output of every simulation beneath the swb2 work directory (each 'output' directory is taken to
+    belong to the simulation named by its parent directory). Used to build a catalog for runs made before the
+    catalog existed; this crawls the whole run tree once.
+
+    Returns:
+        int: number of files cataloged
+    """
+    n_files = 0
+    for output_dir in sorted(Path(work_dir).glob('*/output')):
+        n_files += catalog_output_files(connection, output_dir, simulation_name=output_dir.parent.name)
+    return n_files
+
+def reconcile_catalog(connection, work_dir):
+    """Bring the catalog up to date with the swb2 work directory: files written, rewritten or removed since they
+    were cataloged (for example by a simulation run outside of modelrunner, or rerun by hand) are added,
+    refreshed or dropped, as are the entries of simulations whose output directory no longer exists. Only files
+    whose size or modification time has changed are opened, so for an unchanged work directory this costs a
+    directory listing and a stat of each file.
+
+    Returns:
+        (int, int): number of files cataloged, and number of catalog entries added, refreshed or dropped
+    """
+    changes_before = connection.total_changes
+    n_files = catalog_work_dir(connection, work_dir)
+    simulation_names = [output_dir.parent.name for output_dir in Path(work_dir).glob('*/output')]
+    connection.execute(f"DELETE FROM output_files WHERE simulation_name NOT IN "
+                       f"({','.join('?' * len(simulation_names))})", simulation_names)
+    connection.commit()
+    return n_files, connection.total_changes - changes_before
+
+def clear_catalog(connection):
+    """Drop every catalog entry, so that every file is reopened when the work directory is next cataloged."""
+    connection.execute("DELETE FROM output_files")
+    connection.commit()
+
+def select_output_files(connection, scenario_names=None, weather_data_names=None, swb_variable_names=None,
+                        simulation_names=None):
+    """Select cataloged output files.
+
+    Args:
+        connection (sqlite3 connection): the open catalog
+        scenario_names, weather_data_names, swb_variable_names, simulation_names (list): values to select; all if
+                                                                                   None
+
+    Returns:
+        list: one dict per file, holding 'path', the parts of the file name, 'size', 'mtime', 'time_start',
+              'time_end' and 'n_times'
+    """
+    selections = {'scenario_name': scenario_names,
+                  'weather_data_name': weather_data_names,
+                  'swb_variable_name': swb_variable_names,
+                  'simulation_name': simulation_names}
+    clauses = []
+    parameters = []
+    for column, values in selections.items():
+        if values is not None:
+            values = list(values)
+            clauses.append(f"{column} IN ({','.join('?' * len(values))})")
+            parameters.extend(values)
+
+    query = "SELECT * FROM output_files"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY path"
+    return [dict(row) for row in connection.execute(query, parameters)]
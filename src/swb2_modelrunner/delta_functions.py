@@ -0,0 +1,241 @@
+import json
+import logging
+import re
+from collections import defaultdict
+import numpy as np
+import xarray as xr
+import stats_functions as sf
+import zone_index_functions as zi
+import netcdf_io_functions as nio
+import manifest_functions as mf
+import zonal_stats_store_functions as zs
+
+"""
+Functions used to compare future summary grids with the historical baseline of the same weather data name (GCM),
+variable and summary type. Pairs are found from the names of the summary grids already written by outputrunner,
+so the daily swb output is never read again. For each pair, a netCDF file of the absolute and percent change of
+each cell is written, along with a zonal table of the change in each zone's mean.
+
+Only summary types averaged over the years of a period ('mean_annual_sum', 'mean_monthly_mean', ...) are compared,
+since year-by-year grids of two different periods have no years in common.
+
+A manifest in the delta grid directory records the size and modification time of the two summary grids (and the
+zone mask) behind each delta; on a rerun only the pairs whose inputs have changed, or whose outputs are missing,
+are calculated again.
+"""
+
+DELTA_DEFAULTS = {'baseline_scenario': 'historical',
+                  'baseline_period': '1995-2014',
+                  # percent change is left undefined (NaN) where the baseline is no larger than this in magnitude
+                  'min_baseline': 0.0,
+                  'grid_dir': 'delta_grids',
+                  'store_dir': 'delta_stats_store'}
+
+DELTA_MANIFEST_FILENAME = 'delta_manifest.json'
+
+logger = logging.getLogger(__name__)
+
+def read_delta_settings(output_control_dict, summary_settings):
+    """Combine the [delta] section of the output control file with its defaults, and create the directory that
+    holds the delta grids.
+
+    Args:
+        output_control_dict (dict): contents of the output control file
+        summary_settings (dict): as returned by 'summary_task_functions.read_summary_settings'
+
+    Returns:
+        dict: delta settings, with 'grid_dir' and 'store_dir' as full paths
+    """
+    options = {**DELTA_DEFAULTS, **output_control_dict.get('delta', {})}
+    options['grid_dir'] = summary_settings['grid_stats_dir'] / options['grid_dir']
+    options['store_dir'] = summary_settings['data_summary_dir'] / options['store_dir']
+    logger.info(f"creating directory to hold delta grids at {options['grid_dir']}.")
+    options['grid_dir'].mkdir(parents=True, exist_ok=True)
+    return options
+
+def short_time_period(time_period):
+    """Return the years spanned by a time period, ex. '2040-2059' for '2040-01-01_to_2059-12-31'; a time period
+    given in some other form is returned as is."""
+    match = re.fullmatch(r"(\d{4})-\d{2}-\d{2}_to_(\d{4})-\d{2}-\d{2}", time_period)
+    return f"{match.group(1)}-{match.group(2)}" if match else time_period
+
+def pair_summary_grids(summary_grids, settings, baseline_scenario='historical', baseline_period='1995-2014'):
+    """Pair each selected future summary grid with the baseline grid of the same summary type, weather data name,
+    variable and spatial coverage.
+
+    Args:
+        summary_grids (list): as returned by 'summary_task_functions.find_summary_grids'
+        settings (dict): as returned by 'summary_task_functions.read_summary_settings'; only grids of the selected
+                         summary types, scenarios, weather data names and variables are paired
+        baseline_scenario (str): scenario name of the baseline grids
+        baseline_period (str): years spanned by the baseline grids, ex. '1995-2014'
+
+    Returns:
+        list: for each pair, the parts of the name of the future grid along with 'path', 'baseline_path' and
+              'baseline_time_period'; future grids with more than one matching baseline are left out, with a warning
+    """
+    selected = [grid for grid in summary_grids
+                if grid['summary_type'].startswith('mean_')
+                   and grid['summary_type'].rsplit('_', 1)[0] in settings['summary_types']
+                   and grid['weather_data_name'] in settings['weather_data_names']
+                   and grid['swb_variable_name'] in settings['grid_vars']]
+
+    def pair_key(grid):
+        return (grid['summary_type'], grid['weather_data_name'], grid['swb_variable_name'], grid['spatial_coverage'])
+
+    baselines = defaultdict(list)
+    for grid in selected:
+        if grid['scenario_name'] == baseline_scenario and short_time_period(grid['time_period']) == baseline_period:
+            baselines[pair_key(grid)].append(grid)
+    # two baselines with the same key (ex. spanning different days of the same years) leave it unclear which one to
+    # compare with; neither is chosen
+    for key, grids in baselines.items():
+        if len(grids) > 1:
+            logger.warning(f"  {len(grids)} {baseline_scenario} {baseline_period} baselines for {'__'.join(key)} "
+                           f"({', '.join(grid['path'].name for grid in grids)}); no changes calculated against them")
+
+    pairs = []
+    for grid in selected:
+        if grid['scenario_name'] not in settings['scenario_names']:
+            continue
+        candidates = baselines.get(pair_key(grid), [])
+        if any(baseline is grid for baseline in candidates):
+            continue
+        if not candidates:
+            logger.info(f"  no {baseline_scenario} {baseline_period} baseline for {grid['path'].name}")
+            continue
+        if len(candidates) > 1:
+            continue
+        baseline = candidates[0]
+        pairs.append({**grid, 'baseline_path': baseline['path'], 'baseline_time_period': baseline['time_period']})
+    return pairs
+
+def options_hash(options):
+    """Return a hash of the options that change the contents of a delta grid or zonal table."""
+    return mf.hash_text(json.dumps({key: options[key] for key in ['baseline_scenario', 'baseline_period',
+                                                                   'min_baseline']}, sort_keys=True))
+
+def pair_needs_update(manifest, output_grid_name, input_files, options_digest, output_files):
+    """Decide whether the delta of a pair must be (re)calculated.
+
+    Args:
+        manifest (dict): delta manifest, as returned by 'manifest_functions.read_manifest'
+        output_grid_name (Path): delta grid written for the pair
+        input_files (dict): current descriptions of the pair's summary grids and the zone mask, as returned by
+                            'manifest_functions.describe_input_files'
+        options_digest (str): as returned by 'options_hash'
+        output_files (list): files that should hold the outputs of the pair
+
+    Returns:
+        (bool, str): True if the delta must be calculated, along with a short description of the reason
+    """
+    entry = manifest.get(str(output_grid_name))
+    if entry is None:
+        return True, 'no previous run'
+    if entry.get('options_hash') != options_digest:
+        return True, 'options changed'
+    if entry.get('input_files') != input_files:
+        return True, 'summary grids changed'
+    if not all(output_file.exists() for output_file in output_files):
+        return True, 'outputs missing'
+    return False, 'up to date'
+
+def record_pair(manifest, output_grid_name, input_files, options_digest):
+    """Record the inputs of a delta that has just been calculated in the manifest."""
+    manifest[str(output_grid_name)] = {'options_hash': options_digest,
+                                       'input_files': input_files}
+
+def write_delta_statistics(baseline_filename,
+                           future_filename,
+                           scenario_name,
+                           weather_data_name,
+                           variable_name,
+                           output_grid_name,
+                           mask_filename,
+                           baseline_scenario='historical',
+                           baseline_time_period=None,
+                           min_baseline=0.0,
+                           zone_char_width=2,
+                           crs=None,
+                           netcdf_encodings=None,
+                           nodata_zone=True):
+    """Calculate the change from a baseline summary grid to a future one, and write the change grids to a netCDF file
+    from within the task. Only small metadata and the zonal table are returned.
+
+    Args:
+        baseline_filename (Path): baseline summary grid
+        future_filename (Path): future summary grid, of the same summary type, variable and spatial coverage
+        scenario_name (str): scenario of the future grid
+        weather_data_name (str): weather data name of both grids
+        variable_name (str): swb variable summarized in both grids
+        output_grid_name (Path): netCDF file to write; holds '<variable_name>_change' (future minus baseline) and
+                                 '<variable_name>_percent_change'
+        mask_filename (str): zone mask file
+        baseline_scenario (str): scenario of the baseline grid
+        baseline_time_period (str): time period of the baseline grid
+        min_baseline (float): percent change is NaN where the baseline is no larger than this in magnitude
+        zone_char_width (int): width to which zone labels are zero-padded
+        crs: coordinate reference system of the grids (ex. an EPSG code)
+        netcdf_encodings (dict): netCDF encoding options by variable; see 'netcdf_io_functions.dataset_encoding'
+        nodata_zone (bool): include the cells where the zone mask is nodata as a zone of their own
+
+    Returns:
+        tuple: grid metadata, and the zonal table (a Pandas dataframe)
+    """
+    baseline = nio.read_variable(baseline_filename, variable_name)[variable_name]
+    future = nio.read_variable(future_filename, variable_name)[variable_name]
+    if baseline.shape != future.shape:
+        raise ValueError(f"{future_filename} is shaped {future.shape}, but its baseline {baseline_filename} is "
+                         f"shaped {baseline.shape}")
+
+    def changes(baseline_values, future_values):
+        change = future_values - baseline_values
+        with np.errstate(invalid='ignore', divide='ignore'):
+            percent_change = np.where(np.abs(baseline_values) > min_baseline,
+                                      100. * change / np.abs(baseline_values), np.nan)
+        return change, percent_change
+
+    baseline_values = baseline.values.astype(np.float64)
+    future_values = future.values.astype(np.float64)
+    change, percent_change = changes(baseline_values, future_values)
+
+    delta_dataset = xr.Dataset({f"{variable_name}_change": (future.dims, change.astype(np.float32)),
+                                f"{variable_name}_percent_change": (future.dims, percent_change.astype(np.float32))},
+                               coords=future.coords)
+    delta_dataset = sf.assign_crs(delta_dataset, crs)
+    delta_dataset = delta_dataset.assign_attrs(swb_variable_name=variable_name,
+                                               weather_data_name=weather_data_name,
+                                               scenario_name=scenario_name,
+                                               baseline_scenario=baseline_scenario,
+                                               baseline_time_period=baseline_time_period or '',
+                                               baseline_file=str(baseline_filename),
+                                               future_file=str(future_filename))
+    nio.write_netcdf(delta_dataset, output_grid_name,
+                     encoding=nio.dataset_encoding(delta_dataset, netcdf_encodings))
+
+    # zonal changes are those of each zone's mean, rather than the mean of the cell changes
+    zone_index = zi.load_zone_index(mask_filename, nodata_zone)
+    n_grids = future.shape[0] if future.ndim == 3 else 1
+    baseline_means, future_means = [sf.calculate_zonal_statistics_arrays(values.reshape(n_grids, -1), zone_index,
+                                                                         statistics=['mean'])['mean']
+                                    for values in (baseline_values, future_values)]
+    zone_change, zone_percent_change = changes(baseline_means, future_means)
+    zone_table = sf.zonal_statistics_table({'baseline_mean': baseline_means,
+                                            'future_mean': future_means,
+                                            'change': zone_change,
+                                            'percent_change': zone_percent_change},
+                                           zone_index['zone_ids'], future.dims, future.coords, zone_char_width)
+    zone_table['baseline_scenario'] = baseline_scenario
+    zone_table['baseline_time_period'] = baseline_time_period
+    zone_table['scenario_name'] = scenario_name
+    zone_table['weather_data_name'] = weather_data_name
+    zone_table['swb_variable_name'] = variable_name
+
+    grid_metadata = {'output_grid_name': output_grid_name,
+                     'dims': dict(future.sizes)}
+    return grid_metadata, zone_table
+
+def store_part_filename(pair, store_dir):
+    """Return the name of the file in the delta store that holds the zonal table of a pair."""
+    return zs.partition_filename(store_dir, pair['summary_type'], pair['scenario_name'], pair['weather_data_name'],
+                                 pair['swb_variable_name'], f"{pair['time_period']}__{pair['spatial_coverage']}")
@@ -0,0 +1,136 @@
+import site
+site.addsitedir('.')  # Always appends to end
+
+import argparse
+import sys
+from pathlib import Path
+import logging
+import datetime as dt
+from utility_functions import read_toml_file
+import executor_functions as xf
+import manifest_functions as mf
+import summary_task_functions as st
+import delta_functions as dl
+import zonal_stats_store_functions as zs
+
+"""
+Calculate change-from-baseline grids and zonal tables for each future summary grid written by outputrunner, against
+the historical summary grid of the same weather data name, variable and summary type. Only pairs whose summary
+grids have changed since the last run are calculated again. See delta_functions.py for details.
+"""
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Calculate change-from-baseline grids from SWB2 summary grids')
+    parser.add_argument("run_control_file",
+                        help="run control file, in TOML format")
+    parser.add_argument("output_control_file",
+                        help="output control file, in TOML format")
+    parser.add_argument("--force",
+                        help="recalculate every pair, whether or not its summary grids have changed",
+                        action="store_true")
+
+    try:
+        args = parser.parse_args()
+    except:
+        parser.print_help()
+        sys.exit(0)
+
+    run_control_dict = read_toml_file(filename=args.run_control_file)
+    output_control_dict = read_toml_file(filename=args.output_control_file)
+
+    top_level_dir = Path(run_control_dict['working_directories']['top_level_dir'])
+    base_dir = Path.cwd().parent   # path to git repo that contains this script
+    logfiles_dir = top_level_dir / run_control_dict['working_directories']['logfiles_dir']
+
+    logger = logging.getLogger(__name__)
+    timestamp = dt.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    logging.basicConfig(filename=Path(logfiles_dir)/f"deltarunner__{timestamp}.log", level=logging.INFO, filemode='w')
+    logger.info('Begin executing Python script')
+
+    settings = st.read_summary_settings(run_control_dict, output_control_dict, base_dir)
+    delta_settings = dl.read_delta_settings(output_control_dict, settings)
+
+    pairs = dl.pair_summary_grids(st.find_summary_grids(settings['grid_stats_dir']),
+                                  settings,
+                                  baseline_scenario=delta_settings['baseline_scenario'],
+                                  baseline_period=delta_settings['baseline_period'])
+
+    manifest_filename = delta_settings['grid_dir'] / dl.DELTA_MANIFEST_FILENAME
+    manifest = mf.read_manifest(manifest_filename)
+    options_digest = dl.options_hash(delta_settings)
+
+    # a pair is calculated again only if either summary grid or the zone mask has changed, or an output is missing
+    tasks = []
+    for pair in pairs:
+        output_grid_name = delta_settings['grid_dir'] / pair['path'].name
+        input_files = mf.describe_input_files([pair['baseline_path'], pair['path'], settings['zone_path']])
+        needs_update, reason = dl.pair_needs_update(manifest, output_grid_name, input_files, options_digest,
+                                                    [output_grid_name,
+                                                     dl.store_part_filename(pair, delta_settings['store_dir'])])
+        if args.force or needs_update:
+            logger.info(f"  {pair['path'].name}: {'forced' if args.force else reason}")
+            tasks.append((pair, output_grid_name, input_files))
+        else:
+            logger.info(f"  {pair['path'].name}: up to date; skipped")
+    logger.info(f"Calculating changes from baseline for {len(tasks)} of {len(pairs)} pairs of summary grids")
+
+    # no executor (or Dask cluster) is started if every pair is up to date
+    execution_dict = settings['execution']
+    executor = None
+    if tasks:
+        logger.info(f"creating '{execution_dict.get('backend', 'dask')}' executor for {len(tasks)} tasks...")
+        executor = xf.create_executor(execution_dict, n_tasks=len(tasks))
+
+    failed = []
+    try:
+        futures = {}
+        for pair, output_grid_name, input_files in tasks:
+            future = executor.submit(dl.write_delta_statistics,
+                                     baseline_filename=pair['baseline_path'],
+                                     future_filename=pair['path'],
+                                     scenario_name=pair['scenario_name'],
+                                     weather_data_name=pair['weather_data_name'],
+                                     variable_name=pair['swb_variable_name'],
+                                     output_grid_name=output_grid_name,
+                                     mask_filename=settings['zone_path'],
+                                     baseline_scenario=delta_settings['baseline_scenario'],
+                                     baseline_time_period=pair['baseline_time_period'],
+                                     min_baseline=delta_settings['min_baseline'],
+                                     zone_char_width=2,
+                                     crs=settings['project_crs'],
+                                     netcdf_encodings=settings['netcdf_encodings'],
+                                     nodata_zone=settings['nodata_zone'])
+            futures[future] = (pair, output_grid_name, input_files)
+
+        # zonal tables are written to the delta store, and each pair recorded in the manifest, as each task
+        # finishes; a failed pair is logged and left out of the manifest, so that it is calculated again next time
+        for future in xf.as_completed(list(futures)):
+            pair, output_grid_name, input_files = futures.pop(future)
+            try:
+                grid_metadata, zone_table = future.result()
+            except Exception as e:
+                logger.error(f"  change from baseline of {pair['path'].name} failed: {e}")
+                failed.append(pair['path'].name)
+                continue
+            zs.append_zonal_stats(zone_table,
+                                  store_dir=delta_settings['store_dir'],
+                                  summary_type=pair['summary_type'],
+                                  part_name=f"{pair['time_period']}__{pair['spatial_coverage']}")
+            dl.record_pair(manifest, output_grid_name, input_files, options_digest)
+            mf.write_manifest(manifest, manifest_filename)
+            logger.info(f"  ...wrote {grid_metadata['output_grid_name']}")
+            xf.release(future)
+    finally:
+        if executor is not None:
+            xf.shutdown_executor(executor)
+
+    if 'csv' in settings['zonal_stats_formats']:
+        for summary_type in sorted({pair['summary_type'] for pair in pairs}):
+            zs.export_zonal_stats_csv(delta_settings['store_dir'], summary_type,
+                                      settings['data_summary_dir'] / f"delta_{summary_type}_zonal_stats.csv")
+
+    if failed:
+        logger.error(f"  => {len(failed)} of {len(tasks)} pairs failed: {', '.join(failed)}")
+        sys.exit(1)
+    logger.info(f"  => completed creating delta grids and zonal tables.")
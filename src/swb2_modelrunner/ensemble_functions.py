@@ -0,0 +1,251 @@
+import logging
+import warnings
+from collections import defaultdict
+import numpy as np
+import xarray as xr
+import stats_functions as sf
+import zone_index_functions as zi
+import netcdf_io_functions as nio
+
+"""
+Functions used to calculate multi-model ensemble statistics from the summary grids written by outputrunner. The
+summary grids of every weather data name (GCM) that share a summary type, scenario, variable, time period and
+spatial coverage form one ensemble. Each member grid is read once and folded into running statistics, so that
+only one member is read into memory at a time besides the copies kept for the percentiles:
+
+  - the mean and variance (for the spread) of each cell are updated with Welford's online algorithm, and the
+    minimum and maximum are kept as they go
+  - the median and other percentiles are taken from a fixed-size reservoir sample of the members, one float32
+    copy of the grid for each slot; the reservoir never has more slots than the ensemble has members, so the
+    percentiles are exact for ensembles no larger than 'reservoir_size', and approximate for larger ones. The
+    memory they need does not grow with the ensemble unless 'exact_percentiles' is set, which keeps every member
+
+The same statistics are calculated per zone, from the zonal mean of each member. Ensemble grids are named like
+the summary grids, with 'ensemble' as the weather data name; the zonal tables are kept in a Parquet store of their
+own, as in zonal_stats_store_functions.
+"""
+
+ENSEMBLE_NAME = 'ensemble'
+
+ENSEMBLE_DEFAULTS = {'percentiles': [10, 90],
+                     'reservoir_size': 8,
+                     'exact_percentiles': False,
+                     'min_members': 2,
+                     'seed': 0,
+                     'grid_dir': 'ensemble_grids',
+                     'store_dir': 'ensemble_stats_store'}
+
+logger = logging.getLogger(__name__)
+
+def read_ensemble_settings(output_control_dict, summary_settings):
+    """Combine the [ensemble] section of the output control file with its defaults, and create the directory that
+    holds the ensemble grids.
+
+    Args:
+        output_control_dict (dict): contents of the output control file
+        summary_settings (dict): as returned by 'summary_task_functions.read_summary_settings'
+
+    Returns:
+        dict: ensemble settings, with 'grid_dir' and 'store_dir' as full paths
+    """
+    options = {**ENSEMBLE_DEFAULTS, **output_control_dict.get('ensemble', {})}
+    # an unusable reservoir size is reported here, before any task is started
+    reservoir_slots(options['min_members'], options['reservoir_size'], options['exact_percentiles'])
+    options['grid_dir'] = summary_settings['grid_stats_dir'] / options['grid_dir']
+    options['store_dir'] = summary_settings['data_summary_dir'] / options['store_dir']
+    logger.info(f"creating directory to hold ensemble grids at {options['grid_dir']}.")
+    options['grid_dir'].mkdir(parents=True, exist_ok=True)
+    return options
+
+def group_ensemble_members(summary_grids, settings, min_members=2):
+    """Group summary grids into ensembles across weather data names.
+
+    Args:
+        summary_grids (list): as returned by 'summary_task_functions.find_summary_grids'
+        settings (dict): as returned by 'summary_task_functions.read_summary_settings'; only grids of the selected
+                         summary types, scenarios, weather data names and variables are grouped
+        min_members (int): smallest number of members an ensemble may have
+
+    Returns:
+        dict: path of each member grid keyed by weather data name, keyed by (summary_type, scenario_name,
+              swb_variable_name, time_period, spatial_coverage)
+    """
+    ensembles = defaultdict(dict)
+    for grid in summary_grids:
+        if not ((grid['summary_type'].rsplit('_', 1)[0] in settings['summary_types'])
+                  and (grid['scenario_name'] in settings['scenario_names'])
+                  and (grid['weather_data_name'] in settings['weather_data_names'])
+                  and (grid['swb_variable_name'] in settings['grid_vars'])):
+            continue
+        key = (grid['summary_type'], grid['scenario_name'], grid['swb_variable_name'], grid['time_period'],
+               grid['spatial_coverage'])
+        ensembles[key][grid['weather_data_name']] = grid['path']
+    for key, members in ensembles.items():
+        if len(members) < min_members:
+            logger.info(f"  {'__'.join(key)}: only {len(members)} member(s); no ensemble statistics calculated")
+    return {key: members for key, members in ensembles.items() if len(members) >= min_members}
+
+def reservoir_slots(n_members, reservoir_size=8, exact_percentiles=False):
+    """Return the number of members kept for the percentiles of an ensemble of 'n_members': every member if
+    'exact_percentiles' is set, otherwise no more than 'reservoir_size'.
+
+    Raises:
+        ValueError: if 'reservoir_size' is less than 1 and 'exact_percentiles' is not set
+    """
+    if exact_percentiles:
+        return n_members
+    if reservoir_size < 1:
+        raise ValueError(f"reservoir_size must be at least 1, not {reservoir_size}; set exact_percentiles to keep "
+                         f"every member")
+    return min(reservoir_size, n_members)
+
+def create_accumulator(shape, n_members, reservoir_size=8, seed=0, exact_percentiles=False):
+    """Create the running statistics for an ensemble of 'n_members' grids of the given shape; see
+    'reservoir_slots' for the number of members kept for the percentiles."""
+    return {'n_members': 0,
+            # number of members with a value in each cell
+            'count': np.zeros(shape, dtype=np.int32),
+            'mean': np.zeros(shape, dtype=np.float64),
+            'm2': np.zeros(shape, dtype=np.float64),
+            'min': np.full(shape, np.nan),
+            'max': np.full(shape, np.nan),
+            'reservoir': np.full((reservoir_slots(n_members, reservoir_size, exact_percentiles),) + tuple(shape),
+                                 np.nan, dtype=np.float32),
+            'rng': np.random.default_rng(seed)}
+
+def update_accumulator(accumulator, values):
+    """Fold one ensemble member into the running statistics. Non-finite values are left out."""
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.isfinite(values)
+    accumulator['count'] += valid
+    delta = np.where(valid, values - accumulator['mean'], 0.)
+    accumulator['mean'] += np.where(valid, delta / np.maximum(accumulator['count'], 1), 0.)
+    accumulator['m2'] += np.where(valid, delta * (values - accumulator['mean']), 0.)
+    np.fmin(accumulator['min'], values, out=accumulator['min'])
+    np.fmax(accumulator['max'], values, out=accumulator['max'])
+
+    # reservoir sampling (algorithm R): the first members fill the reservoir, and each later member replaces a
+    # random slot with probability reservoir_size / n_members; one draw serves every cell
+    reservoir_size = accumulator['reservoir'].shape[0]
+    n_members = accumulator['n_members']
+    slot = n_members if n_members < reservoir_size else accumulator['rng'].integers(0, n_members + 1)
+    if slot < reservoir_size:
+        accumulator['reservoir'][slot] = values
+    accumulator['n_members'] += 1
+
+def percentile_names(percentiles):
+    """Return the name of each percentile statistic, keyed by percentile; the 50th is always included, as 'median'."""
+    names = {50.0: 'median'}
+    for percentile in percentiles:
+        names.setdefault(float(percentile), f"p{float(percentile):g}")
+    return names
+
+def summarize_accumulator(accumulator, percentiles=(10, 90)):
+    """Return the ensemble statistics of each cell: 'mean', 'std', 'min', 'max' and 'range' (the spread), and the
+    median and percentiles, named as in 'percentile_names'. Cells with no values are NaN."""
+    count = accumulator['count']
+    has_values = count > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = np.where(has_values, accumulator['m2'] / count, np.nan)
+    statistics = {'mean': np.where(has_values, accumulator['mean'], np.nan),
+                  'std': np.sqrt(variance),
+                  'min': accumulator['min'],
+                  'max': accumulator['max'],
+                  'range': accumulator['max'] - accumulator['min']}
+
+    names = percentile_names(percentiles)
+    sample = accumulator['reservoir'][:min(accumulator['n_members'], accumulator['reservoir'].shape[0])]
+    with warnings.catch_warnings():
+        # cells with no values in any sampled member give NaN, which is what is wanted
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        values = np.nanpercentile(sample, list(names), axis=0)
+    for name, value in zip(names.values(), values):
+        statistics[name] = value
+    return statistics
+
+def write_ensemble_statistics(members,
+                              scenario_name,
+                              variable_name,
+                              output_grid_name,
+                              mask_filename,
+                              percentiles=(10, 90),
+                              reservoir_size=8,
+                              seed=0,
+                              exact_percentiles=False,
+                              zone_char_width=2,
+                              crs=None,
+                              netcdf_encodings=None,
+                              nodata_zone=True):
+    """Calculate the ensemble statistics of a set of summary grids, reading one member at a time, and write the
+    ensemble grids to a netCDF file from within the task. Only small metadata and the zonal table are returned.
+
+    Args:
+        members (dict): path of each member summary grid, keyed by weather data name
+        scenario_name (str): scenario of the ensemble
+        variable_name (str): swb variable summarized in the member grids
+        output_grid_name (Path): netCDF file to write; holds a '<variable_name>_<statistic>' variable per statistic
+        mask_filename (str): zone mask file
+        percentiles (list): percentiles to calculate, besides the median
+        reservoir_size (int): largest number of members sampled for the percentiles
+        seed (int): seed of the random draws made once the reservoir is full
+        exact_percentiles (bool): keep every member for the percentiles, however large the ensemble
+        zone_char_width (int): width to which zone labels are zero-padded
+        crs: coordinate reference system of the grids (ex. an EPSG code)
+        netcdf_encodings (dict): netCDF encoding options by variable; see 'netcdf_io_functions.dataset_encoding'
+        nodata_zone (bool): include the cells where the zone mask is nodata as a zone of their own
+
+    Returns:
+        tuple: grid metadata, and the zonal table (a Pandas dataframe)
+    """
+    n_slots = reservoir_slots(len(members), reservoir_size, exact_percentiles)
+    zone_index = zi.load_zone_index(mask_filename, nodata_zone)
+    grid_accumulator = None
+    zone_accumulator = None
+    members_used = []
+
+    for weather_data_name, filename in members.items():
+        dataarray = nio.read_variable(filename, variable_name)[variable_name]
+        if grid_accumulator is None:
+            dims, shape = dataarray.dims, dataarray.shape
+            coords = {name: coord.variable for name, coord in dataarray.coords.items()}
+            n_grids = shape[0] if len(shape) == 3 else 1
+            grid_accumulator = create_accumulator(shape, len(members), reservoir_size, seed, exact_percentiles)
+            zone_accumulator = create_accumulator((n_grids, len(zone_index['zone_ids'])), len(members),
+                                                  reservoir_size, seed, exact_percentiles)
+        elif dataarray.shape != shape:
+            logger.warning(f"  {filename} is shaped {dataarray.shape} rather than {shape}; left out of the ensemble")
+            continue
+        values = dataarray.values
+        update_accumulator(grid_accumulator, values)
+        zonal_means = sf.calculate_zonal_statistics_arrays(values.reshape(n_grids, -1), zone_index,
+                                                           statistics=['mean'])['mean']
+        update_accumulator(zone_accumulator, zonal_means)
+        members_used.append(weather_data_name)
+        del dataarray, values
+
+    percentile_method = ("every member; exact" if n_slots == len(members)
+                         else f"reservoir sample of {n_slots} of {len(members)} members; approximate")
+    ensemble_dataset = xr.Dataset({f"{variable_name}_{name}": (dims, value.astype(np.float32))
+                                   for name, value in summarize_accumulator(grid_accumulator, percentiles).items()},
+                                  coords=coords)
+    ensemble_dataset = sf.assign_crs(ensemble_dataset, crs)
+    ensemble_dataset = ensemble_dataset.assign_attrs(swb_variable_name=variable_name,
+                                                     weather_data_name=ENSEMBLE_NAME,
+                                                     scenario_name=scenario_name,
+                                                     ensemble_members=', '.join(members_used),
+                                                     n_members=len(members_used),
+                                                     percentile_method=percentile_method)
+    nio.write_netcdf(ensemble_dataset, output_grid_name,
+                     encoding=nio.dataset_encoding(ensemble_dataset, netcdf_encodings))
+
+    zone_table = sf.zonal_statistics_table(summarize_accumulator(zone_accumulator, percentiles),
+                                           zone_index['zone_ids'], dims, coords, zone_char_width)
+    zone_table['n_members'] = len(members_used)
+    zone_table['scenario_name'] = scenario_name
+    zone_table['weather_data_name'] = ENSEMBLE_NAME
+    zone_table['swb_variable_name'] = variable_name
+
+    grid_metadata = {'output_grid_name': output_grid_name,
+                     'members': members_used,
+                     'dims': dict(zip(dims, shape))}
+    return grid_metadata, zone_table
@@ -0,0 +1,113 @@
+import site
+site.addsitedir('.')  # Always appends to end
+
+import argparse
+import sys
+from pathlib import Path
+import logging
+import datetime as dt
+from utility_functions import read_toml_file
+import executor_functions as xf
+import summary_task_functions as st
+import ensemble_functions as en
+import zonal_stats_store_functions as zs
+
+"""
+Calculate multi-model ensemble statistics (mean, median, spread and percentiles, per cell and per zone) across the
+weather data names of each scenario, time period, variable and summary type, from the summary grids already written
+by outputrunner. See ensemble_functions.py for how the statistics are calculated.
+"""
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Calculate multi-model ensemble statistics from SWB2 summary grids')
+    parser.add_argument("run_control_file",
+                        help="run control file, in TOML format")
+    parser.add_argument("output_control_file",
+                        help="output control file, in TOML format")
+
+    try:
+        args = parser.parse_args()
+    except:
+        parser.print_help()
+        sys.exit(0)
+
+    run_control_dict = read_toml_file(filename=args.run_control_file)
+    output_control_dict = read_toml_file(filename=args.output_control_file)
+
+    top_level_dir = Path(run_control_dict['working_directories']['top_level_dir'])
+    base_dir = Path.cwd().parent   # path to git repo that contains this script
+    logfiles_dir = top_level_dir / run_control_dict['working_directories']['logfiles_dir']
+
+    logger = logging.getLogger(__name__)
+    timestamp = dt.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    logging.basicConfig(filename=Path(logfiles_dir)/f"ensemblerunner__{timestamp}.log", level=logging.INFO, filemode='w')
+    logger.info('Begin executing Python script')
+
+    settings = st.read_summary_settings(run_control_dict, output_control_dict, base_dir)
+    ensemble_settings = en.read_ensemble_settings(output_control_dict, settings)
+
+    ensembles = en.group_ensemble_members(st.find_summary_grids(settings['grid_stats_dir']),
+                                          settings,
+                                          min_members=ensemble_settings['min_members'])
+    logger.info(f"Calculating ensemble statistics for {len(ensembles)} sets of summary grids")
+
+    execution_dict = settings['execution']
+    logger.info(f"creating '{execution_dict.get('backend', 'dask')}' executor for {len(ensembles)} tasks...")
+    executor = xf.create_executor(execution_dict, n_tasks=len(ensembles))
+
+    failed = []
+    try:
+        # one task per ensemble; each task reads its members one at a time
+        futures = {}
+        for (summary_type, scenario_name, swb_variable_name, time_period, spatial_coverage), members in ensembles.items():
+            output_grid_name = ensemble_settings['grid_dir'] / st.summary_grid_filename(summary_type, scenario_name,
+                                                                                        en.ENSEMBLE_NAME,
+                                                                                        swb_variable_name,
+                                                                                        time_period,
+                                                                                        spatial_coverage)
+            logger.info(f"  ensemble of {', '.join(members)} ==> {output_grid_name.name}")
+            future = executor.submit(en.write_ensemble_statistics,
+                                     members=members,
+                                     scenario_name=scenario_name,
+                                     variable_name=swb_variable_name,
+                                     output_grid_name=output_grid_name,
+                                     mask_filename=settings['zone_path'],
+                                     percentiles=ensemble_settings['percentiles'],
+                                     reservoir_size=ensemble_settings['reservoir_size'],
+                                     seed=ensemble_settings['seed'],
+                                     exact_percentiles=ensemble_settings['exact_percentiles'],
+                                     zone_char_width=2,
+                                     crs=settings['project_crs'],
+                                     netcdf_encodings=settings['netcdf_encodings'],
+                                     nodata_zone=settings['nodata_zone'])
+            futures[future] = (summary_type, f"{time_period}__{spatial_coverage}", output_grid_name)
+
+        # the zonal tables are appended to the ensemble store as each task finishes; a failed ensemble is logged,
+        # and the others carry on
+        for future in xf.as_completed(list(futures)):
+            summary_type, part_name, output_grid_name = futures.pop(future)
+            try:
+                grid_metadata, zone_table = future.result()
+            except Exception as e:
+                logger.error(f"  ensemble statistics for {output_grid_name.name} failed: {e}")
+                failed.append(output_grid_name.name)
+                continue
+            zs.append_zonal_stats(zone_table,
+                                  store_dir=ensemble_settings['store_dir'],
+                                  summary_type=summary_type,
+                                  part_name=part_name)
+            logger.info(f"  ...wrote {grid_metadata['output_grid_name']} ({len(grid_metadata['members'])} members)")
+            xf.release(future)
+    finally:
+        xf.shutdown_executor(executor)
+
+    if 'csv' in settings['zonal_stats_formats']:
+        for summary_type in sorted({key[0] for key in ensembles}):
+            zs.export_zonal_stats_csv(ensemble_settings['store_dir'], summary_type,
+                                      settings['data_summary_dir'] / f"{en.ENSEMBLE_NAME}_{summary_type}_zonal_stats.csv")
+
+    if failed:
+        logger.error(f"  => {len(failed)} of {len(ensembles)} ensembles failed: {', '.join(failed)}")
+        sys.exit(1)
+    logger.info(f"  => completed creating ensemble grids and zonal tables.")
@@ -0,0 +1,100 @@
+import concurrent.futures
+import logging
+import os
+from dask.distributed import Client, LocalCluster
+import dask.distributed
+
+"""
+Functions used to create the executor that runs outputrunner's tasks. Every backend offers the same
+'submit(fn, *args, **kwargs)' / 'future.result()' interface:
+
+  dask    - a Dask LocalCluster, sized from the [execution] section of the output control file
+  process - a concurrent.futures.ProcessPoolExecutor; no scheduler or dashboard to start
+  serial  - each task runs in this process as soon as it is submitted; cheapest for a handful of files
+  auto    - 'serial' for jobs of no more than 'serial_max_tasks' tasks, 'dask' otherwise
+"""
+
+logger = logging.getLogger(__name__)
+
+class SerialExecutor(concurrent.futures.Executor):
+    """Executor that runs each task immediately, in the calling process."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+def _n_workers(execution_dict):
+    n_workers = execution_dict.get('n_workers', 0)
+    return n_workers if n_workers > 0 else (os.cpu_count() or 1)
+
+def create_executor(execution_dict, n_tasks=None):
+    """Create an executor from the [execution] section of the output control file.
+
+    Args:
+        execution_dict (dict): execution settings; see the example output control file
+        n_tasks (int): number of tasks that will be submitted; used by the 'auto' backend
+
+    Returns:
+        executor: a dask.distributed Client or a concurrent.futures Executor
+    """
+    backend = execution_dict.get('backend', 'dask')
+    if backend == 'auto':
+        if n_tasks is not None and n_tasks <= execution_dict.get('serial_max_tasks', 4):
+            backend = 'serial'
+        else:
+            backend = 'dask'
+
+    match backend:
+
+        case 'serial':
+            logger.info("running tasks serially in this process")
+            return SerialExecutor()
+
+        case 'process':
+            n_workers = _n_workers(execution_dict)
+            logger.info(f"creating process pool with {n_workers} workers")
+            return concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+
+        case 'dask':
+            n_workers = _n_workers(execution_dict)
+            local_directory = execution_dict.get('local_directory') or None
+            ## more than one thread per worker used to lead to spurious HDF5 and netCDF read errors; the summary
+            ## tasks now make every netCDF call through netcdf_io_functions, which serializes them
+            cluster = LocalCluster(n_workers=n_workers,
+                                   threads_per_worker=execution_dict.get('threads_per_worker', 1),
+                                   memory_limit=execution_dict.get('memory_limit', 'auto'),
+                                   local_directory=local_directory)
+            if execution_dict.get('adaptive', False):
+                cluster.adapt(minimum=execution_dict.get('minimum_workers', 1),
+                              maximum=execution_dict.get('maximum_workers', n_workers))
+            logger.info(f"created Dask cluster: {cluster}")
+            return Client(cluster)
+
+        case _:
+            raise ValueError(f"unknown execution backend '{backend}'")
+
+def as_completed(futures):
+    """Iterate over 'futures' as they finish, whichever executor created them."""
+    futures = list(futures)
+    if any(isinstance(future, dask.distributed.Future) for future in futures):
+        return dask.distributed.as_completed(futures)
+    return concurrent.futures.as_completed(futures)
+
+def release(future):
+    """Let the executor drop its copy of a finished task's result."""
+    if isinstance(future, dask.distributed.Future):
+        future.release()
+
+def shutdown_executor(executor):
+    """Shut down an executor (and, for Dask, its cluster)."""
+    if isinstance(executor, Client):
+        cluster = executor.cluster
+        executor.close()
+        if cluster is not None:
+            cluster.close()
+    else:
+        executor.shutdown()
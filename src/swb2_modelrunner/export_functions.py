@@ -1,27 +1,81 @@
 import xarray as xr
 import rioxarray as rio
-import xrspatial as xrs
 import numpy as np
 import pandas as pd
 import datetime as dt
 
+"""
+Functions used to export summary grids as GeoTIFF images. Each summary grid is written as a single Cloud-Optimized
+GeoTIFF (COG): one band per time step (year, month, ...), internally tiled, DEFLATE-compressed and with overviews,
+so that GIS clients reading the file over a network only fetch the tiles and zoom level they display.
+"""
 
-def export_xarray_dataset_as_series_of_tif_images(ds,
-                                            summary_type,
-                                            scenario_name,
-                                            weather_data_name,
-                                            swb_variable_name,
-                                            time_period,
-                                            output_image_dir):
+# defaults for the creation options passed to the GDAL COG driver; any of these may be overridden in the
+# [geotiff_output] section of the output control file
+GEOTIFF_OPTIONS = {'compress': 'DEFLATE',
+                   'level': 6,
+                   'predictor': 'YES',
+                   'blocksize': 512,
+                   'overviews': 'AUTO',
+                   'overview_resampling': 'AVERAGE',
+                   'bigtiff': 'IF_SAFER'}
 
+def _band_descriptions(values, band_dim, summary_type):
+  """Return a description for each band of a multi-band image (ex. '2041', '2041-07', 'Jul')."""
+  match band_dim:
 
-  match summary_type:
+    case 'time':
+      if summary_type == 'monthly':
+        return [pd.Timestamp(value).strftime('%Y-%m') for value in values]
+      else:
+        return [pd.Timestamp(value).strftime('%Y') for value in values]
 
-    case "mean_annual":
-      ds[swb_variable_name].rio.to_raster(output_image_dir / 
-        f"{time_period}__{summary_type}__{scenario_name}__{weather_data_name}__{swb_variable_name}.tif")
-      return
+    case 'month':
+      return [dt.date(2000, int(value), 1).strftime('%b') for value in values]
 
     case _:
-          print(f"unknown summary_type '{summary_type}'")
-          #exit(1)
+      return [str(value) for value in values]
+
+def export_xarray_dataset_as_cog(ds,
+                                 summary_type,
+                                 scenario_name,
+                                 weather_data_name,
+                                 swb_variable_name,
+                                 time_period,
+                                 output_image_dir,
+                                 crs=None,
+                                 geotiff_options=None):
+  """Write one summary grid as a multi-band Cloud-Optimized GeoTIFF, one band per time step.
+
+  Args:
+      ds (xarray dataset): summary grid; 2-D for mean_annual summaries, otherwise with a leading time,
+                           month, year or water_year dimension
+      summary_type (str): summary type without the operation suffix (ex. 'monthly', 'mean_annual')
+      scenario_name, weather_data_name, swb_variable_name, time_period (str): used to name the image file
+      output_image_dir (Path): directory the image is written to
+      crs (int or str): coordinate reference system of the grid (ex. 5070)
+      geotiff_options (dict): GDAL COG creation options that override those in 'GEOTIFF_OPTIONS'
+
+  Returns:
+      Path: name of the image file written
+  """
+  options = {**GEOTIFF_OPTIONS, **(geotiff_options or {})}
+  output_filename = output_image_dir / f"{time_period}__{summary_type}__{scenario_name}__{weather_data_name}__{swb_variable_name}.tif"
+
+  da = ds[swb_variable_name]
+  if crs is not None:
+    da = da.rio.write_crs(crs)
+  if np.issubdtype(da.dtype, np.floating):
+    da = da.rio.write_nodata(np.nan, encoded=False)
+
+  band_dims = [dim for dim in da.dims if dim not in (da.rio.y_dim, da.rio.x_dim)]
+  if band_dims:
+    band_dim = band_dims[0]
+    da = da.transpose(band_dim, da.rio.y_dim, da.rio.x_dim)
+    da.attrs['long_name'] = tuple(_band_descriptions(da[band_dim].values, band_dim, summary_type))
+  else:
+    da.attrs['long_name'] = swb_variable_name
+
+  # GDAL expects the creation option names in upper case
+  da.rio.to_raster(output_filename, driver='COG', **{key.upper(): value for key, value in options.items()})
+  return output_filename
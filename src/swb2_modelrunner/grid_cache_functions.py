@@ -0,0 +1,194 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+"""
+Functions used to read Arc ASCII grids (zone masks, land use, available water capacity, soil groups) through a
+binary cache. The first time a grid is read, its values are parsed from text once and written to a cache file
+holding a small JSON header (grid size, geotransform, nodata value, data type, and the size and modification time of
+the source) followed by the raw array. Every later read, in any process, memory-maps the array from the cache file
+without copying or parsing it. A cache file whose source has since changed is rebuilt.
+
+The cache file is written next to the grid ('<grid>.gridcache'); if that directory cannot be written to, it goes to
+a per-user cache directory instead, named from a hash of the grid's path.
+"""
+
+GRID_CACHE_SUFFIX = '.gridcache'
+GRID_CACHE_MAGIC = b'SWBGRID1'
+# bytes set aside for the magic number and JSON header; the array starts at this offset
+GRID_CACHE_HEADER_BYTES = 4096
+USER_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'swb2_modelrunner' / 'grids'
+
+ASC_HEADER_KEYS = ['ncols', 'nrows', 'xllcorner', 'yllcorner', 'xllcenter', 'yllcenter', 'cellsize',
+                   'nodata_value']
+
+def read_asc_header(filename):
+    """Read the header of an Arc ASCII grid (and nothing more).
+
+    Returns:
+        dict: 'ncols', 'nrows', 'xllcorner', 'yllcorner', 'cellsize' and 'nodata' (None if not given), and
+              'n_header_lines'
+    """
+    header = {}
+    n_header_lines = 0
+    with open(filename) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 2 or parts[0].lower() not in ASC_HEADER_KEYS:
+                break
+            header[parts[0].lower()] = float(parts[1])
+            n_header_lines += 1
+    for key in ['ncols', 'nrows', 'cellsize']:
+        if key not in header:
+            raise ValueError(f"no '{key}' in the header of {filename}")
+    # a grid located by its lower left cell center is converted to its lower left corner
+    half_cell = header['cellsize'] / 2.0
+    return {'ncols': int(header['ncols']),
+            'nrows': int(header['nrows']),
+            'xllcorner': header.get('xllcorner', header.get('xllcenter', 0.0) - half_cell),
+            'yllcorner': header.get('yllcorner', header.get('yllcenter', 0.0) - half_cell),
+            'cellsize': header['cellsize'],
+            'nodata': header.get('nodata_value'),
+            'n_header_lines': n_header_lines}
+
+def read_asc_values(filename, header=None):
+    """Parse the values of an Arc ASCII grid. Grids holding only whole numbers are returned as int32, all others as
+    float32; nodata cells keep the grid's nodata value."""
+    header = header or read_asc_header(filename)
+    shape = (header['nrows'], header['ncols'])
+    values = pd.read_csv(filename, sep=r'\s+', header=None, skiprows=header['n_header_lines'],
+                         dtype='float64', engine='c').to_numpy()
+    if values.shape != shape:
+        # rows wrapped over more than one line, or ragged; read the values as one stream
+        with open(filename) as f:
+            for _ in range(header['n_header_lines']):
+                f.readline()
+            values = np.array(f.read().split(), dtype='float64').reshape(shape)
+    finite = values[np.isfinite(values)]
+    if (np.array_equal(finite, np.round(finite)) and np.isfinite(values).all()
+          and (finite.size == 0 or (finite.min() >= np.iinfo('int32').min and finite.max() <= np.iinfo('int32').max))):
+        return values.astype('int32')
+    return values.astype('float32')
+
+def grid_cache_filename(filename):
+    """Return the name of the cache file for a grid: next to the grid if its directory can be written to,
+    otherwise in the per-user cache directory."""
+    source = Path(filename).resolve()
+    if os.access(source.parent, os.W_OK):
+        return Path(f"{source}{GRID_CACHE_SUFFIX}")
+    digest = hashlib.sha1(str(source).encode('utf-8')).hexdigest()[:12]
+    return USER_CACHE_DIR / f"{digest}__{source.name}{GRID_CACHE_SUFFIX}"
+
+def _source_description(filename):
+    stat_result = os.stat(filename)
+    return {'source': str(Path(filename).resolve()), 'size': stat_result.st_size, 'mtime': stat_result.st_mtime}
+
+def write_grid_cache(filename, cache_filename=None):
+    """Parse an Arc ASCII grid and write its cache file. The file is written under a temporary name and then moved
+    into place, so that readers never see a partial cache file.
+
+    Returns:
+        Path: name of the cache file
+    """
+    cache_filename = Path(cache_filename or grid_cache_filename(filename))
+    header = read_asc_header(filename)
+    values = read_asc_values(filename, header)
+    cellsize = header['cellsize']
+    description = {**_source_description(filename),
+                   'nrows': header['nrows'],
+                   'ncols': header['ncols'],
+                   'cellsize': cellsize,
+                   'xllcorner': header['xllcorner'],
+                   'yllcorner': header['yllcorner'],
+                   # GDAL order: x of upper left corner, cell width, 0, y of upper left corner, 0, -cell height
+                   'geotransform': [header['xllcorner'], cellsize, 0.0,
+                                    header['yllcorner'] + header['nrows'] * cellsize, 0.0, -cellsize],
+                   'nodata': header['nodata'],
+                   'dtype': values.dtype.str}
+    header_bytes = GRID_CACHE_MAGIC + json.dumps(description).encode('utf-8')
+    if len(header_bytes) > GRID_CACHE_HEADER_BYTES:
+        raise ValueError(f"grid cache header for {filename} is too long")
+
+    cache_filename.parent.mkdir(parents=True, exist_ok=True)
+    tmp_filename = cache_filename.with_name(f"{cache_filename.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_filename, 'wb') as f:
+        f.write(header_bytes.ljust(GRID_CACHE_HEADER_BYTES, b' '))
+        f.write(np.ascontiguousarray(values).tobytes())
+    os.replace(tmp_filename, cache_filename)
+    return cache_filename
+
+def read_grid_cache_header(cache_filename):
+    """Return the JSON header of a grid cache file, or None if the file is missing or is not a grid cache file."""
+    try:
+        with open(cache_filename, 'rb') as f:
+            header_bytes = f.read(GRID_CACHE_HEADER_BYTES)
+    except OSError:
+        return None
+    if not header_bytes.startswith(GRID_CACHE_MAGIC):
+        return None
+    try:
+        return json.loads(header_bytes[len(GRID_CACHE_MAGIC):].decode('utf-8'))
+    except ValueError:
+        return None
+
+def _cache_is_current(description, filename):
+    current = _source_description(filename)
+    return description is not None and all(description.get(key) == current[key] for key in ['size', 'mtime'])
+
+@functools.lru_cache(maxsize=16)
+def _load_grid(filename, size, mtime):
+    cache_filename = grid_cache_filename(filename)
+    description = read_grid_cache_header(cache_filename)
+    if not _cache_is_current(description, filename):
+        write_grid_cache(filename, cache_filename)
+        description = read_grid_cache_header(cache_filename)
+    values = np.memmap(cache_filename, dtype=np.dtype(description['dtype']), mode='r',
+                       offset=GRID_CACHE_HEADER_BYTES, shape=(description['nrows'], description['ncols']))
+    return values, description
+
+def load_grid(filename):
+    """Return the values of an Arc ASCII grid, memory-mapped from its cache file (built first if it is missing or
+    older than the grid). The array is read-only; nodata cells hold the grid's nodata value. Each process keeps the
+    mapping for the lifetime of the process.
+
+    Returns:
+        (numpy memmap, dict): the values (nrows by ncols), and the cache header: 'nrows', 'ncols', 'cellsize',
+                              'xllcorner', 'yllcorner', 'geotransform', 'nodata' and 'dtype'
+    """
+    stat_result = os.stat(filename)
+    return _load_grid(str(Path(filename).resolve()), stat_result.st_size, stat_result.st_mtime)
+
+def read_grid_header(filename):
+    """Return the header of an Arc ASCII grid, from its cache file if that is up to date (no text is parsed),
+    otherwise from the grid itself."""
+    description = read_grid_cache_header(grid_cache_filename(filename))
+    if _cache_is_current(description, filename):
+        return description
+    return read_asc_header(filename)
+
+def load_grid_dataarray(filename, masked=False):
+    """Return an Arc ASCII grid as an xarray DataArray with cell-center 'y' and 'x' coordinates.
+
+    Args:
+        masked (bool): replace nodata cells with NaN; this makes a float copy of the values, where otherwise the
+                       DataArray wraps the memory-mapped cache without copying it
+
+    Returns:
+        xarray DataArray: the grid values, with the cache header (less its source description) as attributes
+    """
+    # imported here, so that reading grid headers (ex. in pre-flight checks) does not load xarray
+    import xarray as xr
+    values, description = load_grid(filename)
+    cellsize = description['cellsize']
+    x = description['xllcorner'] + cellsize * (np.arange(description['ncols']) + 0.5)
+    y = description['yllcorner'] + cellsize * (np.arange(description['nrows'])[::-1] + 0.5)
+    if masked and description['nodata'] is not None:
+        values = np.where(values == description['nodata'], np.nan, values)
+    attributes = {key: value for key, value in description.items() if key not in ('source', 'size', 'mtime')}
+    return xr.DataArray(values, dims=('y', 'x'), coords={'y': y, 'x': x}, name=Path(filename).stem,
+                        attrs=attributes)
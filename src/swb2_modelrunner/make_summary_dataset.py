@@ -2,6 +2,9 @@ import site
 site.addsitedir('.')  # Always appends to end
 
 import stats_functions as sf
+import export_functions as ef
+import zone_index_functions as zi
+import netcdf_io_functions as nio
 import time
 import xarray as xr
 
@@ -12,29 +15,159 @@ def calculate_spatial_statistics(netcdf_filename,
                                  weather_data_name, 
                                  zone_char_width,
                                  summary_type,
-                                 crs):
+                                 crs,
+                                 seasons=None,
+                                 nodata_zone=True,
+                                 majority=False):
 
-    xarray_dataset = xr.open_dataset(netcdf_filename)
+    # the variable is opened lazily; each slice read from the file takes the per-process netCDF lock, and the
+    # reductions below run without it
+    xarray_dataset = nio.read_variable(netcdf_filename, variable_name)
 
-    mask_dataarray = xr.open_dataarray(mask_filename).astype('int')[0,:,:]
+    # the zone index is built once per mask file and memory-mapped from disk thereafter
+    zone_index = zi.load_zone_index(mask_filename, nodata_zone)
 
     summary_dataset = sf.summarize_array_values(xarray_dataset=xarray_dataset,
                                                 variable_name=variable_name,
                                                 summary_type=summary_type,
-                                                crs=crs)
+                                                crs=crs,
+                                                seasons=seasons)
     summary_dataset = summary_dataset.assign_attrs(swb_variable_name=variable_name, 
                                                      weather_data_name=weather_data_name,
                                                      scenario_name=scenario_name)
 
     zonal_stats = sf.calculate_zonal_statistics(xarray_dataarray=summary_dataset[variable_name],
-                                                mask_dataarray=mask_dataarray,
+                                                mask_dataarray=None,
+                                                zone_index=zone_index,
                                                 summary_type=summary_type,
-                                                num_zone_chars=zone_char_width)
+                                                num_zone_chars=zone_char_width,
+                                                majority=majority)
     zonal_stats['scenario_name'] = scenario_name
     zonal_stats['swb_variable_name'] = variable_name
     zonal_stats['weather_data_name'] = weather_data_name
     
     #xarray_dataset.close()
-    #mask_dataarray.close()
     
-    return summary_dataset, zonal_stats
\ No newline at end of file
+    return summary_dataset, zonal_stats
+
+def calculate_spatial_statistics_multi(netcdf_filename,
+                                       mask_filename,
+                                       scenario_name,
+                                       variable_name,
+                                       weather_data_name,
+                                       zone_char_width,
+                                       summary_types,
+                                       crs,
+                                       seasons=None,
+                                       nodata_zone=True,
+                                       majority=False):
+    """Single-pass version of 'calculate_spatial_statistics': the daily netCDF file is read once and
+    every summary type in 'summary_types' is calculated from it.
+
+    Returns:
+        dict: (summary_dataset, zonal_stats) tuple for each summary type, keyed by summary type
+    """
+
+    # the variable is opened lazily and read one month at a time by 'summarize_array_values_multi'; each read
+    # takes the per-process netCDF lock, and the reductions run without it
+    xarray_dataset = nio.read_variable(netcdf_filename, variable_name)
+
+    # the zone index is built once per mask file and memory-mapped from disk thereafter
+    zone_index = zi.load_zone_index(mask_filename, nodata_zone)
+
+    summary_datasets = sf.summarize_array_values_multi(xarray_dataset=xarray_dataset,
+                                                       variable_name=variable_name,
+                                                       summary_types=summary_types,
+                                                       crs=crs,
+                                                       seasons=seasons)
+
+    results = {}
+    for summary_type, summary_dataset in summary_datasets.items():
+        summary_dataset = summary_dataset.assign_attrs(swb_variable_name=variable_name,
+                                                       weather_data_name=weather_data_name,
+                                                       scenario_name=scenario_name)
+
+        zonal_stats = sf.calculate_zonal_statistics(xarray_dataarray=summary_dataset[variable_name],
+                                                    mask_dataarray=None,
+                                                    zone_index=zone_index,
+                                                    summary_type=summary_type,
+                                                    num_zone_chars=zone_char_width,
+                                                    majority=majority)
+        zonal_stats['scenario_name'] = scenario_name
+        zonal_stats['swb_variable_name'] = variable_name
+        zonal_stats['weather_data_name'] = weather_data_name
+
+        results[summary_type] = (summary_dataset, zonal_stats)
+
+    return results
+
+
+def write_spatial_statistics_multi(netcdf_filename,
+                                   mask_filename,
+                                   scenario_name,
+                                   variable_name,
+                                   weather_data_name,
+                                   zone_char_width,
+                                   summary_types,
+                                   output_grid_names,
+                                   crs,
+                                   tif_image_dir=None,
+                                   time_period=None,
+                                   seasons=None,
+                                   geotiff_options=None,
+                                   netcdf_encodings=None,
+                                   nodata_zone=True,
+                                   majority=False):
+    """Calculate every summary type in 'summary_types' from a daily netCDF file, as in
+    'calculate_spatial_statistics_multi', and write each summary grid to its netCDF file (and, optionally,
+    to a multi-band Cloud-Optimized GeoTIFF) from within the task. Only small metadata and the zonal statistics are
+    returned, so the summary grids never have to be sent back to the client.
+
+    Args:
+        output_grid_names (dict): name of the netCDF file to write for each summary type
+        tif_image_dir (Path): if given, each summary grid is also exported as a GeoTIFF to this directory
+        time_period (str): short time period (ex. '2040-2059') used to name the GeoTIFF images
+        seasons (dict): user-defined seasons, as described in 'stats_functions.summarize_by_labels'
+        geotiff_options (dict): GDAL COG creation options; see 'export_functions.GEOTIFF_OPTIONS'
+        netcdf_encodings (dict): netCDF encoding options by variable; see 'netcdf_io_functions.dataset_encoding'
+        nodata_zone (bool): include the cells where the zone mask is nodata as a zone of their own; see
+                            'zone_index_functions'
+        majority (bool): add the 'majority' (most frequent value) of each zone to the zonal statistics
+
+    Returns:
+        dict: (grid_metadata, zonal_stats) tuple for each summary type, keyed by summary type
+    """
+    results = calculate_spatial_statistics_multi(netcdf_filename=netcdf_filename,
+                                                 mask_filename=mask_filename,
+                                                 scenario_name=scenario_name,
+                                                 variable_name=variable_name,
+                                                 weather_data_name=weather_data_name,
+                                                 zone_char_width=zone_char_width,
+                                                 summary_types=summary_types,
+                                                 crs=crs,
+                                                 seasons=seasons,
+                                                 nodata_zone=nodata_zone,
+                                                 majority=majority)
+
+    written = {}
+    for summary_type, (summary_dataset, zonal_stats) in results.items():
+        output_grid_name = output_grid_names[summary_type]
+        nio.write_netcdf(summary_dataset, output_grid_name,
+                         encoding=nio.dataset_encoding(summary_dataset, netcdf_encodings))
+
+        if tif_image_dir is not None:
+            ef.export_xarray_dataset_as_cog(ds=summary_dataset,
+                                            summary_type=summary_type.rsplit('_', 1)[0],
+                                            scenario_name=scenario_name,
+                                            weather_data_name=weather_data_name,
+                                            swb_variable_name=variable_name,
+                                            time_period=time_period,
+                                            output_image_dir=tif_image_dir,
+                                            crs=crs,
+                                            geotiff_options=geotiff_options)
+
+        grid_metadata = {'output_grid_name': output_grid_name,
+                         'dims': dict(summary_dataset[variable_name].sizes)}
+        written[summary_type] = (grid_metadata, zonal_stats)
+
+    return written
@@ -0,0 +1,97 @@
+import datetime as dt
+import hashlib
+import json
+import os
+from pathlib import Path
+
+"""
+Functions used to maintain a run manifest in the swb2 work directory. For each simulation the manifest
+records a hash of the rendered control file, the size and modification time of each input file, the
+exit code returned by swb2 and the output files produced. On a rerun, only simulations whose inputs
+have changed, or that failed or never finished, need to be launched again.
+"""
+
+MANIFEST_FILENAME = 'run_manifest.json'
+
+def hash_text(text):
+    """Return the SHA-256 hex digest of a string (for example, the rendered swb2 control file)."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def describe_input_files(filenames, stat_cache=None):
+    """Return a dict of {filename: {'size': bytes, 'mtime': seconds}} for a list of input files.
+    Files that do not exist are recorded with a value of None. If a 'stat_cache' dict is given, each
+    file is stat'ed only once however many simulations refer to it; the cache holds the os.stat result
+    (or None) of each file name."""
+    if stat_cache is None:
+        stat_cache = {}
+    input_files = {}
+    for filename in filenames:
+        if str(filename) not in stat_cache:
+            try:
+                stat_cache[str(filename)] = os.stat(filename)
+            except OSError:
+                stat_cache[str(filename)] = None
+        stat_result = stat_cache[str(filename)]
+        input_files[str(filename)] = (None if stat_result is None
+                                      else {'size': stat_result.st_size, 'mtime': stat_result.st_mtime})
+    return input_files
+
+def list_output_files(output_dir):
+    """Return a sorted list of the names of the files found in a simulation's output directory."""
+    output_path = Path(output_dir)
+    if not output_path.is_dir():
+        return []
+    return sorted(f.name for f in output_path.iterdir() if f.is_file())
+
+def read_manifest(manifest_filename):
+    """Read a run manifest; return an empty manifest if the file does not exist or cannot be parsed."""
+    try:
+        with open(manifest_filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(manifest, manifest_filename):
+    """Write a run manifest. The file is written to a temporary name and then moved into place so that
+    an interrupted write never leaves a truncated manifest behind."""
+    tmp_filename = f"{manifest_filename}.tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_filename, manifest_filename)
+
+def simulation_needs_run(manifest, simulation_name, control_file_hash, input_files, output_dir):
+    """Decide whether a simulation must be (re)launched.
+
+    Args:
+        manifest (dict): run manifest, as returned by 'read_manifest'
+        simulation_name (str): name of the simulation
+        control_file_hash (str): hash of the control file text rendered for this run
+        input_files (dict): current input file descriptions, as returned by 'describe_input_files'
+        output_dir (str): directory that should hold the output files produced by this simulation
+
+    Returns:
+        (bool, str): True if the simulation must be run, along with a short description of the reason
+    """
+    entry = manifest.get(simulation_name)
+    if entry is None:
+        return True, 'no previous run'
+    if entry.get('control_file_hash') != control_file_hash:
+        return True, 'control file changed'
+    if entry.get('input_files') != input_files:
+        return True, 'input files changed'
+    if entry.get('exit_code') != 0:
+        return True, f"previous run did not finish successfully (exit code: {entry.get('exit_code')})"
+    existing_output_files = set(list_output_files(output_dir))
+    if not entry.get('output_files') or not set(entry['output_files']).issubset(existing_output_files):
+        return True, 'output files missing'
+    return False, 'up to date'
+
+def record_simulation(manifest, simulation_name, control_file_hash, input_files, exit_code=None, output_files=None):
+    """Add or replace the manifest entry for a simulation. An exit code of None marks a run that was
+    started but has not (yet) finished."""
+    manifest[simulation_name] = {'control_file_hash': control_file_hash,
+                                 'input_files': input_files,
+                                 'exit_code': exit_code,
+                                 'output_files': output_files if output_files is not None else [],
+                                 'updated': dt.datetime.now().isoformat(timespec='seconds')}
+    return manifest
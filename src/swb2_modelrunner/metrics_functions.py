@@ -0,0 +1,53 @@
+import json
+import pandas as pd
+
+"""
+Functions used to record the resources used by each swb2 simulation: wall time, CPU time, peak resident memory,
+bytes read and written, and exit code. Metrics are appended to a JSON lines file as each simulation finishes, so
+that they survive an interrupted run, and are written to a csv file and summarized once every simulation is done.
+"""
+
+METRICS_FIELDS = ['simulation_name', 'start_time', 'end_time', 'wall_time_s', 'cpu_user_s', 'cpu_system_s',
+                  'peak_rss_bytes', 'read_bytes', 'write_bytes', 'exit_code']
+
+def append_metrics(metrics, jsonl_filename):
+    """Append the metrics of one simulation to a JSON lines file."""
+    with open(jsonl_filename, 'a') as f:
+        f.write(json.dumps({field: metrics.get(field) for field in METRICS_FIELDS}) + '\n')
+
+def read_metrics(jsonl_filename):
+    """Read a JSON lines metrics file into a dataframe, one row per simulation."""
+    return pd.read_json(jsonl_filename, lines=True, dtype={'simulation_name': str, 'exit_code': 'Int64'})
+
+def write_metrics_csv(metrics_df, csv_filename):
+    """Write a dataframe of simulation metrics to a csv file."""
+    metrics_df.to_csv(csv_filename, columns=METRICS_FIELDS, index=False)
+
+def summarize_metrics(metrics_df):
+    """Return a table summarizing a dataframe of simulation metrics, in units suited to sizing an allocation.
+
+    Returns:
+        Pandas dataframe: wall time (hours), CPU time (hours), CPU utilization, peak memory (GB) and gigabytes read
+                          and written, for each simulation, followed by rows for the mean, maximum and total;
+                          figures that were not measured are NaN, and left out of the mean, maximum and total
+    """
+    # figures that were not measured (ex. CPU time and memory under SLURM without sacct) are None, or missing from
+    # the file altogether; they are left out of the means, maxima and totals
+    values = {field: pd.to_numeric(metrics_df[field], errors='coerce') if field in metrics_df
+              else pd.Series(float('nan'), index=metrics_df.index)
+              for field in ['wall_time_s', 'cpu_user_s', 'cpu_system_s', 'peak_rss_bytes', 'read_bytes', 'write_bytes']}
+    summary_df = pd.DataFrame({'simulation_name': metrics_df['simulation_name'],
+                               'wall_time_h': values['wall_time_s'] / 3600.,
+                               'cpu_time_h': (values['cpu_user_s'] + values['cpu_system_s']) / 3600.,
+                               'peak_rss_gb': values['peak_rss_bytes'] / 1024**3,
+                               'read_gb': values['read_bytes'] / 1024**3,
+                               'write_gb': values['write_bytes'] / 1024**3,
+                               'exit_code': metrics_df['exit_code']})
+    summary_df['cpu_utilization'] = (summary_df['cpu_time_h'] / summary_df['wall_time_h']).where(summary_df['wall_time_h'] > 0)
+
+    numeric_columns = ['wall_time_h', 'cpu_time_h', 'cpu_utilization', 'peak_rss_gb', 'read_gb', 'write_gb']
+    totals = [{'simulation_name': 'mean', **summary_df[numeric_columns].mean().to_dict()},
+              {'simulation_name': 'max', **summary_df[numeric_columns].max().to_dict()},
+              {'simulation_name': 'total', **summary_df[numeric_columns].drop(columns=['cpu_utilization', 'peak_rss_gb']).sum(min_count=1).to_dict()}]
+    summary_df = pd.concat([summary_df, pd.DataFrame(totals)], ignore_index=True)
+    return summary_df[['simulation_name'] + numeric_columns + ['exit_code']]
@@ -7,16 +7,46 @@ import datetime as dt
 import os
 import sys
 from utility_functions import read_toml_file
-import subprocess
-import time
+import scheduler_functions as scheduler
+import slurm_functions as slurm
+import manifest_functions as mf
+import catalog_functions as cat
+import metrics_functions as metrics
+import progress_functions as pf
+import preflight_functions as preflight
+import staging_functions as staging
 
 """
 This file takes a configuration file that contains varied weather data and gridded input drivers and 
-creates a set of swb control files along with a working directory, logfile and output file directories. Python's Popen 
-class is used to fire off a swb2 run in each of the directories it creates.
-
-By design, each time the script is run, the old working directory is completely removed. I want to ensure that 
-whatever we are looking at includes only files generated from the latest swb2 model run.
+creates a set of swb control files along with a working directory, logfile and output file directories. A swb2 run
+is started in each of the directories it creates. The 'backend' setting in the [model_execution] section of the run
+control file selects where the runs happen:
+
+  local - swb2 processes are started on this machine; the number running at any one time is limited by the
+          'max_concurrent_runs' setting
+  slurm - the runs are submitted as a SLURM job array and spread across the nodes of a cluster; the cores and memory
+          requested for each run are taken from the 'cores_per_run' and 'memory_per_run_gb' columns of the
+          simulation details file, where present, or from the run control file
+
+If 'cleanup_work_dir' is set in the run control file, the old working directory is completely removed each time
+the script is run, ensuring that whatever we are looking at includes only files generated from the latest swb2 model
+run. Otherwise a run manifest kept in the working directory is used to relaunch only those simulations whose inputs
+have changed, or that failed or never finished.
+
+Before anything is launched, the inputs named in each control file are checked (existence, and grid dimensions
+against the GRID line) and the disk space and memory needed by the runs are estimated; the script stops if an input
+is missing or mismatched or the output will not fit on disk, and runs fewer simulations at once if they will not fit
+in memory. See 'preflight_functions.py'.
+
+If a [staging] section with a 'staging_dir' is given in the run control file, the input files of each simulation
+are copied to that (node-local) directory as the simulation starts, and its control file is rewritten to read the
+copies; each distinct file is copied only once. See 'staging_functions.py'.
+
+Given an output control file ('--output_control_file'), the script also does outputrunner's work as it goes: as
+soon as a simulation finishes successfully, its output files for the configured 'grid_vars' are handed to the
+summary executor, while the other simulations are still running. Only the simulations run this time are
+summarized. The summary workers (the [execution] section of the output control file) share the machine with the
+swb2 processes, so 'max_concurrent_runs' and 'n_workers' may need to be lowered accordingly.
 """
 # this is taken from: 
 # https://stackoverflow.com/questions/431684/equivalent-of-shell-cd-command-to-change-the-working-directory/13197763#13197763
@@ -117,6 +147,23 @@ if __name__ == '__main__':
   parser.add_argument('--dry_run',
                       help='create output files and structure, but do *not* run simulations',
                       action='store_true')
+  parser.add_argument('--max_concurrent_runs',
+                      help='maximum number of swb2 processes to run at once (default: from run control file, or estimated from cores and memory)',
+                      type=int)
+  parser.add_argument('--backend',
+                      help="where to run the simulations: 'local' or 'slurm' (default: from run control file, or 'local')",
+                      choices=['local', 'slurm'])
+  parser.add_argument('--skip_preflight',
+                      help='launch the simulations without first checking their inputs and estimating their needs',
+                      action='store_true')
+  parser.add_argument('--output_control_file',
+                      help='summarize the output of each simulation as soon as it finishes, as outputrunner does, using this output control file')
+  parser.add_argument('--make_tifs',
+                      help="with '--output_control_file', also create a cloud-optimized tif file for each summary grid",
+                      action='store_true')
+  parser.add_argument('--force_rerun',
+                      help='run every simulation, even those the run manifest shows to be up to date',
+                      action='store_true')
 
   # expected dir structure should resemble this (Hovenweep example):
 # ├───git
@@ -150,6 +197,7 @@ if __name__ == '__main__':
   run_control_filename = args.run_control_file
   simulation_details_filename = args.simulation_details_file
   dry_run = args.dry_run
+  force_rerun = args.force_rerun
   control_dict = read_toml_file(filename=run_control_filename)
   simulations_df = pd.read_csv(simulation_details_filename, delimiter="\t",)
 
@@ -186,6 +234,8 @@ if __name__ == '__main__':
   gridded_data_dir = base_dir / control_dict['data_directories']['swb_gridded_data_dir']
   templates_dir = base_dir / control_dict['data_directories']['swb_templates_dir']
   cleanup_work_dir = control_dict['auto_cleanup']['cleanup_work_dir']
+  execution_dict = control_dict.get('model_execution', {})
+  backend = args.backend if args.backend is not None else execution_dict.get('backend', 'local')
 
   lu_lookup_table_name = control_dict['input_tables']['lu_lookup_table_name']
   irr_lookup_table_name = control_dict['input_tables']['irr_lookup_table_name']
@@ -208,72 +258,262 @@ if __name__ == '__main__':
     logger.info(f"destroyed directory: {work_dir}")
     destroy_model_work_dir(work_dir)
 
-process_dict = {}
-
-# iterate over the entries in the run table; fire off a separate instance of swb2 for each
-
-simulations_df['simulation_name']=''
-
-for index, row in simulations_df.iterrows():
-
-  simulations_df.loc[index, 'simulation_name'] = f"{row.scenario_name}__{row.weather_data_basename}__{row.start_year}-{row.end_year}"
-  create_model_work_dir(work_dir=work_dir,
-                        sub_dir=simulations_df.loc[index, 'simulation_name'],
-                        logfile_dir='logfile',
-                        output_dir='output')  
-
-  logger.info(f"creating dir and files for {simulations_df.loc[index, 'simulation_name']}")
-
-  # read in the contents of the appropriate SWB2 control file TEMPLATE
-  swb_control_file_template_text = read_template_file(templates_dir / Path(row.template_file))
-
-  start_date_txt = f"{row.start_month:02}/{row.start_day:02}/{row.start_year}"
-  end_date_txt = f"{row.end_month:02}/{row.end_day:02}/{row.end_year}"
-
-  swb_control_file_text = create_control_file_text(
-                             template_file_text = swb_control_file_template_text,
-                             precip_file = Path(weather_data_dir) / row.weather_data_dir / row.precip_file,
-                             tmin_file = Path(weather_data_dir) / row.weather_data_dir / row.tmin_file,
-                             tmax_file = Path(weather_data_dir) / row.weather_data_dir / row.tmax_file,
-                             lu_lookup_table_name = lu_lookup_table_path,
-                             irr_lookup_table_name = irr_lookup_table_path,
-                             available_water_capacity_grid = gridded_data_dir / Path(row.available_water_capacity_grid),
-                             landuse_grid = gridded_data_dir / Path(row.landuse_grid),
-                             hydrologic_soil_group_grid = gridded_data_dir / Path(row.hydrologic_soil_group_grid),
-                             irrigation_mask_grid = gridded_data_dir / Path(row.irrigation_mask_grid),
-                             start_date=start_date_txt,
-                             end_date=end_date_txt,
-                           )
-
-  swb_run_dir = str(Path(work_dir) / simulations_df.loc[index, 'simulation_name'])
-  control_file_name = f"{simulations_df.loc[index, 'simulation_name']}__control_file.ctl" 
-  control_file_path = Path(swb_run_dir) / control_file_name
-
-  write_control_file(swb_control_file_text, 
-                     control_file_path,
-                    )
-  
-  output_prefix = f"--output_prefix={simulations_df.loc[index, 'simulation_name']}__"
-  #swb_binary =  row.swb_executable
-  swb_binary = 'swb2'
-  swb_arg_text = [swb_binary, "--output_dir=output", output_prefix, "--logfile_dir=logfile",
-                  output_prefix, control_file_name]
-
-#  if not dry_run:
-  with cd(swb_run_dir):
-    p = subprocess.Popen(swb_arg_text, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    logger.info(f"running swb for {simulations_df.loc[index, 'simulation_name']}")
-    logger.info(f"   location of swb run: {swb_run_dir}")
-    logger.info(f"   swb command line: '{swb_arg_text}'")
-    process_dict[index] = p
-    time.sleep(3)
-
-logger.info(f"waiting for simulations to finish...")
-exit_codes = [p.wait() for p in process_dict.values()]
-
-logger.info(f"swb finished? exit codes: {exit_codes}")
-
-logger.info("End of Python script.")
-
-
-
+  # the run manifest records what was run previously; only simulations whose inputs have changed,
+  # or that failed or never finished, are launched again
+  work_dir.mkdir(parents=True, exist_ok=True)
+  manifest_path = work_dir / mf.MANIFEST_FILENAME
+  manifest = mf.read_manifest(manifest_path)
+
+  # the output catalog lists the netCDF files written by each simulation, for use by outputrunner
+  catalog = cat.open_catalog(work_dir / cat.CATALOG_FILENAME)
+
+  simulations = []
+  # os.stat results of the input files, shared by every simulation that uses them
+  input_stats = {}
+
+  # iterate over the entries in the run table; create a work dir and control file for each simulation
+
+  simulations_df['simulation_name']=''
+
+  for index, row in simulations_df.iterrows():
+
+    simulations_df.loc[index, 'simulation_name'] = f"{row.scenario_name}__{row.weather_data_basename}__{row.start_year}-{row.end_year}"
+    create_model_work_dir(work_dir=work_dir,
+                          sub_dir=simulations_df.loc[index, 'simulation_name'],
+                          logfile_dir='logfile',
+                          output_dir='output')  
+
+    logger.info(f"creating dir and files for {simulations_df.loc[index, 'simulation_name']}")
+
+    # read in the contents of the appropriate SWB2 control file TEMPLATE
+    swb_control_file_template_text = read_template_file(templates_dir / Path(row.template_file))
+
+    start_date_txt = f"{row.start_month:02}/{row.start_day:02}/{row.start_year}"
+    end_date_txt = f"{row.end_month:02}/{row.end_day:02}/{row.end_year}"
+
+    input_paths = {'precip_file': Path(weather_data_dir) / row.weather_data_dir / row.precip_file,
+                   'tmin_file': Path(weather_data_dir) / row.weather_data_dir / row.tmin_file,
+                   'tmax_file': Path(weather_data_dir) / row.weather_data_dir / row.tmax_file,
+                   'lu_lookup_table_name': lu_lookup_table_path,
+                   'irr_lookup_table_name': irr_lookup_table_path,
+                   'available_water_capacity_grid': gridded_data_dir / Path(row.available_water_capacity_grid),
+                   'landuse_grid': gridded_data_dir / Path(row.landuse_grid),
+                   'hydrologic_soil_group_grid': gridded_data_dir / Path(row.hydrologic_soil_group_grid),
+                   'irrigation_mask_grid': gridded_data_dir / Path(row.irrigation_mask_grid),
+                  }
+
+    swb_control_file_text = create_control_file_text(
+                               template_file_text = swb_control_file_template_text,
+                               start_date=start_date_txt,
+                               end_date=end_date_txt,
+                               **input_paths,
+                             )
+
+    swb_run_dir = str(Path(work_dir) / simulations_df.loc[index, 'simulation_name'])
+    control_file_name = f"{simulations_df.loc[index, 'simulation_name']}__control_file.ctl" 
+    control_file_path = Path(swb_run_dir) / control_file_name
+
+    write_control_file(swb_control_file_text, 
+                       control_file_path,
+                      )
+    
+    output_prefix = f"--output_prefix={simulations_df.loc[index, 'simulation_name']}__"
+    #swb_binary =  row.swb_executable
+    swb_binary = 'swb2'
+    swb_arg_text = [swb_binary, "--output_dir=output", output_prefix, "--logfile_dir=logfile",
+                    output_prefix, control_file_name]
+
+    simulation = {'simulation_name': simulations_df.loc[index, 'simulation_name'],
+                  'swb_run_dir': swb_run_dir,
+                  'swb_arg_text': swb_arg_text,
+                  'control_file_hash': mf.hash_text(swb_control_file_text),
+                  'control_file_path': control_file_path,
+                  'control_file_text': swb_control_file_text,
+                  'input_paths': [str(path) for path in input_paths.values()],
+                  'input_files': mf.describe_input_files(input_paths.values(), stat_cache=input_stats)}
+
+    # cores and memory requested for this run by a batch backend, if given in the simulation details file
+    for resource in ['cores_per_run', 'memory_per_run_gb']:
+      if resource in row and pd.notna(row[resource]):
+        simulation[resource] = row[resource]
+
+    # the simulation period, read back from the control file, is used to report the progress of the run
+    simulation_period = pf.read_simulation_period(swb_control_file_text)
+    if simulation_period is not None:
+      simulation['start_date'], simulation['end_date'] = simulation_period
+
+    needs_run, reason = mf.simulation_needs_run(manifest=manifest,
+                                                simulation_name=simulation['simulation_name'],
+                                                control_file_hash=simulation['control_file_hash'],
+                                                input_files=simulation['input_files'],
+                                                output_dir=Path(swb_run_dir) / 'output')
+    if needs_run or force_rerun:
+      logger.info(f"   simulation will be run: {'rerun forced' if force_rerun else reason}")
+      simulations.append(simulation)
+    else:
+      logger.info(f"   skipping simulation; {reason} according to run manifest")
+
+  # work out how many swb2 processes may run at once; a value of zero (or none at all) in the
+  # run control file means 'estimate from the number of cores and the memory available' when running
+  # locally, and 'no limit beyond what SLURM allows' when running as a job array
+  if args.max_concurrent_runs is not None:
+    max_concurrent_runs = args.max_concurrent_runs
+  else:
+    max_concurrent_runs = execution_dict.get('max_concurrent_runs', 0)
+  if max_concurrent_runs <= 0 and backend == 'local':
+    max_concurrent_runs = scheduler.estimate_max_concurrent_runs(
+                            memory_per_run_gb=execution_dict.get('memory_per_run_gb', 4.0),
+                            cores_per_run=execution_dict.get('cores_per_run', 1))
+
+  # check the inputs and estimated needs of the simulations before launching any of them
+  if not args.skip_preflight and simulations:
+    preflight_results = preflight.check_simulations(simulations,
+                                                    stat_cache=input_stats,
+                                                    options=control_dict.get('preflight', {}))
+    max_concurrent_runs = preflight.check_budget(
+                            preflight_results,
+                            work_dir=work_dir,
+                            max_concurrent_runs=max_concurrent_runs,
+                            total_memory_gb=scheduler.get_total_memory_gb() if backend == 'local' else None,
+                            memory_per_run_gb=execution_dict.get('memory_per_run_gb', 4.0) if backend == 'slurm' else None,
+                            options=control_dict.get('preflight', {}))
+    preflight_report = preflight.format_report(preflight_results)
+    logger.info(preflight_report)
+    print(preflight_report)
+    if preflight_results['errors'] and not dry_run:
+      logger.error("pre-flight check failed; no simulations launched")
+      catalog.close()
+      sys.exit(1)
+
+  # resource use of each simulation is appended to a JSON lines file as it finishes
+  metrics_jsonl_path = Path(logfiles_dir) / f"swb_run_metrics__{timestamp}.jsonl"
+  metrics_csv_path = Path(logfiles_dir) / f"swb_run_metrics__{timestamp}.csv"
+
+  # input files may be copied to node-local scratch space as each simulation starts; staging is done
+  # by the machine that runs swb2, so it applies to the local backend only
+  staging_dict = control_dict.get('staging', {})
+  staging_cache = None
+  if staging_dict.get('staging_dir'):
+    if backend == 'local':
+      staging_cache = staging.create_cache(staging_dict['staging_dir'], max_size_gb=staging_dict.get('max_size_gb'))
+      logger.info(f"staging input files in {staging_cache['staging_dir']}")
+    else:
+      logger.warning(f"input file staging is not available with the '{backend}' backend; reading inputs in place")
+
+  def stage_simulation_inputs(simulation):
+    simulation['staged_paths'] = staging.acquire(staging_cache, simulation['input_paths'])
+    write_control_file(staging.rewrite_control_file_paths(simulation['control_file_text'], simulation['staged_paths']),
+                       simulation['control_file_path'])
+
+  # in pipeline mode, the output of each simulation is summarized as soon as it finishes; the executor
+  # runs the summaries in other processes, so that the swb2 runs being followed here are not held up
+  summary_settings = None
+  summary_futures = {}
+  summary_csv_started = set()
+  if args.output_control_file and not dry_run and simulations:
+    # imported only here, so that runs without summaries do not load xarray's summary stack or Dask
+    import summary_task_functions as st
+    import executor_functions as xf
+    summary_settings = st.read_summary_settings(control_dict,
+                                                read_toml_file(filename=args.output_control_file),
+                                                base_dir,
+                                                make_tifs=args.make_tifs)
+    summary_execution = dict(summary_settings['execution'])
+    if summary_execution.get('backend', 'dask') in ('serial', 'auto'):
+      logger.info(f"summary backend '{summary_execution['backend']}' would run summaries in this process; using 'process' instead")
+      summary_execution['backend'] = 'process'
+    summary_executor = xf.create_executor(summary_execution)
+
+  def summarize_simulation(simulation):
+    output_files = cat.select_output_files(catalog,
+                                           scenario_names=summary_settings['scenario_names'],
+                                           weather_data_names=summary_settings['weather_data_names'],
+                                           swb_variable_names=summary_settings['grid_vars'],
+                                           simulation_names=[simulation['simulation_name']])
+    tasks = [st.make_summary_task(output_file, summary_settings) for output_file in output_files]
+    tasks = [task for task in tasks if task is not None]
+    for task_kwargs, details in tasks:
+      st.submit_summary_task(summary_executor, summary_futures, task_kwargs, details)
+    logger.info(f"submitted {len(tasks)} summary tasks for {simulation['simulation_name']}")
+    # store the results of any summaries finished meanwhile, without waiting for the rest
+    st.collect_results(summary_futures, summary_settings, summary_csv_started, wait=False, raise_errors=False)
+
+  def record_finished_simulation(simulation, exit_code, simulation_metrics):
+    if 'staged_paths' in simulation:
+      staging.release(staging_cache, simulation['staged_paths'])
+    metrics.append_metrics(simulation_metrics, metrics_jsonl_path)
+    output_files = mf.list_output_files(Path(simulation['swb_run_dir']) / 'output')
+    mf.record_simulation(manifest,
+                         simulation_name=simulation['simulation_name'],
+                         control_file_hash=simulation['control_file_hash'],
+                         input_files=simulation['input_files'],
+                         exit_code=exit_code,
+                         output_files=output_files)
+    mf.write_manifest(manifest, manifest_path)
+    if exit_code == 0:
+      n_files = cat.catalog_output_files(catalog,
+                                         output_dir=Path(simulation['swb_run_dir']) / 'output',
+                                         simulation_name=simulation['simulation_name'])
+      logger.info(f"cataloged {n_files} output files for {simulation['simulation_name']}")
+      if summary_settings is not None:
+        summarize_simulation(simulation)
+    else:
+      cat.remove_simulation(catalog, simulation['simulation_name'])
+
+  if dry_run:
+    logger.info(f"dry run requested; {len(simulations)} simulations prepared but not run.")
+  else:
+    # mark every simulation about to be launched as unfinished, so that an interrupted run is
+    # picked up again the next time this script is run
+    for simulation in simulations:
+      mf.record_simulation(manifest,
+                           simulation_name=simulation['simulation_name'],
+                           control_file_hash=simulation['control_file_hash'],
+                           input_files=simulation['input_files'])
+    mf.write_manifest(manifest, manifest_path)
+
+    progress_options = {'report_interval': execution_dict.get('progress_report_interval', 60.0),
+                        'stall_timeout': execution_dict.get('stall_timeout', 1800.0),
+                        'date_pattern': execution_dict.get('progress_date_pattern', pf.DATE_PATTERN)}
+    try:
+      match backend:
+        case 'local':
+          logger.info(f"running {len(simulations)} simulations, at most {max_concurrent_runs} at a time...")
+          exit_codes = scheduler.run_simulations(simulations,
+                                                 max_concurrent_runs=max_concurrent_runs,
+                                                 on_complete=record_finished_simulation,
+                                                 sample_interval=execution_dict.get('metrics_sample_interval', 1.0),
+                                                 progress_options=progress_options,
+                                                 on_start=stage_simulation_inputs if staging_cache is not None else None)
+        case 'slurm':
+          logger.info(f"submitting {len(simulations)} simulations as a SLURM job array...")
+          exit_codes = slurm.run_simulations(simulations,
+                                             script_dir=work_dir / 'slurm',
+                                             slurm_options=execution_dict.get('slurm', {}),
+                                             max_concurrent_runs=max_concurrent_runs,
+                                             on_complete=record_finished_simulation,
+                                             cores_per_run=execution_dict.get('cores_per_run', 1),
+                                             memory_per_run_gb=execution_dict.get('memory_per_run_gb', 4.0),
+                                             progress_options=progress_options)
+        case _:
+          raise ValueError(f"unknown model execution backend '{backend}'; expected 'local' or 'slurm'")
+      logger.info(f"swb finished? exit codes: {exit_codes}")
+
+      if summary_settings is not None:
+        logger.info(f"waiting for {len(summary_futures)} remaining summary tasks...")
+        st.collect_results(summary_futures, summary_settings, summary_csv_started, raise_errors=False)
+        logger.info("  => completed creating summary grids and zonal stats.")
+    finally:
+      # the summary executor (and any Dask cluster) is shut down even if a run or summary fails
+      if summary_settings is not None:
+        xf.shutdown_executor(summary_executor)
+
+    if metrics_jsonl_path.exists():
+      metrics_df = metrics.read_metrics(metrics_jsonl_path)
+      metrics.write_metrics_csv(metrics_df, metrics_csv_path)
+      summary_text = metrics.summarize_metrics(metrics_df).to_string(index=False, float_format=lambda x: f"{x:.3f}")
+      logger.info(f"resource use of each simulation (also written to {metrics_csv_path}):\n{summary_text}")
+      print(summary_text)
+
+  catalog.close()
+  logger.info("End of Python script.")
@@ -0,0 +1,145 @@
+import collections
+import logging
+import os
+import threading
+import numpy as np
+import xarray as xr
+
+"""
+Functions used for all netCDF reads and writes made by the summary tasks. The HDF5 and netCDF libraries are
+not safe to call from more than one thread at a time, so every call into them is made while holding a single
+per-process lock. Variables are returned lazily: the lock is handed to the xarray backend, which takes it for
+each slice actually read from the file and releases it in between, so a task can stream a large daily file one
+piece at a time while other threads of the same worker read theirs. The numeric reductions run without the
+lock. Open file handles are kept in a small least-recently-used cache so that repeated reads of the same file,
+and the slice-by-slice reads of one file, do not reopen it; a handle closed while a lazy dataset still refers
+to it is reopened by xarray on the next read.
+"""
+
+MAX_OPEN_FILES = 16
+
+# encoding used for a summary grid when the [netcdf_output] section of the output control file says nothing else
+ENCODING_DEFAULTS = {'compression': 'zlib',
+                     'complevel': 4,
+                     'shuffle': True,
+                     'dtype': 'float32'}
+
+logger = logging.getLogger(__name__)
+
+# one lock for every HDF5/netCDF call made in this process
+netcdf_lock = threading.RLock()
+
+_open_datasets = collections.OrderedDict()
+
+def _file_key(filename):
+    stat_result = os.stat(filename)
+    return (os.path.abspath(filename), stat_result.st_size, stat_result.st_mtime)
+
+def _open_dataset(filename):
+    # must be called while holding 'netcdf_lock'
+    key = _file_key(filename)
+    if key in _open_datasets:
+        _open_datasets.move_to_end(key)
+        return _open_datasets[key]
+
+    # a file that has been rewritten since it was opened is closed rather than reused
+    for stale_key in [k for k in _open_datasets if k[0] == key[0]]:
+        _open_datasets.pop(stale_key).close()
+
+    dataset = xr.open_dataset(filename, lock=netcdf_lock)
+    _open_datasets[key] = dataset
+    while len(_open_datasets) > MAX_OPEN_FILES:
+        _, oldest_dataset = _open_datasets.popitem(last=False)
+        oldest_dataset.close()
+    return dataset
+
+def read_variable(filename, variable_name):
+    """Return a lazily read xarray Dataset holding 'variable_name' (and its coordinates) from a netCDF file.
+    Values are read, under 'netcdf_lock', only when they are used, and only the slices that are used; call
+    'load' on the result to read the whole variable at once."""
+    with netcdf_lock:
+        return _open_dataset(filename)[[variable_name]]
+
+def write_netcdf(dataset, filename, **kwargs):
+    """Write an xarray Dataset to a netCDF file; 'kwargs' are passed on to 'to_netcdf'."""
+    with netcdf_lock:
+        # drop any cached handle to a file about to be overwritten
+        for key in [k for k in _open_datasets if k[0] == os.path.abspath(filename)]:
+            _open_datasets.pop(key).close()
+        dataset.to_netcdf(filename, **kwargs)
+
+def _chunk_sizes(dataarray, chunks):
+    # a 'time' entry applies to whichever non-spatial dimension the grid has (time, month, year, ...)
+    sizes = []
+    for dim in dataarray.dims:
+        key = dim if dim in chunks or dim in ('x', 'y') else 'time'
+        sizes.append(max(min(int(chunks.get(key, dataarray.sizes[dim])), dataarray.sizes[dim]), 1))
+    return tuple(sizes)
+
+def variable_encoding(dataarray, encoding_options=None):
+    """Translate encoding options for one variable, as given in the [netcdf_output] section of the output control
+    file, into the encoding that xarray passes on to the netCDF4 library.
+
+    Args:
+        dataarray (xarray DataArray): the variable to be written
+        encoding_options (dict): any of 'compression' ('zlib', 'zstd' or 'none'), 'complevel', 'shuffle',
+                                 'dtype' ('float32', 'float64', or an integer type such as 'int16' to store
+                                 values packed as scaled integers), 'scale_factor', 'add_offset', 'fill_value',
+                                 and 'chunks' (chunk size by dimension name; 'time' applies to any non-spatial
+                                 dimension); options not given are taken from 'ENCODING_DEFAULTS'
+
+    Returns:
+        dict: encoding for the variable
+    """
+    options = {**ENCODING_DEFAULTS, **(encoding_options or {})}
+    encoding = {}
+
+    match options['compression']:
+        case 'zlib':
+            encoding.update(zlib=True, complevel=options['complevel'])
+        case 'zstd':
+            encoding.update(compression='zstd', complevel=options['complevel'])
+        case 'none':
+            pass
+        case _:
+            raise ValueError(f"unknown netCDF compression '{options['compression']}'")
+    if options['compression'] != 'none':
+        encoding['shuffle'] = options['shuffle']
+
+    dtype = np.dtype(options['dtype'])
+    if np.issubdtype(dtype, np.integer):
+        scale_factor = options.get('scale_factor', 1.0)
+        add_offset = options.get('add_offset', 0.0)
+        fill_value = options.get('fill_value', np.iinfo(dtype).min)
+        # values that would not fit the packed integer type are kept as float32 rather than silently wrapped
+        packed_min = float(dataarray.min(skipna=True)) - add_offset
+        packed_max = float(dataarray.max(skipna=True)) - add_offset
+        if (np.isfinite(packed_min) and
+            (packed_min / scale_factor <= np.iinfo(dtype).min or packed_max / scale_factor > np.iinfo(dtype).max)):
+            logger.warning(f"values of '{dataarray.name}' are out of range for {dtype} with a scale_factor of "
+                           f"{scale_factor}; writing float32 instead")
+            dtype = np.dtype('float32')
+        else:
+            encoding.update(scale_factor=scale_factor, add_offset=add_offset)
+    if np.issubdtype(dtype, np.floating):
+        fill_value = options.get('fill_value', np.nan)
+    encoding.update(dtype=dtype, _FillValue=fill_value)
+
+    if 'chunks' in options and dataarray.ndim > 0:
+        encoding['chunksizes'] = _chunk_sizes(dataarray, options['chunks'])
+
+    return encoding
+
+def dataset_encoding(dataset, encodings=None):
+    """Return the encoding for every gridded variable of a dataset. 'encodings' holds the [netcdf_output] section
+    of the output control file: options under 'default' apply to every variable, and options under a variable's
+    own name override them."""
+    encodings = encodings or {}
+    return {name: variable_encoding(dataarray, {**encodings.get('default', {}), **encodings.get(name, {})})
+            for name, dataarray in dataset.data_vars.items() if dataarray.ndim >= 2}
+
+def close_all():
+    """Close every cached file handle."""
+    with netcdf_lock:
+        while _open_datasets:
+            _open_datasets.popitem()[1].close()
@@ -4,11 +4,13 @@ import matplotlib.font_manager as fm
 import pathlib as pl
 import datetime as dt
 import usgs_matplotlib_tweaks as usgs
+import plot_time_series_by_variable as pv
 
 def make_annual_plot_of_variables_by_zone(zonal_stats_df, 
                                           variable_dict={},
                                           weather_driver_dict={},
-                                          output_filename='plot.pdf'):
+                                          output_filename='plot.pdf',
+                                          preview=False):
     """Generate annual mean plot for each  'weather_driver' present in 'weather_driver_dict' 
        and for each 'variable_name' present in 'variable_dict'. X-axis is the zone id; Y-axis is the variable value.
 
@@ -26,9 +28,14 @@ def make_annual_plot_of_variables_by_zone(zonal_stats_df,
     Args:
         zonal_stats_df (Pandas dataframe): dataframe of zonal statistics gleaned from annual or monthly gridded data
                                            It is expected that the zonal stats correspond to a series of year values
+        preview (bool): save the figure at a low resolution for quick review
     """
     # alias for input dataframe
     df = zonal_stats_df
+
+    # split the dataframe by weather driver and variable once, rather than querying it for every combination
+    groups = dict(tuple(df.groupby(['weather_driver', 'swb_variable_name'], sort=False)))
+    empty_df = df.iloc[0:0]
     
     zones = df['zone'].unique().tolist()
         
@@ -52,7 +59,7 @@ def make_annual_plot_of_variables_by_zone(zonal_stats_df,
             linestyle=value['linestyle']
             print(f"creating plot for {variable_name}, as driven by {key}")
             
-            subset_df = df.query(f"weather_driver=='{key}' and swb_variable_name=='{variable_name}'")
+            subset_df = groups.get((key, variable_name), empty_df)
 
             ax.plot(subset_df['zone'], subset_df['mean'], color=color, 
                     linewidth=linewidth, linestyle=linestyle, label=key)
@@ -71,4 +78,7 @@ def make_annual_plot_of_variables_by_zone(zonal_stats_df,
     plt.tight_layout()
     fig.patch.set_alpha(1.0)    
     pl.Path(output_filename).resolve()            
-    fig.savefig(output_filename, dpi = (250), bbox_inches='tight') 
\ No newline at end of file
+    dpi = pv.PREVIEW_DPI if preview else 250
+    fig.savefig(output_filename, dpi = (dpi), bbox_inches='tight')
+    plt.close(fig)
+ 
\ No newline at end of file
@@ -31,6 +31,10 @@ def make_time_series_plot_by_variable(zonal_stats_df,
     """
     # alias for input dataframe
     df = zonal_stats_df
+
+    # split the dataframe by weather driver and variable once, rather than querying it for every combination
+    groups = dict(tuple(df.groupby(['weather_driver', 'swb_variable_name'], sort=False)))
+    empty_df = df.iloc[0:0]
     
     n_variables = len(variable_dict)
 
@@ -57,7 +61,7 @@ def make_time_series_plot_by_variable(zonal_stats_df,
             linewidth=value['linewidth']
             linestyle=value['linestyle']
             print(f"creating plot for {variable_name}, as driven by {key}")
-            subset_df = df.query(f"weather_driver=='{key}' and swb_variable_name=='{variable_name}'")
+            subset_df = groups.get((key, variable_name), empty_df)
             ax.plot(subset_df[time_variable], subset_df['mean'], color=color, 
                     linewidth=linewidth, linestyle=linestyle, label=key)
         ax.set_ylabel(ylabel_text, fontsize = 14)
@@ -80,4 +84,99 @@ def make_time_series_plot_by_variable(zonal_stats_df,
     plt.tight_layout()
     fig.patch.set_alpha(1.0)    
     pl.Path(output_filename).resolve()            
-    fig.savefig(output_filename, dpi = (250), bbox_inches='tight') 
\ No newline at end of file
+    fig.savefig(output_filename, dpi = (250), bbox_inches='tight')
+    plt.close(fig)
+ 
+PREVIEW_DPI = 72
+
+def create_time_series_figure_template(variable_dict={},
+                                       weather_driver_dict={},
+                                       time_variable='year'):
+    """Lay out a time series figure once, so that it can be reused for many zones. The figure, axes,
+       styling and legends match those of 'make_time_series_plot_by_variable'; every line starts out empty.
+
+    Args:
+        variable_dict (dict): variables to plot, one subplot per variable
+        weather_driver_dict (dict): weather drivers to plot, one line per driver on each subplot
+        time_variable (str): name of the column holding x-axis values; 'year' or 'month'
+
+    Returns:
+        dict: 'figure', the 'lines' of the figure keyed by (weather_driver, variable_name), the 'time_variable',
+              and the figure's 'title' text artist
+    """
+    n_variables = len(variable_dict)
+
+    month_abbreviations = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
+
+    fig = plt.figure(figsize=(10, n_variables*3))
+    usgs.set_matplotlib_params_for_usgs_style()
+
+    lines = {}
+    plotnum = 0
+    for (variable_name, variable_details) in variable_dict.items():
+        variable_description = variable_details['description']
+        variable_units = variable_details['units']
+
+        if time_variable=='month':
+            ylabel_text = f"Monthly mean, {variable_units}"
+        else:
+            ylabel_text = f"Annual mean, {variable_units}"
+
+        plotnum += 1
+        ax = fig.add_subplot(n_variables,1,plotnum)
+        for key, value in weather_driver_dict.items():
+            (lines[(key, variable_name)],) = ax.plot([], [], color=value['color'], linewidth=value['linewidth'],
+                                                     linestyle=value['linestyle'], label=key)
+        ax.set_ylabel(ylabel_text, fontsize = 14)
+
+        if time_variable=='month':
+            ax.set(xticks=[1,2,3,4,5,6,7,8,9,10,11,12])
+            ax.set(xticklabels = month_abbreviations)
+
+        box = ax.get_position()
+        ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
+
+        ax.legend(loc='center left', bbox_to_anchor=(1, 0.5), fontsize='small')
+        ax.set_title(f"{variable_description}", fontsize=12)
+
+    plt.tight_layout()
+    fig.patch.set_alpha(1.0)
+    # the title sits just above the top of the figure; 'bbox_inches' of 'tight' keeps it in the saved file
+    title = fig.suptitle('', y=1.0, va='bottom', fontsize=14)
+
+    return {'figure': fig, 'lines': lines, 'time_variable': time_variable, 'title': title}
+
+def update_time_series_figure_template(template, zonal_stats_df, title=''):
+    """Replace the line data (and title) of a figure template with the values held in 'zonal_stats_df'.
+       Weather driver/variable combinations missing from the dataframe are drawn as empty lines.
+
+    Args:
+        template (dict): figure template created by 'create_time_series_figure_template'
+        zonal_stats_df (Pandas dataframe): zonal statistics for a single zone; see 'make_time_series_plot_by_variable'
+        title (str): title placed above the figure (ex. the zone id)
+    """
+    time_variable = template['time_variable']
+    groups = dict(tuple(zonal_stats_df.groupby(['weather_driver', 'swb_variable_name'], sort=False)))
+
+    for (key, variable_name), line in template['lines'].items():
+        subset_df = groups.get((key, variable_name))
+        if subset_df is None:
+            line.set_data([], [])
+        else:
+            line.set_data(subset_df[time_variable].to_numpy(), subset_df['mean'].to_numpy())
+
+    for ax in template['figure'].axes:
+        ax.relim()
+        ax.autoscale_view()
+
+    template['title'].set_text(title)
+
+def save_figure_template(template, output_filename, preview=False):
+    """Save a figure template. With 'preview', the figure is saved at a low resolution for quick review;
+       the file format follows the extension of 'output_filename' (ex. '.png')."""
+    dpi = PREVIEW_DPI if preview else 250
+    template['figure'].savefig(output_filename, dpi = (dpi), bbox_inches='tight')
+
+def close_figure_template(template):
+    """Release the figure held by a figure template."""
+    plt.close(template['figure'])
@@ -1,6 +1,8 @@
 import site
 site.addsitedir('.')  # Always appends to end
 import argparse
+import matplotlib
+matplotlib.use('Agg')  # plots are only ever written to file, possibly from several processes at once
 import matplotlib.pyplot as plt
 import plot_time_series_by_variable as pv
 import plot_annual_mean_variables_by_zone as pz
@@ -11,119 +13,179 @@ import logging
 import pathlib as pl
 import datetime as dt
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from collections import defaultdict
 
 from utility_functions import read_toml_file
-
-parser = argparse.ArgumentParser(description='Munge through zonal stats output and create plots')
-parser.add_argument("run_control_file",
-                    help='run control file, in TOML format')
-parser.add_argument("output_control_file",
-                    help="output control file, in TOML format")
-
-try:
-    args = parser.parse_args()
-except:
-    parser.print_help()
-    sys.exit(0)
-
-run_control_filename = args.run_control_file
-output_control_filename = args.output_control_file
-
-run_control_dict = read_toml_file(filename=run_control_filename)
-output_control_dict = read_toml_file(filename=output_control_filename)
-
-weather_driver_dict = output_control_dict['variables']['weather_driver_dict']
-variable_dict = output_control_dict['variables']['variable_dict']
-
-# simulations_df = pd.read_csv(simulation_details_filename, delimiter="\t",)
-
-# simulations_df.start_date=pd.to_datetime(simulations_df.start_date)
-# simulations_df.end_date=pd.to_datetime(simulations_df.end_date)
-# simulations_df['start_year'] = simulations_df.start_date.dt.year
-# simulations_df['end_year'] = simulations_df.end_date.dt.year
-# simulations_df['start_day'] = simulations_df.start_date.dt.day
-# simulations_df['end_day'] = simulations_df.end_date.dt.day
-# simulations_df['start_month'] = simulations_df.start_date.dt.month
-# simulations_df['end_month'] = simulations_df.end_date.dt.month
-
-# pull specific SWB2 run data from the TOML file
-top_level_dir = Path(run_control_dict['working_directories']['top_level_dir'])
-base_dir = Path.cwd().parent   # path to git repo that contains this script
-gcm_runs_dir = top_level_dir / run_control_dict['working_directories']['gcm_runs_dir']
-logfiles_dir = top_level_dir / run_control_dict['working_directories']['logfiles_dir']
-data_summary_dir = top_level_dir / run_control_dict['working_directories']['data_summary_dir']
-work_dir = top_level_dir / run_control_dict['working_directories']['swb_work_dir']
-
-# obtain list of models, scenarios, periods, for which we expect to see results
-weather_data_names = output_control_dict['scenarios_and_periods']['weather_data_names']
-scenario_names = output_control_dict['scenarios_and_periods']['scenario_names']
-time_periods = output_control_dict['scenarios_and_periods']['time_periods']
-
-# obtain list of varibles for which we want to extract summaries
-grid_vars = output_control_dict['variables']['grid_vars']
-data_summary_dir = top_level_dir / run_control_dict['working_directories']['data_summary_dir']
-
-logger = logging.getLogger(__name__)
-timestamp = dt.datetime.now().strftime("%Y-%m-%d_%H%M%S")
-logging.basicConfig(filename=Path(logfiles_dir)/f"outputrunner__{timestamp}.log", level=logging.INFO, filemode='w')
-logger.info('Begin executing Python script')
-
-logger.info('created simulations dataframe')
-
-weather_data_dir = run_control_dict['data_directories']['weather_data_dir']
-tabular_data_dir = base_dir / run_control_dict['data_directories']['swb_tabular_data_dir']
-gridded_data_dir = base_dir / run_control_dict['data_directories']['swb_gridded_data_dir']
-
-#lu_lookup_table_name = run_control_dict['input_tables']['lu_lookup_table_name']
-#irr_lookup_table_name = run_control_dict['input_tables']['irr_lookup_table_name']
-
-plot_dir = top_level_dir / run_control_dict['working_directories']['plot_dir']
-logger.info(f"creating directory to hold plots at {plot_dir}.")
-plot_dir.mkdir(parents=True, exist_ok=True)
-
-annual_sum_types = output_control_dict['output_data_types']['annual_sum_types']
-mean_monthly_types = output_control_dict['output_data_types']['mean_monthly_types']
-mean_annual_types = output_control_dict['output_data_types']['mean_annual_types']
-
-mean_annual_sum_zonal_stats_path = data_summary_dir / 'mean_annual_sum_zonal_stats.csv'
-mean_annual_sum_zonal_stats_df = pd.read_csv(mean_annual_sum_zonal_stats_path, header=0, sep=',',
-                                            dtype=annual_sum_types )
-mean_annual_sum_zonal_stats_df.reset_index(drop=True, inplace=True)
-
-mean_monthly_sum_zonal_stats_path = data_summary_dir / 'mean_monthly_sum_zonal_stats.csv'
-mean_monthly_sum_zonal_stats_df = pd.read_csv(mean_monthly_sum_zonal_stats_path, header=0, sep=',',
-                                              dtype=mean_monthly_types)
-mean_monthly_sum_zonal_stats_df.reset_index(drop=True, inplace=True)
-
-annual_sum_zonal_stats_path = data_summary_dir / 'annual_sum_zonal_stats.csv'
-annual_sum_zonal_stats_df = pd.read_csv(annual_sum_zonal_stats_path, header=0, sep=',',
-                                             dtype=mean_annual_types )
-annual_sum_zonal_stats_df.reset_index(drop=True, inplace=True)
-
-zones = annual_sum_zonal_stats_df['zone'].unique()
-
-for zone in zones:
-  logging.info(f"==> creating plots for zone: {zone}")
-  zone_df  = annual_sum_zonal_stats_df.query(f"zone=='{zone}'")
-  zone_monthly_df = mean_monthly_sum_zonal_stats_df.query(f"zone=='{zone}'")
-  zone_mean_annual_df = mean_annual_sum_zonal_stats_df.query(f"zone=='{zone}'")
-
-  annual_sum_plot_filename = plot_dir / f"annual_sum_plot_{zone}.pdf"
-  pv.make_time_series_plot_by_variable(zonal_stats_df=zone_df,
-                                       variable_dict=variable_dict,
-                                       weather_driver_dict=weather_driver_dict,
-                                       output_filename=annual_sum_plot_filename)
-
-  mean_monthly_plot_filename = plot_dir / f"mean_monthly_plot_{zone}.pdf"
-  pv.make_time_series_plot_by_variable(zonal_stats_df=zone_monthly_df,
-                                       variable_dict=variable_dict,
-                                       weather_driver_dict=weather_driver_dict,
-                                       output_filename=mean_monthly_plot_filename,
-                                       time_variable='month')
-  
-pz.make_annual_plot_of_variables_by_zone(zonal_stats_df=mean_annual_sum_zonal_stats_df, 
-                                         variable_dict=variable_dict,
-                                         weather_driver_dict=weather_driver_dict,
-                                         output_filename='mean_annual_variables_by_zone.pdf')
+import zonal_stats_store_functions as zs
+
+def read_zonal_stats(summary_basetype, dtypes, zonal_stats_formats, zonal_stats_store_dir, data_summary_dir):
+  """Read zonal stats for both the summed and averaged variables of a summary type, from the Parquet
+  store if one is being written, otherwise from the csv file written by outputrunner."""
+  if 'parquet' in zonal_stats_formats:
+    zonal_stats_df = pd.concat([zs.read_zonal_stats(zonal_stats_store_dir, f"{summary_basetype}_{operation}")
+                                for operation in ['sum', 'mean']])
+    # numeric columns are already typed in the store; only the string columns need converting
+    zonal_stats_df = zonal_stats_df.astype({key: value for key, value in dtypes.items()
+                                            if key in zonal_stats_df.columns and value == 'str'})
+  else:
+    zonal_stats_path = data_summary_dir / f"{summary_basetype}_sum_zonal_stats.csv"
+    zonal_stats_df = pd.read_csv(zonal_stats_path, header=0, sep=',', dtype=dtypes)
+  zonal_stats_df.reset_index(drop=True, inplace=True)
+  return zonal_stats_df
+
+def render_zone_plots(zone_data, variable_dict, weather_driver_dict, plot_dir, preview=False):
+  """Write the annual sum and mean monthly plots for a list of zones. Runs in a worker process.
+
+  The figures are laid out once for the whole list; for each zone only the line data and title are replaced
+  before saving.
+
+  Args:
+      zone_data (list): (zone, annual sum zonal stats, mean monthly zonal stats) for each zone
+      variable_dict (dict): variables to plot
+      weather_driver_dict (dict): weather drivers to plot
+      plot_dir (Path): directory the plots are written to
+      preview (bool): write low-resolution png files rather than pdf files
+
+  Returns:
+      list: the zones plotted
+  """
+  suffix = 'png' if preview else 'pdf'
+  annual_sum_template = pv.create_time_series_figure_template(variable_dict=variable_dict,
+                                                              weather_driver_dict=weather_driver_dict)
+  mean_monthly_template = pv.create_time_series_figure_template(variable_dict=variable_dict,
+                                                                weather_driver_dict=weather_driver_dict,
+                                                                time_variable='month')
+
+  for zone, zone_df, zone_monthly_df in zone_data:
+    pv.update_time_series_figure_template(annual_sum_template, zone_df, title=f"Zone {zone}")
+    pv.save_figure_template(annual_sum_template, plot_dir / f"annual_sum_plot_{zone}.{suffix}", preview=preview)
+
+    pv.update_time_series_figure_template(mean_monthly_template, zone_monthly_df, title=f"Zone {zone}")
+    pv.save_figure_template(mean_monthly_template, plot_dir / f"mean_monthly_plot_{zone}.{suffix}", preview=preview)
+
+  pv.close_figure_template(annual_sum_template)
+  pv.close_figure_template(mean_monthly_template)
+  return [zone for zone, _, _ in zone_data]
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description='Munge through zonal stats output and create plots')
+  parser.add_argument("run_control_file",
+                      help='run control file, in TOML format')
+  parser.add_argument("output_control_file",
+                      help="output control file, in TOML format")
+  parser.add_argument("--n_processes",
+                      help="number of processes used to render plots (default: one per core)",
+                      type=int,
+                      default=0)
+  parser.add_argument("--preview",
+                      help="write quick, low-resolution png plots instead of pdf files",
+                      action='store_true')
+
+  try:
+      args = parser.parse_args()
+  except:
+      parser.print_help()
+      sys.exit(0)
+
+  run_control_filename = args.run_control_file
+  output_control_filename = args.output_control_file
+
+  run_control_dict = read_toml_file(filename=run_control_filename)
+  output_control_dict = read_toml_file(filename=output_control_filename)
+
+  weather_driver_dict = output_control_dict['variables']['weather_driver_dict']
+  variable_dict = output_control_dict['variables']['variable_dict']
+
+  # simulations_df = pd.read_csv(simulation_details_filename, delimiter="\t",)
+
+  # simulations_df.start_date=pd.to_datetime(simulations_df.start_date)
+  # simulations_df.end_date=pd.to_datetime(simulations_df.end_date)
+  # simulations_df['start_year'] = simulations_df.start_date.dt.year
+  # simulations_df['end_year'] = simulations_df.end_date.dt.year
+  # simulations_df['start_day'] = simulations_df.start_date.dt.day
+  # simulations_df['end_day'] = simulations_df.end_date.dt.day
+  # simulations_df['start_month'] = simulations_df.start_date.dt.month
+  # simulations_df['end_month'] = simulations_df.end_date.dt.month
+
+  # pull specific SWB2 run data from the TOML file
+  top_level_dir = Path(run_control_dict['working_directories']['top_level_dir'])
+  base_dir = Path.cwd().parent   # path to git repo that contains this script
+  gcm_runs_dir = top_level_dir / run_control_dict['working_directories']['gcm_runs_dir']
+  logfiles_dir = top_level_dir / run_control_dict['working_directories']['logfiles_dir']
+  data_summary_dir = top_level_dir / run_control_dict['working_directories']['data_summary_dir']
+  work_dir = top_level_dir / run_control_dict['working_directories']['swb_work_dir']
+
+  # obtain list of models, scenarios, periods, for which we expect to see results
+  weather_data_names = output_control_dict['scenarios_and_periods']['weather_data_names']
+  scenario_names = output_control_dict['scenarios_and_periods']['scenario_names']
+  time_periods = output_control_dict['scenarios_and_periods']['time_periods']
+
+  # obtain list of varibles for which we want to extract summaries
+  grid_vars = output_control_dict['variables']['grid_vars']
+  data_summary_dir = top_level_dir / run_control_dict['working_directories']['data_summary_dir']
+
+  logger = logging.getLogger(__name__)
+  timestamp = dt.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+  logging.basicConfig(filename=Path(logfiles_dir)/f"outputrunner__{timestamp}.log", level=logging.INFO, filemode='w')
+  logger.info('Begin executing Python script')
+
+  logger.info('created simulations dataframe')
+
+  weather_data_dir = run_control_dict['data_directories']['weather_data_dir']
+  tabular_data_dir = base_dir / run_control_dict['data_directories']['swb_tabular_data_dir']
+  gridded_data_dir = base_dir / run_control_dict['data_directories']['swb_gridded_data_dir']
+
+  #lu_lookup_table_name = run_control_dict['input_tables']['lu_lookup_table_name']
+  #irr_lookup_table_name = run_control_dict['input_tables']['irr_lookup_table_name']
+
+  plot_dir = top_level_dir / run_control_dict['working_directories']['plot_dir']
+  logger.info(f"creating directory to hold plots at {plot_dir}.")
+  plot_dir.mkdir(parents=True, exist_ok=True)
+
+  annual_sum_types = output_control_dict['output_data_types']['annual_sum_types']
+  mean_monthly_types = output_control_dict['output_data_types']['mean_monthly_types']
+  mean_annual_types = output_control_dict['output_data_types']['mean_annual_types']
+
+  zonal_stats_formats = output_control_dict.get('zonal_stats_output', {}).get('formats', ['parquet'])
+  zonal_stats_store_dir = data_summary_dir / output_control_dict.get('zonal_stats_output', {}).get('store_dir', 'zonal_stats_store')
+
+  mean_annual_sum_zonal_stats_df = read_zonal_stats('mean_annual', annual_sum_types,
+                                                    zonal_stats_formats, zonal_stats_store_dir, data_summary_dir)
+  mean_monthly_sum_zonal_stats_df = read_zonal_stats('mean_monthly', mean_monthly_types,
+                                                     zonal_stats_formats, zonal_stats_store_dir, data_summary_dir)
+  annual_sum_zonal_stats_df = read_zonal_stats('annual', mean_annual_types,
+                                               zonal_stats_formats, zonal_stats_store_dir, data_summary_dir)
+
+  # split each table by zone once, rather than querying the full tables for every zone
+  annual_sum_by_zone = dict(tuple(annual_sum_zonal_stats_df.groupby('zone', sort=False)))
+  mean_monthly_sum_by_zone = dict(tuple(mean_monthly_sum_zonal_stats_df.groupby('zone', sort=False)))
+  empty_monthly_df = mean_monthly_sum_zonal_stats_df.iloc[0:0]
+
+  zones = annual_sum_zonal_stats_df['zone'].unique()
+
+  # the per-zone plots are independent of one another; render them in a pool of processes. Each process is
+  # handed a share of the zones so that it lays out its figures once and reuses them for every zone
+  n_processes = args.n_processes if args.n_processes > 0 else (os.cpu_count() or 1)
+  zone_data = [(zone, annual_sum_by_zone[zone], mean_monthly_sum_by_zone.get(zone, empty_monthly_df)) for zone in zones]
+  zone_chunks = [zone_data[i::n_processes] for i in range(n_processes) if zone_data[i::n_processes]]
+  with ProcessPoolExecutor(max_workers=n_processes) as executor:
+    futures = []
+    for zone_chunk in zone_chunks:
+      futures.append(executor.submit(render_zone_plots,
+                                     zone_data=zone_chunk,
+                                     variable_dict=variable_dict,
+                                     weather_driver_dict=weather_driver_dict,
+                                     plot_dir=plot_dir,
+                                     preview=args.preview))
+    for future in as_completed(futures):
+      logging.info(f"==> created plots for zones: {', '.join(future.result())}")
+
+  pz.make_annual_plot_of_variables_by_zone(zonal_stats_df=mean_annual_sum_zonal_stats_df, 
+                                           variable_dict=variable_dict,
+                                           weather_driver_dict=weather_driver_dict,
+                                           output_filename=f"mean_annual_variables_by_zone.{'png' if args.preview else 'pdf'}",
+                                           preview=args.preview)
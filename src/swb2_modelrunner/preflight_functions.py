@@ -0,0 +1,289 @@
+import logging
+import math
+import os
+import shutil
+from collections import defaultdict
+import pandas as pd
+import progress_functions as pf
+import grid_cache_functions as gc
+
+"""
+Functions used to check a set of swb2 simulations before any of them is launched, so that a missing or mismatched
+input file is found in seconds rather than hours into a run. The rendered control file of each simulation is
+parsed for its GRID line, its input files and the variables named on its OUTPUT ENABLE lines. Then:
+
+  - every input file is stat'ed once, however many simulations refer to it
+  - only the header of each Arc ASCII grid, and only the dimension sizes and first and last times of each netCDF
+    file, are read; inputs given on the model grid (no projection definition of their own, or the same one as
+    BASE_PROJECTION_DEFINITION) must match the GRID line in number of columns, rows and cell size, and netCDF
+    weather files must cover the simulation period
+  - the disk space and memory needed by each run are estimated from the grid size, the number of simulated days
+    and the number of output variables, and compared with the free disk space of the work directory and the
+    memory available to the runs
+
+The estimates are deliberately simple; the coefficients in PREFLIGHT_DEFAULTS may be set in the [preflight] section
+of the run control file, ex. from the peak memory reported in the run metrics of an earlier run.
+"""
+
+PREFLIGHT_DEFAULTS = {'output_bytes_per_value': 4.0,
+                      'memory_bytes_per_cell': 1024.0,
+                      'memory_base_mb': 256.0,
+                      'disk_reserve_gb': 1.0}
+
+GRID_FORMATS = ['ARC_GRID', 'NETCDF']
+
+# values that stand in place of a file name in a control file
+NON_FILE_VALUES = ['CONSTANT', 'NONE']
+
+logger = logging.getLogger(__name__)
+
+def parse_control_file(control_file_text):
+    """Pick out the parts of an swb2 control file needed for pre-flight checks.
+
+    Returns:
+        dict: 'grid' (dict of nx, ny, x0, y0 and cellsize, or None), 'base_projection' (str), 'inputs' (dict of
+              {'format', 'path'}, keyed by control file keyword), 'options' (every other keyword's value, as text),
+              'output_variables' (list of the variables enabled for output), 'start_date' and 'end_date'; inputs given
+              as a CONSTANT or NONE are kept in 'options', since they have no file to check
+    """
+    control = {'grid': None, 'base_projection': None, 'inputs': {}, 'options': {}, 'output_variables': [],
+               'start_date': None, 'end_date': None}
+    for line in control_file_text.splitlines():
+        parts = line.split()
+        if not parts or parts[0].startswith(('#', '-', '!', '%')):
+            continue
+        keyword = parts[0].upper()
+        if keyword == 'GRID' and len(parts) >= 6:
+            try:
+                control['grid'] = {'nx': int(parts[1]), 'ny': int(parts[2]), 'x0': float(parts[3]),
+                                   'y0': float(parts[4]), 'cellsize': float(parts[5])}
+            except ValueError:
+                pass
+        elif keyword == 'BASE_PROJECTION_DEFINITION':
+            control['base_projection'] = ' '.join(parts[1:])
+        elif len(parts) >= 2 and (parts[1].upper() in NON_FILE_VALUES
+                                  or (parts[1].upper() in GRID_FORMATS and parts[2:3] == ['NONE'])):
+            # a gridded input given as a constant, or switched off, has no file to check
+            control['options'][keyword] = ' '.join(parts[1:])
+        elif len(parts) >= 3 and parts[1].upper() in GRID_FORMATS:
+            control['inputs'][keyword] = {'format': parts[1].upper(), 'path': ' '.join(parts[2:])}
+        elif keyword.endswith('_LOOKUP_TABLE') and len(parts) >= 2:
+            control['inputs'][keyword] = {'format': 'TABLE', 'path': ' '.join(parts[1:])}
+        elif keyword == 'OUTPUT' and len(parts) >= 3:
+            for variable in parts[2:]:
+                if parts[1].upper() == 'ENABLE' and variable not in control['output_variables']:
+                    control['output_variables'].append(variable)
+                elif parts[1].upper() == 'DISABLE' and variable in control['output_variables']:
+                    control['output_variables'].remove(variable)
+        elif keyword in ('START_DATE', 'END_DATE') and len(parts) >= 2:
+            control[keyword.lower()] = pf.parse_date(parts[1])
+        else:
+            control['options'][keyword] = ' '.join(parts[1:])
+    return control
+
+def _on_model_grid(control, keyword):
+    # an input with no projection definition of its own, or the model's own, is expected to match the GRID line
+    projection = (control['options'].get(f"{keyword}_PROJECTION_DEFINITION")
+                  or control['options'].get(f"{keyword}_GRID_PROJECTION_DEFINITION"))
+    return projection is None or projection.split() == (control['base_projection'] or '').split()
+
+def _decode_time_extent(times):
+    # decode only the first and last values of a time variable; None and None if they cannot be decoded as dates
+    import xarray as xr
+    endpoints = xr.Dataset({'time': times.variable[[0, -1]]})
+    try:
+        values = xr.decode_cf(endpoints)['time'].values
+        return pd.Timestamp(str(values[0])).date(), pd.Timestamp(str(values[-1])).date()
+    except (ValueError, TypeError, OverflowError):
+        return None, None
+
+def read_netcdf_dimensions(filename, z_var=None, time_var='time'):
+    """Read the grid dimensions and time extent of a netCDF file without reading its data.
+
+    The file is opened without decoding its times, so that a time axis xarray cannot decode makes for a warning
+    rather than an unreadable file; only the first and last times are read and decoded.
+
+    Returns:
+        dict: 'nx' and 'ny' (the last two dimensions of 'z_var', or of the first variable with at least two
+              dimensions; None if there is none), and 'time_start' and 'time_end' (dates; None if there is no
+              readable time axis)
+    """
+    # imported here, so that launching runs whose inputs are all Arc ASCII grids does not load xarray
+    import xarray as xr
+    dimensions = {'nx': None, 'ny': None, 'time_start': None, 'time_end': None}
+    with xr.open_dataset(filename, decode_times=False) as ds:
+        candidates = [z_var] if z_var in ds.data_vars else [name for name in ds.data_vars if ds[name].ndim >= 2]
+        if candidates:
+            dimensions['ny'], dimensions['nx'] = [ds.sizes[dim] for dim in ds[candidates[0]].dims[-2:]]
+        if time_var in ds.variables and ds[time_var].ndim == 1 and ds[time_var].size > 0:
+            dimensions['time_start'], dimensions['time_end'] = _decode_time_extent(ds[time_var])
+    return dimensions
+
+def _read_grid_description(input_format, filename, control, keyword, description_cache):
+    # header or dimensions of a gridded input, read once per file (and netCDF variable)
+    z_var = control['options'].get(f"{keyword}_NETCDF_Z_VAR")
+    if (filename, z_var) not in description_cache:
+        try:
+            if input_format == 'ARC_GRID':
+                # the grid cache header when it is up to date, otherwise the few header lines of the grid
+                header = gc.read_grid_header(filename)
+                description = {'nx': int(header['ncols']), 'ny': int(header['nrows']), 'cellsize': header['cellsize']}
+            else:
+                description = read_netcdf_dimensions(filename, z_var=z_var,
+                                                     time_var=control['options'].get(f"{keyword}_NETCDF_TIME_VAR", 'time'))
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            description = e
+        description_cache[(filename, z_var)] = description
+    return description_cache[(filename, z_var)]
+
+def estimate_run_needs(control, options=None):
+    """Estimate the disk space and memory needed by one swb2 run.
+
+    Disk space is that of one daily grid for each output variable, for each simulated day; memory is a fixed
+    amount plus an amount for each grid cell.
+
+    Returns:
+        dict: 'n_cells', 'n_days', 'n_output_variables', 'disk_bytes' and 'memory_bytes'
+    """
+    options = {**PREFLIGHT_DEFAULTS, **(options or {})}
+    grid = control['grid'] or {'nx': 0, 'ny': 0}
+    n_cells = grid['nx'] * grid['ny']
+    n_days = 0
+    if control['start_date'] is not None and control['end_date'] is not None:
+        n_days = (control['end_date'] - control['start_date']).days + 1
+    n_output_variables = len(control['output_variables'])
+    return {'n_cells': n_cells,
+            'n_days': n_days,
+            'n_output_variables': n_output_variables,
+            'disk_bytes': int(n_output_variables * n_cells * n_days * options['output_bytes_per_value']),
+            'memory_bytes': int(options['memory_base_mb'] * 1024**2 + n_cells * options['memory_bytes_per_cell'])}
+
+def check_simulations(simulations, stat_cache=None, options=None):
+    """Check the inputs of a set of simulations and estimate what each run needs.
+
+    Args:
+        simulations (list): list of dicts, each with 'simulation_name' and 'control_file_text' (the rendered control
+                            file) entries
+        stat_cache (dict): os.stat results already gathered (ex. by 'manifest_functions.describe_input_files'),
+                           keyed by file name; added to as needed
+        options (dict): estimate coefficients; see 'PREFLIGHT_DEFAULTS'
+
+    Returns:
+        dict: 'errors' and 'warnings' (lists of messages) and 'estimates' (dataframe with one row per simulation)
+    """
+    stat_cache = {} if stat_cache is None else stat_cache
+    description_cache = {}
+    problems = defaultdict(list)
+    estimates = []
+
+    def report(kind, message, simulation_name):
+        problems[(kind, message)].append(simulation_name)
+
+    for simulation in simulations:
+        simulation_name = simulation['simulation_name']
+        control = parse_control_file(simulation['control_file_text'])
+        grid = control['grid']
+        if grid is None:
+            report('errors', 'control file has no readable GRID line', simulation_name)
+        if control['start_date'] is None or control['end_date'] is None:
+            report('errors', 'control file has no readable START_DATE and END_DATE', simulation_name)
+
+        for keyword, control_input in control['inputs'].items():
+            filename = control_input['path']
+            if filename not in stat_cache:
+                try:
+                    stat_cache[filename] = os.stat(filename)
+                except OSError:
+                    stat_cache[filename] = None
+            if stat_cache[filename] is None:
+                report('errors', f"{keyword}: input file not found: {filename}", simulation_name)
+                continue
+            if control_input['format'] not in GRID_FORMATS:
+                continue
+
+            description = _read_grid_description(control_input['format'], filename, control, keyword,
+                                                 description_cache)
+            if isinstance(description, Exception):
+                report('errors', f"{keyword}: could not read {filename}: {str(description).splitlines()[0]}",
+                       simulation_name)
+                continue
+            if grid is not None and _on_model_grid(control, keyword):
+                if (description['nx'], description['ny']) != (grid['nx'], grid['ny']):
+                    report('errors', f"{keyword}: {filename} is {description['nx']} by {description['ny']} cells; "
+                                     f"GRID line is {grid['nx']} by {grid['ny']}", simulation_name)
+                elif 'cellsize' in description and not math.isclose(description['cellsize'], grid['cellsize'],
+                                                                      rel_tol=1e-6):
+                    report('errors', f"{keyword}: {filename} has a cell size of {description['cellsize']}; "
+                                     f"GRID line gives {grid['cellsize']}", simulation_name)
+            if control_input['format'] == 'NETCDF' and control['start_date'] is not None:
+                if description['time_start'] is None:
+                    report('warnings', f"{keyword}: no readable time axis in {filename}", simulation_name)
+                elif (description['time_start'] > control['start_date']
+                      or description['time_end'] < control['end_date']):
+                    report('errors', f"{keyword}: {filename} covers {description['time_start']} to "
+                                     f"{description['time_end']}, not the whole simulation period "
+                                     f"({control['start_date']} to {control['end_date']})", simulation_name)
+
+        estimates.append({'simulation_name': simulation_name, **estimate_run_needs(control, options)})
+
+    results = {'errors': [], 'warnings': [],
+               'estimates': pd.DataFrame(estimates, columns=['simulation_name', 'n_cells', 'n_days',
+                                                             'n_output_variables', 'disk_bytes', 'memory_bytes'])}
+    for (kind, message), simulation_names in problems.items():
+        affected = simulation_names[0] if len(simulation_names) == 1 else f"{len(simulation_names)} simulations"
+        results[kind].append(f"{message} ({affected})")
+    return results
+
+def check_budget(results, work_dir, max_concurrent_runs, total_memory_gb=None, memory_per_run_gb=None,
+                 options=None):
+    """Compare the estimated needs of the runs with the disk space and memory available. Errors and warnings are
+    added to 'results'.
+
+    Args:
+        results (dict): as returned by 'check_simulations'
+        work_dir (Path): directory to which the runs write their output
+        max_concurrent_runs (int): number of runs that would be allowed to run at once
+        total_memory_gb (float): memory shared by the concurrent runs (ex. of this machine); None to skip the check
+        memory_per_run_gb (float): memory requested for each run (ex. of a batch system); None to skip the check
+        options (dict): see 'PREFLIGHT_DEFAULTS'
+
+    Returns:
+        int: the number of runs that may run at once without exceeding 'total_memory_gb' (at least 1)
+    """
+    options = {**PREFLIGHT_DEFAULTS, **(options or {})}
+    estimates = results['estimates']
+    if estimates.empty:
+        return max_concurrent_runs
+
+    disk_needed = estimates['disk_bytes'].sum()
+    disk_free = shutil.disk_usage(work_dir).free - options['disk_reserve_gb'] * 1024**3
+    if disk_needed > disk_free:
+        results['errors'].append(f"output is estimated at {disk_needed / 1024**3:.1f} GB; only "
+                                 f"{max(disk_free, 0) / 1024**3:.1f} GB is free in {work_dir}")
+
+    memory_per_run = estimates['memory_bytes'].max()
+    if memory_per_run_gb is not None and memory_per_run > memory_per_run_gb * 1024**3:
+        results['warnings'].append(f"each run is estimated to need up to {memory_per_run / 1024**3:.1f} GB of memory; "
+                                   f"{memory_per_run_gb} GB is requested")
+    if total_memory_gb is not None:
+        allowed_runs = int(total_memory_gb * 1024**3 // memory_per_run)
+        if allowed_runs < 1:
+            results['errors'].append(f"a single run is estimated to need {memory_per_run / 1024**3:.1f} GB of memory; "
+                                     f"only {total_memory_gb:.1f} GB is available")
+        elif allowed_runs < max_concurrent_runs:
+            results['warnings'].append(f"reducing the number of concurrent runs from {max_concurrent_runs} to "
+                                       f"{allowed_runs}; each needs up to {memory_per_run / 1024**3:.1f} GB of memory")
+            return allowed_runs
+    return max_concurrent_runs
+
+def format_report(results):
+    """Return a text summary of the pre-flight checks and estimates."""
+    estimates = results['estimates']
+    lines = [f"pre-flight check of {len(estimates)} simulations: "
+             f"{len(results['errors'])} errors, {len(results['warnings'])} warnings"]
+    if not estimates.empty:
+        lines.append(f"  estimated output: {estimates['disk_bytes'].sum() / 1024**3:.2f} GB in all; "
+                     f"estimated memory: up to {estimates['memory_bytes'].max() / 1024**3:.2f} GB per run")
+    lines += [f"  ERROR: {message}" for message in results['errors']]
+    lines += [f"  WARNING: {message}" for message in results['warnings']]
+    return '\n'.join(lines)
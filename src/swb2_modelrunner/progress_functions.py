@@ -0,0 +1,211 @@
+import asyncio
+import datetime as dt
+import logging
+import re
+import time
+from pathlib import Path
+
+"""
+Functions used to follow the progress of running swb2 simulations. swb2's standard output is read as it is written
+(and saved to the simulation's logfile directory), and the files in each simulation's logfile directory are
+tailed; the most recent simulated date found in either is compared with the START_DATE and END_DATE of the control
+file to estimate how far along each run is. A single coroutine reports the progress and estimated time remaining of
+each run, and of the whole set of runs, at a fixed interval, and warns about any run whose simulated date has not
+advanced for a while. Everything runs on the scheduler's event loop; no threads are started. Runs submitted to a
+batch system are followed the same way, with 'check_progress' called from the job status polling loop.
+"""
+
+# dates written by swb2 as mm/dd/yyyy or yyyy-mm-dd
+DATE_PATTERN = r"(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})|(?P<iso_year>\d{4})-(?P<iso_month>\d{2})-(?P<iso_day>\d{2})"
+
+# lines that echo the simulation period rather than report the simulated date
+IGNORED_LINE_PATTERN = r"START_DATE|END_DATE|START DATE|END DATE"
+
+STDOUT_FILENAME = 'swb_stdout.txt'
+
+logger = logging.getLogger(__name__)
+
+def read_simulation_period(control_file_text):
+    """Return the (START_DATE, END_DATE) of an swb2 control file as dates; None if either is missing."""
+    dates = {}
+    for line in control_file_text.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0].upper() in ('START_DATE', 'END_DATE'):
+            date = parse_date(parts[1])
+            if date is not None:
+                dates[parts[0].upper()] = date
+    if 'START_DATE' in dates and 'END_DATE' in dates:
+        return dates['START_DATE'], dates['END_DATE']
+    return None
+
+def parse_date(text, date_pattern=DATE_PATTERN):
+    """Return the last date found in a line of text, or None."""
+    date = None
+    for match in re.finditer(date_pattern, text):
+        groups = match.groupdict()
+        try:
+            if groups.get('iso_year'):
+                date = dt.date(int(groups['iso_year']), int(groups['iso_month']), int(groups['iso_day']))
+            else:
+                date = dt.date(int(groups['year']), int(groups['month']), int(groups['day']))
+        except (ValueError, TypeError):
+            continue
+    return date
+
+def create_tracker(simulations, date_pattern=DATE_PATTERN):
+    """Create the progress record for a set of simulations. Simulations without 'start_date' and 'end_date' entries
+    are tracked only as queued, running or finished."""
+    tracker = {'date_pattern': re.compile(date_pattern),
+               'ignored_line_pattern': re.compile(IGNORED_LINE_PATTERN),
+               'simulations': {}}
+    for simulation in simulations:
+        tracker['simulations'][simulation['simulation_name']] = {
+            'start_date': simulation.get('start_date'),
+            'end_date': simulation.get('end_date'),
+            'logfile_dir': Path(simulation['swb_run_dir']) / 'logfile',
+            'status': 'queued',
+            'started_at': None,
+            'run_seconds': 0.0,
+            'simulated_date': None,
+            'last_advance': None,
+            'logfile_offsets': {},
+            'stalled': False}
+    return tracker
+
+def mark_started(tracker, simulation_name):
+    record = tracker['simulations'][simulation_name]
+    record['status'] = 'running'
+    record['started_at'] = record['last_advance'] = time.monotonic()
+
+def mark_finished(tracker, simulation_name):
+    record = tracker['simulations'][simulation_name]
+    record['status'] = 'finished'
+    if record['started_at'] is not None:
+        record['run_seconds'] = time.monotonic() - record['started_at']
+    if record['end_date'] is not None:
+        record['simulated_date'] = record['end_date']
+
+def update_from_line(tracker, simulation_name, line):
+    """Update a simulation's simulated date from a line of swb2 output."""
+    if tracker['ignored_line_pattern'].search(line):
+        return
+    date = parse_date(line, tracker['date_pattern'])
+    record = tracker['simulations'][simulation_name]
+    if date is None or record['start_date'] is None:
+        return
+    # dates outside of the simulation period (ex. file creation dates) say nothing about progress
+    if not (record['start_date'] <= date <= record['end_date']):
+        return
+    if record['simulated_date'] is None or date > record['simulated_date']:
+        record['simulated_date'] = date
+        record['last_advance'] = time.monotonic()
+        record['stalled'] = False
+
+async def read_stdout(stream, tracker, simulation_name, stdout_filename):
+    """Read swb2's standard output line by line as it is written, saving it to 'stdout_filename'."""
+    with open(stdout_filename, 'w') as f:
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # a line longer than the stream's buffer; take it in pieces
+                line = await stream.read(2**16)
+            if not line:
+                break
+            text = line.decode(errors='replace')
+            f.write(text)
+            update_from_line(tracker, simulation_name, text)
+
+def tail_logfiles(tracker, simulation_name):
+    """Read whatever has been added to the files in a simulation's logfile directory since the last look, and update
+    its simulated date."""
+    record = tracker['simulations'][simulation_name]
+    try:
+        logfiles = [f for f in record['logfile_dir'].iterdir() if f.is_file()]
+    except OSError:
+        return
+    for logfile in logfiles:
+        offset = record['logfile_offsets'].get(logfile.name, 0)
+        try:
+            if logfile.stat().st_size <= offset:
+                continue
+            with open(logfile, 'rb') as f:
+                f.seek(offset)
+                new_text = f.read()
+        except OSError:
+            continue
+        # keep any incomplete last line for the next look
+        complete_text, _, partial_line = new_text.rpartition(b'\n')
+        record['logfile_offsets'][logfile.name] = offset + len(new_text) - len(partial_line)
+        for line in complete_text.decode(errors='replace').splitlines():
+            update_from_line(tracker, simulation_name, line)
+
+def _fraction_complete(record):
+    if record['status'] == 'finished':
+        return 1.0
+    if record['simulated_date'] is None or record['start_date'] is None:
+        return 0.0
+    total_days = (record['end_date'] - record['start_date']).days + 1
+    return ((record['simulated_date'] - record['start_date']).days + 1) / total_days
+
+def _format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    return str(dt.timedelta(seconds=int(seconds)))
+
+def progress_report(tracker):
+    """Return lines describing the progress and estimated time remaining of each running simulation and of the
+    whole set of simulations."""
+    now = time.monotonic()
+    lines = []
+    elapsed_run_seconds = 0.0
+    completed_runs = 0.0
+    for simulation_name, record in tracker['simulations'].items():
+        fraction = _fraction_complete(record)
+        completed_runs += fraction
+        if record['status'] != 'running':
+            continue
+        elapsed = now - record['started_at']
+        elapsed_run_seconds += elapsed
+        eta = elapsed * (1.0 - fraction) / fraction if fraction > 0 else None
+        simulated_date = record['simulated_date'].isoformat() if record['simulated_date'] else 'not yet known'
+        lines.append(f"  {simulation_name}: {100 * fraction:5.1f}% (simulated date {simulated_date}); "
+                     f"elapsed {_format_duration(elapsed)}, remaining {_format_duration(eta)}")
+
+    n_simulations = len(tracker['simulations'])
+    n_finished = sum(record['status'] == 'finished' for record in tracker['simulations'].values())
+    n_running = sum(record['status'] == 'running' for record in tracker['simulations'].values())
+    # the ensemble rate is the number of simulations' worth of work done per second, over all runs so far
+    finished_seconds = sum(record['run_seconds'] for record in tracker['simulations'].values())
+    total_seconds = finished_seconds + elapsed_run_seconds
+    ensemble_eta = None
+    if completed_runs > 0 and n_running > 0:
+        seconds_per_run = total_seconds / completed_runs
+        ensemble_eta = seconds_per_run * (n_simulations - completed_runs) / n_running
+    lines.insert(0, f"{n_finished} of {n_simulations} simulations finished, {n_running} running; "
+                    f"{100 * completed_runs / max(n_simulations, 1):5.1f}% of all simulated days done; "
+                    f"estimated time remaining {_format_duration(ensemble_eta)}")
+    return lines
+
+def check_progress(tracker, stall_timeout=1800.0):
+    """Tail the logfiles of the running simulations and log their progress; warn about any simulation whose
+    simulated date has not advanced in 'stall_timeout' seconds."""
+    now = time.monotonic()
+    for simulation_name, record in tracker['simulations'].items():
+        if record['status'] != 'running':
+            continue
+        tail_logfiles(tracker, simulation_name)
+        if not record['stalled'] and now - record['last_advance'] > stall_timeout:
+            record['stalled'] = True
+            logger.warning(f"{simulation_name} appears to be stuck: simulated date has not advanced in "
+                           f"{_format_duration(now - record['last_advance'])}")
+            print(f"WARNING: {simulation_name} has not advanced in {_format_duration(now - record['last_advance'])}")
+    report = '\n'.join(progress_report(tracker))
+    logger.info(f"progress:\n{report}")
+    print(report, flush=True)
+
+async def report_progress(tracker, report_interval=60.0, stall_timeout=1800.0):
+    """Call 'check_progress' every 'report_interval' seconds until cancelled."""
+    while True:
+        await asyncio.sleep(report_interval)
+        check_progress(tracker, stall_timeout)
@@ -0,0 +1,264 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+import psutil
+import progress_functions as pf
+
+"""
+Functions used to launch a set of swb2 simulations with a bounded number of concurrently running
+processes. Simulations are held in a work queue; as soon as one swb2 process exits, the next
+simulation in the queue is started. While it runs, each swb2 process (and any children it starts)
+is sampled for CPU time, memory use and bytes read and written. When it exits, the process is reaped
+with os.wait4, and the CPU time and peak memory the kernel has counted for it (and the children it
+waited for) replace the sampled figures if larger, so that the time since the last sample is not lost
+(see '_apply_rusage' for when the kernel's peak memory can be used).
+Bytes read and written come from the samples alone. An optional 'on_start' function is called (in a
+worker thread) just before each swb2 process is started, for example to stage its inputs.
+"""
+
+logger = logging.getLogger(__name__)
+
+# 'ru_maxrss' is in kilobytes on Linux, and in bytes on macOS
+RU_MAXRSS_BYTES = 1 if sys.platform == 'darwin' else 1024
+
+def get_total_memory_gb():
+    """Return the total physical memory of this machine in gigabytes, or None if it cannot be determined."""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024**3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def estimate_max_concurrent_runs(memory_per_run_gb=4.0, cores_per_run=1):
+    """Estimate how many swb2 processes may safely run at once on this machine.
+
+    Args:
+        memory_per_run_gb (float): estimated peak memory use of a single swb2 run, in gigabytes
+        cores_per_run (int): number of cores to set aside for each swb2 run
+
+    Returns:
+        int: the smaller of the core-limited and memory-limited number of runs (at least 1)
+    """
+    n_cores = os.cpu_count() or 1
+    max_runs = n_cores // max(cores_per_run, 1)
+
+    total_memory_gb = get_total_memory_gb()
+    if total_memory_gb is not None and memory_per_run_gb > 0:
+        max_runs = min(max_runs, int(total_memory_gb // memory_per_run_gb))
+
+    return max(max_runs, 1)
+
+def _peak_rss_from_proc(pid):
+    # the kernel's own high-water mark of resident memory (Linux only); catches peaks between samples
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+def _sample_process(process, usage):
+    # record the resources used so far by a process and its children; 'usage' keeps the latest totals
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return
+    rss = cpu_user = cpu_system = read_bytes = write_bytes = 0
+    for p in processes:
+        try:
+            with p.oneshot():
+                rss += p.memory_info().rss
+                cpu_times = p.cpu_times()
+                cpu_user += cpu_times.user
+                cpu_system += cpu_times.system
+                if p is process:
+                    # children that have already exited, and been waited for, are counted by their parent
+                    cpu_user += getattr(cpu_times, 'children_user', 0.0)
+                    cpu_system += getattr(cpu_times, 'children_system', 0.0)
+                # characters passed through read/write calls are counted on network file systems too
+                io = p.io_counters() if hasattr(p, 'io_counters') else None
+                if io is not None:
+                    read_bytes += getattr(io, 'read_chars', io.read_bytes)
+                    write_bytes += getattr(io, 'write_chars', io.write_bytes)
+        except psutil.Error:
+            continue
+    usage['peak_rss_bytes'] = max(usage['peak_rss_bytes'], rss, _peak_rss_from_proc(process.pid))
+    # a child that has exited drops out of the sums, so the totals are never allowed to go down
+    for key, value in [('cpu_user_s', cpu_user), ('cpu_system_s', cpu_system),
+                       ('read_bytes', read_bytes), ('write_bytes', write_bytes)]:
+        usage[key] = max(usage[key], value)
+
+def _apply_rusage(usage, rusage):
+    # the kernel's totals for an exited process, which include the last moments of the run that no sample saw
+    usage['cpu_user_s'] = max(usage['cpu_user_s'], rusage.ru_utime)
+    usage['cpu_system_s'] = max(usage['cpu_system_s'], rusage.ru_stime)
+    # a child's 'ru_maxrss' also counts the memory it shared with this process before it started swb2 (Linux keeps
+    # the high-water mark across exec), so it can only be told apart from that when it is larger than this
+    # process's own peak; otherwise the sampled figure (which includes the kernel's VmHWM) is kept
+    if rusage.ru_maxrss > resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+        usage['peak_rss_bytes'] = max(usage['peak_rss_bytes'], rusage.ru_maxrss * RU_MAXRSS_BYTES)
+
+def _wait_for_exit(pid):
+    # reap a child process with os.wait4 in a thread of its own, so that its resource use is read from the kernel
+    # as it is reaped; the returned future gives (exit code, rusage), or (None, None) if it could not be waited for
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def wait():
+        try:
+            _, status, rusage = os.wait4(pid, 0)
+            result = (os.waitstatus_to_exitcode(status), rusage)
+        except ChildProcessError:
+            logger.warning(f"process {pid} was reaped by something else; its exit code is unknown")
+            result = (None, None)
+        loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+    threading.Thread(target=wait, name=f"wait4-{pid}", daemon=True).start()
+    return future
+
+async def _open_pipe_reader(pipe):
+    # wrap the read end of a pipe in an asyncio stream
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader, transport
+
+async def _monitor_process(pid, usage, sample_interval):
+    try:
+        process = psutil.Process(pid)
+    except psutil.Error:
+        return
+    while True:
+        _sample_process(process, usage)
+        await asyncio.sleep(sample_interval)
+
+async def _run_simulation(simulation, semaphore, on_start, on_complete, sample_interval, tracker):
+    async with semaphore:
+        simulation_name = simulation['simulation_name']
+        prepared = True
+        if on_start is not None:
+            # a failure here (ex. staging the inputs or writing the control file) fails this simulation alone
+            try:
+                await asyncio.to_thread(on_start, simulation)
+            except Exception:
+                logger.exception(f"could not prepare {simulation_name} to run; swb not started")
+                prepared = False
+        logger.info(f"running swb for {simulation_name}")
+        logger.info(f"   location of swb run: {simulation['swb_run_dir']}")
+        logger.info(f"   swb command line: '{simulation['swb_arg_text']}'")
+        usage = {'peak_rss_bytes': 0, 'cpu_user_s': 0.0, 'cpu_system_s': 0.0, 'read_bytes': 0, 'write_bytes': 0}
+        start_time = dt.datetime.now()
+        start_counter = time.perf_counter()
+        pf.mark_started(tracker, simulation_name)
+        process = None
+        if prepared:
+            try:
+                # started with Popen rather than asyncio, so that the process is reaped here (with os.wait4) rather
+                # than by asyncio's child watcher
+                process = subprocess.Popen(simulation['swb_arg_text'],
+                                           cwd=simulation['swb_run_dir'],
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT)
+            except OSError as e:
+                logger.error(f"could not start swb for {simulation_name}: {e}")
+        if process is None:
+            exit_code = None
+        else:
+            exited = _wait_for_exit(process.pid)
+            monitor = asyncio.create_task(_monitor_process(process.pid, usage, sample_interval))
+            stdout_filename = Path(simulation['swb_run_dir']) / 'logfile' / pf.STDOUT_FILENAME
+            transport = None
+            try:
+                stdout, transport = await _open_pipe_reader(process.stdout)
+                await pf.read_stdout(stdout, tracker, simulation_name, stdout_filename)
+                exit_code, rusage = await exited
+            except asyncio.CancelledError:
+                # never leave an swb2 process running behind a cancelled run
+                if not exited.done():
+                    logger.warning(f"stopping swb for {simulation_name}")
+                    process.terminate()
+                    await exited
+                raise
+            finally:
+                monitor.cancel()
+                if transport is not None:
+                    transport.close()
+                # the process has been reaped; recording its exit code keeps Popen from waiting for it again
+                if exited.done():
+                    process.returncode = exited.result()[0]
+            if rusage is not None:
+                _apply_rusage(usage, rusage)
+            logger.info(f"swb finished for {simulation_name}; exit code: {exit_code}")
+        pf.mark_finished(tracker, simulation_name)
+
+        metrics = {'simulation_name': simulation_name,
+                   'start_time': start_time.isoformat(timespec='seconds'),
+                   'end_time': dt.datetime.now().isoformat(timespec='seconds'),
+                   'wall_time_s': round(time.perf_counter() - start_counter, 3),
+                   **usage,
+                   'exit_code': exit_code}
+        if on_complete is not None:
+            # a failure here (ex. writing the manifest or catalog) is reported without stopping the other runs
+            try:
+                on_complete(simulation, exit_code, metrics)
+            except Exception:
+                logger.exception(f"error handling the completion of {simulation_name}")
+        return simulation_name, exit_code
+
+async def _run_simulations(simulations, max_concurrent_runs, on_start, on_complete, sample_interval, progress_options):
+    semaphore = asyncio.Semaphore(max_concurrent_runs)
+    tracker = pf.create_tracker(simulations, date_pattern=progress_options.get('date_pattern', pf.DATE_PATTERN))
+    reporter = asyncio.create_task(pf.report_progress(tracker,
+                                                      report_interval=progress_options.get('report_interval', 60.0),
+                                                      stall_timeout=progress_options.get('stall_timeout', 1800.0)))
+    tasks = [asyncio.create_task(_run_simulation(simulation, semaphore, on_start, on_complete, sample_interval, tracker))
+             for simulation in simulations]
+    try:
+        # every run is waited for, so that an error in one never leaves the swb2 processes of others orphaned;
+        # the first error is raised once they are all done
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        reporter.cancel()
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+def run_simulations(simulations, max_concurrent_runs, on_complete=None, sample_interval=1.0, progress_options=None,
+                    on_start=None):
+    """Run each simulation in 'simulations', never allowing more than 'max_concurrent_runs' swb2
+    processes to run at once. Simulations are started in list order.
+
+    Args:
+        simulations (list): list of dicts, each with the keys 'simulation_name', 'swb_run_dir' (the
+                            directory in which swb2 is launched) and 'swb_arg_text' (swb2 command line, as a list)
+        max_concurrent_runs (int): maximum number of swb2 processes allowed to run at the same time
+        on_complete (callable): optional function called as 'on_complete(simulation, exit_code, metrics)' as
+                                soon as each simulation finishes (an error it raises is logged, and the other
+                                simulations carry on); 'metrics' is a dict holding the simulation name,
+                                start and end times, wall time, CPU time (user and system) and peak resident
+                                memory (the larger of the sampled figures and those counted by the kernel at exit),
+                                bytes read and written (as last sampled), and the exit code
+        sample_interval (float): seconds between samples of each running swb2 process's resource use
+        progress_options (dict): optional 'report_interval' and 'stall_timeout' (seconds) and 'date_pattern'
+                                 (regular expression) used to report progress; simulations that include
+                                 'start_date' and 'end_date' (dates) are reported with a percent complete and ETA
+        on_start (callable): optional function called as 'on_start(simulation)' just before each swb2 process is
+                             started; it is run in a worker thread, so that other runs are not held up meanwhile. If
+                             it raises an error, the error is logged and swb2 is not started for that simulation,
+                             which is reported to 'on_complete' with an exit code of None
+
+    Returns:
+        dict: exit code of each simulation, keyed by simulation name; None if swb2 could not be started
+    """
+    results = asyncio.run(_run_simulations(simulations, max(int(max_concurrent_runs), 1), on_start, on_complete,
+                                           sample_interval, progress_options or {}))
+    return dict(results)
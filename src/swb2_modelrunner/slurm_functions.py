@@ -0,0 +1,384 @@
+import datetime as dt
+import logging
+import math
+import shlex
+import subprocess
+import time
+from collections import defaultdict
+from pathlib import Path
+import progress_functions as pf
+
+"""
+Functions used to run a set of swb2 simulations as a SLURM job array, so that an ensemble can be spread across the
+nodes of a cluster. One tasks file lists the command line of each simulation, and one job script runs the line
+picked out by SLURM_ARRAY_TASK_ID. The script is submitted with 'sbatch' once for each distinct combination of cores
+and memory requested (taken per simulation from the simulation details file, or from the run control file), each
+submission covering just the array indices that need those resources. The maximum number of simulations allowed to
+run at once is split among the submissions (as the '%' limit of each array), so that together they stay within it.
+
+Jobs are followed with 'squeue' while they are queued or running and with 'sacct' once they have left the queue;
+sacct supplies the exit code, times, CPU time, peak memory and bytes read and written of each task. Where sacct is
+not available (for example, when 'sbatch' and 'squeue' are local stand-in scripts), the exit code is read from the
+file each task writes to its logfile directory, and the times are those observed while polling.
+
+The commands used to talk to SLURM are set in the [model_execution.slurm] section of the run control file.
+"""
+
+SLURM_DEFAULTS = {'sbatch_command': 'sbatch',
+                  'squeue_command': 'squeue',
+                  'sacct_command': 'sacct',
+                  'poll_interval': 30.0,
+                  # number of polls to wait for sacct to report on a task that has left the queue
+                  'sacct_retries': 5,
+                  'job_name': 'swb2',
+                  'time_limit': None,
+                  'partition': None,
+                  'account': None,
+                  'extra_directives': []}
+
+TASKS_FILENAME = 'swb_tasks.txt'
+JOB_SCRIPT_FILENAME = 'swb_job_array.sh'
+EXIT_CODE_FILENAME = 'swb_exit_code.txt'
+
+# job states from which a task does not return
+TERMINAL_STATES = ['BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE', 'FAILED', 'NODE_FAIL', 'OUT_OF_MEMORY',
+                   'PREEMPTED', 'TIMEOUT']
+
+SACCT_FIELDS = ['JobID', 'State', 'ExitCode', 'Start', 'End', 'ElapsedRaw', 'UserCPU', 'SystemCPU', 'MaxRSS',
+                'MaxDiskRead', 'MaxDiskWrite']
+
+SIZE_UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4, 'P': 1024**5}
+
+logger = logging.getLogger(__name__)
+
+def task_command(simulation):
+    """Return the shell command that runs one simulation: swb2 is run in the simulation's directory with its output
+    saved to the logfile directory, and its exit code is written alongside."""
+    swb_command = ' '.join(shlex.quote(str(arg)) for arg in simulation['swb_arg_text'])
+    return (f"cd {shlex.quote(str(simulation['swb_run_dir']))} && "
+            f"{{ {swb_command} > logfile/{pf.STDOUT_FILENAME} 2>&1; status=$?; "
+            f"echo $status > logfile/{EXIT_CODE_FILENAME}; exit $status; }}")
+
+def write_tasks_file(simulations, tasks_filename):
+    """Write the command of each simulation to a tasks file, one per line; line n is run by array task n-1."""
+    with open(tasks_filename, 'w') as f:
+        for simulation in simulations:
+            f.write(task_command(simulation) + '\n')
+
+def job_script_text(tasks_filename, script_dir, slurm_options):
+    """Return the text of the job array script. Cores, memory and the array indices are given on the sbatch command
+    line, since they differ from one submission to the next."""
+    directives = [f"--job-name={slurm_options['job_name']}",
+                  f"--output={Path(script_dir) / 'slurm-%A_%a.out'}"]
+    for option, directive in [('time_limit', 'time'), ('partition', 'partition'), ('account', 'account')]:
+        if slurm_options.get(option):
+            directives.append(f"--{directive}={slurm_options[option]}")
+    directives.extend(slurm_options.get('extra_directives', []))
+
+    lines = ['#!/bin/bash']
+    lines += [f"#SBATCH {directive}" for directive in directives]
+    lines += ['',
+              f"task_line=$(sed -n \"$((SLURM_ARRAY_TASK_ID + 1))p\" {shlex.quote(str(tasks_filename))})",
+              'eval "$task_line"',
+              '']
+    return '\n'.join(lines)
+
+def resource_groups(simulations, cores_per_run=1, memory_per_run_gb=4.0):
+    """Group the array indices of the simulations by the cores and memory each requests.
+
+    Returns:
+        dict: list of array indices, keyed by (cores, memory in megabytes)
+    """
+    groups = defaultdict(list)
+    for index, simulation in enumerate(simulations):
+        cores = int(simulation.get('cores_per_run') or cores_per_run)
+        memory_mb = int(math.ceil(float(simulation.get('memory_per_run_gb') or memory_per_run_gb) * 1024))
+        groups[(cores, memory_mb)].append(index)
+    return dict(groups)
+
+def array_spec(indices, max_concurrent_runs=0):
+    """Return an sbatch '--array' specification (ex. '0-3,7,9-10%4') for a list of array indices."""
+    ranges = []
+    indices = sorted(indices)
+    start = previous = indices[0]
+    for index in indices[1:] + [None]:
+        if index is not None and index == previous + 1:
+            previous = index
+            continue
+        ranges.append(f"{start}-{previous}" if previous > start else f"{start}")
+        if index is not None:
+            start = previous = index
+    spec = ','.join(ranges)
+    return f"{spec}%{max_concurrent_runs}" if max_concurrent_runs > 0 else spec
+
+def split_max_concurrent_runs(group_sizes, max_concurrent_runs=0):
+    """Split the maximum number of tasks allowed to run at once among several job arrays, so that together they never
+    run more than 'max_concurrent_runs' tasks. Every array may run at least one task; the rest of the limit goes,
+    one task at a time, to the array with the most tasks per task allowed to run.
+
+    Args:
+        group_sizes (list): number of tasks in each job array
+        max_concurrent_runs (int): limit on the tasks of all of the arrays together; 0 leaves this to SLURM
+
+    Returns:
+        list: limit for each job array (each 0 if 'max_concurrent_runs' is 0)
+    """
+    if max_concurrent_runs <= 0:
+        return [0] * len(group_sizes)
+    limits = [1] * len(group_sizes)
+    if len(group_sizes) > max_concurrent_runs:
+        logger.warning(f"{len(group_sizes)} job arrays are needed for the cores and memory requested; up to "
+                       f"{len(group_sizes)} tasks may run at once, rather than {max_concurrent_runs}")
+        return limits
+    for _ in range(max_concurrent_runs - len(group_sizes)):
+        candidates = [i for i, size in enumerate(group_sizes) if limits[i] < size]
+        if not candidates:
+            break
+        limits[max(candidates, key=lambda i: group_sizes[i] / limits[i])] += 1
+    return limits
+
+def _run_command(command, arguments):
+    # returns the standard output of a SLURM command, or None if it could not be run or failed
+    try:
+        result = subprocess.run(shlex.split(command) + arguments, capture_output=True, text=True)
+    except OSError as e:
+        logger.warning(f"could not run '{command}': {e}")
+        return None
+    if result.returncode != 0:
+        logger.warning(f"'{command}' exited with code {result.returncode}: {result.stderr.strip()}")
+        return None
+    return result.stdout
+
+def submit_array(script_filename, indices, cores, memory_mb, max_concurrent_runs, slurm_options):
+    """Submit the job array script for the given array indices; returns the job id."""
+    output = _run_command(slurm_options['sbatch_command'],
+                          ['--parsable',
+                           f"--array={array_spec(indices, max_concurrent_runs)}",
+                           f"--cpus-per-task={cores}",
+                           f"--mem={memory_mb}M",
+                           str(script_filename)])
+    if output is None or not output.strip():
+        raise RuntimeError(f"could not submit {script_filename} with '{slurm_options['sbatch_command']}'")
+    # --parsable prints 'jobid' or 'jobid;cluster'
+    return output.strip().splitlines()[-1].split(';')[0]
+
+def parse_duration(text):
+    """Convert a SLURM duration ([DD-][HH:]MM:SS[.mmm]) to seconds; None if empty or unreadable."""
+    if not text:
+        return None
+    day_text, _, text = text.rpartition('-')
+    try:
+        days = int(day_text) if day_text else 0
+        parts = [float(part) for part in text.split(':')]
+    except ValueError:
+        return None
+    seconds = 0.0
+    for part in parts:
+        seconds = 60.0 * seconds + part
+    return days * 86400.0 + seconds
+
+def parse_size(text):
+    """Convert a SLURM size (ex. '1.50G', '2048K', '512') to bytes; None if empty or unreadable."""
+    if not text:
+        return None
+    multiplier = SIZE_UNITS.get(text[-1].upper(), 1)
+    number = text[:-1] if text[-1].upper() in SIZE_UNITS else text
+    try:
+        return int(float(number) * multiplier)
+    except ValueError:
+        return None
+
+def query_squeue(job_ids, slurm_options):
+    """Return the state of each array task still known to squeue, keyed by '<job id>_<array index>'; None if squeue
+    could not be run."""
+    output = _run_command(slurm_options['squeue_command'], ['-h', '-r', '-j', ','.join(job_ids), '-o', '%i %T'])
+    if output is None:
+        return None
+    states = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            states[parts[0]] = parts[1]
+    return states
+
+def query_sacct(job_ids, slurm_options):
+    """Return the accounting record of each finished array task, keyed by '<job id>_<array index>'. The peak memory
+    and bytes read and written of a task are the largest reported for any of its steps.
+
+    Returns:
+        dict: for each task, a dict of the 'SACCT_FIELDS' values as text
+    """
+    output = _run_command(slurm_options['sacct_command'],
+                          ['-n', '-P', '-j', ','.join(job_ids), '-o', ','.join(SACCT_FIELDS)])
+    if output is None:
+        return {}
+    records = {}
+    steps = defaultdict(list)
+    for line in output.splitlines():
+        values = line.split('|')
+        if len(values) < len(SACCT_FIELDS):
+            continue
+        record = dict(zip(SACCT_FIELDS, values))
+        task_id, _, step = record['JobID'].partition('.')
+        if step:
+            steps[task_id].append(record)
+        else:
+            records[task_id] = record
+    for task_id, record in records.items():
+        for field in ['MaxRSS', 'MaxDiskRead', 'MaxDiskWrite']:
+            sizes = [parse_size(r[field]) for r in [record] + steps[task_id]]
+            sizes = [size for size in sizes if size is not None]
+            record[field] = str(max(sizes)) if sizes else ''
+    return records
+
+def _state(record):
+    # 'CANCELLED by 1234' -> 'CANCELLED'
+    return record['State'].split()[0] if record['State'].strip() else ''
+
+def _read_exit_code(simulation):
+    try:
+        return int((Path(simulation['swb_run_dir']) / 'logfile' / EXIT_CODE_FILENAME).read_text().strip())
+    except (OSError, ValueError):
+        return None
+
+def _task_metrics(simulation, record, observed):
+    # metrics of a finished task, from its sacct record where there is one, otherwise as observed while polling
+    metrics = {'simulation_name': simulation['simulation_name'],
+               'start_time': observed.get('start_time'),
+               'end_time': dt.datetime.now().isoformat(timespec='seconds'),
+               'wall_time_s': (round(time.monotonic() - observed['started_at'], 3)
+                               if 'started_at' in observed else None),
+               'cpu_user_s': None,
+               'cpu_system_s': None,
+               'peak_rss_bytes': None,
+               'read_bytes': None,
+               'write_bytes': None,
+               'exit_code': _read_exit_code(simulation)}
+    if record is None:
+        return metrics
+
+    exit_code = int(record['ExitCode'].split(':')[0]) if record['ExitCode'].split(':')[0].isdigit() else None
+    # a task that was cancelled, timed out or ran out of memory may still report an exit code of zero
+    if _state(record) != 'COMPLETED' and not exit_code:
+        exit_code = 1
+    for field, value in [('start_time', record['Start']), ('end_time', record['End'])]:
+        if value and value not in ('Unknown', 'None'):
+            metrics[field] = value
+    if record['ElapsedRaw'].isdigit():
+        metrics['wall_time_s'] = float(record['ElapsedRaw'])
+    metrics.update({'cpu_user_s': parse_duration(record['UserCPU']),
+                    'cpu_system_s': parse_duration(record['SystemCPU']),
+                    'peak_rss_bytes': parse_size(record['MaxRSS']),
+                    'read_bytes': parse_size(record['MaxDiskRead']),
+                    'write_bytes': parse_size(record['MaxDiskWrite']),
+                    'exit_code': exit_code})
+    return metrics
+
+def run_simulations(simulations, script_dir, slurm_options=None, max_concurrent_runs=0, on_complete=None,
+                    cores_per_run=1, memory_per_run_gb=4.0, progress_options=None):
+    """Run each simulation in 'simulations' as a task of a SLURM job array, and wait for all of them to finish.
+
+    Args:
+        simulations (list): list of dicts, each with the keys 'simulation_name', 'swb_run_dir' and 'swb_arg_text',
+                            as for 'scheduler_functions.run_simulations'; optional 'cores_per_run' and
+                            'memory_per_run_gb' entries override the defaults below for that simulation
+        script_dir (Path): directory to which the tasks file, job script and SLURM output files are written
+        slurm_options (dict): settings from the [model_execution.slurm] section of the run control file; see
+                              'SLURM_DEFAULTS'
+        max_concurrent_runs (int): maximum number of simulations allowed to run at once, split among the job
+                                   arrays as in 'split_max_concurrent_runs'; 0 leaves this to SLURM
+        on_complete (callable): optional function called as 'on_complete(simulation, exit_code, metrics)' as each
+                                simulation finishes; an error it raises is logged, and the other simulations are
+                                still followed
+        cores_per_run (int): cores requested for each simulation that does not give its own
+        memory_per_run_gb (float): memory (GB) requested for each simulation that does not give its own
+        progress_options (dict): optional 'report_interval', 'stall_timeout' and 'date_pattern' used to report
+                                 progress
+
+    Returns:
+        dict: exit code of each simulation, keyed by simulation name; None if the outcome could not be determined
+    """
+    slurm_options = {**SLURM_DEFAULTS, **(slurm_options or {})}
+    progress_options = progress_options or {}
+    if not simulations:
+        return {}
+
+    script_dir = Path(script_dir)
+    script_dir.mkdir(parents=True, exist_ok=True)
+    tasks_filename = script_dir / TASKS_FILENAME
+    script_filename = script_dir / JOB_SCRIPT_FILENAME
+    write_tasks_file(simulations, tasks_filename)
+    with open(script_filename, 'w') as f:
+        f.write(job_script_text(tasks_filename, script_dir, slurm_options))
+    for simulation in simulations:
+        (Path(simulation['swb_run_dir']) / 'logfile' / EXIT_CODE_FILENAME).unlink(missing_ok=True)
+
+    pending = {}
+    job_ids = []
+    groups = resource_groups(simulations, cores_per_run, memory_per_run_gb)
+    # each job array is given its share of 'max_concurrent_runs', so that together they stay within it
+    limits = split_max_concurrent_runs([len(indices) for indices in groups.values()], max_concurrent_runs)
+    for ((cores, memory_mb), indices), limit in zip(groups.items(), limits):
+        job_id = submit_array(script_filename, indices, cores, memory_mb, limit, slurm_options)
+        logger.info(f"submitted job {job_id}: {len(indices)} simulations, {cores} cores and {memory_mb} MB each"
+                    + (f", at most {limit} at once" if limit else ''))
+        job_ids.append(job_id)
+        for index in indices:
+            pending[f"{job_id}_{index}"] = simulations[index]
+
+    tracker = pf.create_tracker(simulations, date_pattern=progress_options.get('date_pattern', pf.DATE_PATTERN))
+    report_interval = progress_options.get('report_interval', 60.0)
+    stall_timeout = progress_options.get('stall_timeout', 1800.0)
+    last_report = time.monotonic()
+    observed = defaultdict(dict)
+    sacct_misses = defaultdict(int)
+    exit_codes = {}
+
+    while pending:
+        time.sleep(slurm_options['poll_interval'])
+        states = query_squeue(job_ids, slurm_options)
+        if states is None:
+            continue
+
+        finished = []
+        for task_id, simulation in pending.items():
+            state = states.get(task_id)
+            if state == 'RUNNING' and 'started_at' not in observed[task_id]:
+                observed[task_id].update({'started_at': time.monotonic(),
+                                          'start_time': dt.datetime.now().isoformat(timespec='seconds')})
+                pf.mark_started(tracker, simulation['simulation_name'])
+                logger.info(f"{simulation['simulation_name']} is running as task {task_id}")
+            if state is None or state in TERMINAL_STATES:
+                finished.append(task_id)
+
+        records = query_sacct(job_ids, slurm_options) if finished else {}
+        for task_id in finished:
+            simulation = pending[task_id]
+            record = records.get(task_id)
+            if record is not None and _state(record) not in TERMINAL_STATES:
+                # sacct can lag behind squeue; look again at the next poll
+                continue
+            if record is None and _read_exit_code(simulation) is None:
+                sacct_misses[task_id] += 1
+                if sacct_misses[task_id] <= slurm_options['sacct_retries']:
+                    continue
+                logger.error(f"could not determine the outcome of {simulation['simulation_name']} (task {task_id})")
+
+            metrics = _task_metrics(simulation, record, observed[task_id])
+            pf.mark_finished(tracker, simulation['simulation_name'])
+            logger.info(f"swb finished for {simulation['simulation_name']}; exit code: {metrics['exit_code']}")
+            exit_codes[simulation['simulation_name']] = metrics['exit_code']
+            if on_complete is not None:
+                # a failure here (ex. writing the manifest or catalog) is reported without leaving the tasks still
+                # queued or running unwatched
+                try:
+                    on_complete(simulation, metrics['exit_code'], metrics)
+                except Exception:
+                    logger.exception(f"error handling the completion of {simulation['simulation_name']}")
+            del pending[task_id]
+
+        if time.monotonic() - last_report >= report_interval:
+            pf.check_progress(tracker, stall_timeout)
+            last_report = time.monotonic()
+
+    return exit_codes
@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+"""
+Functions used to keep copies of swb2 input files on node-local scratch space, so that many concurrent swb2
+processes read their weather data and grids from local disk rather than all pulling the same bytes from a shared
+parallel filesystem.
+
+Each distinct input file is copied to the staging directory once, when the first simulation that needs it is about
+to start, and the control file of that simulation is rewritten to point at the staged copies. Staged files are
+reference counted: a file in use by a running simulation is never removed. Once the staging directory holds more
+than its size limit, the least recently used files that no running simulation refers to are removed. Files left in
+the staging directory by an earlier run are reused if they still match the original's size and modification time.
+"""
+
+logger = logging.getLogger(__name__)
+
+def staged_filename(source):
+    """Return the name given to the staged copy of a file; the hash keeps files of the same name apart."""
+    source = str(source)
+    return f"{hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]}__{Path(source).name}"
+
+def create_cache(staging_dir, max_size_gb=None):
+    """Create the record of a staging directory, taking in any files already staged there.
+
+    Args:
+        staging_dir (Path): node-local directory to hold the staged copies
+        max_size_gb (float): size of the staging directory above which unused files are removed; None for no limit
+
+    Returns:
+        dict: staging cache, passed to the other functions of this module
+    """
+    staging_path = Path(os.path.expandvars(str(staging_dir))).expanduser()
+    staging_path.mkdir(parents=True, exist_ok=True)
+    cache = {'staging_dir': staging_path,
+             'max_bytes': None if max_size_gb is None else int(max_size_gb * 1024**3),
+             'total_bytes': 0,
+             # staged files, least recently used first, keyed by staged file name
+             'entries': OrderedDict(),
+             'lock': threading.Lock()}
+    existing_files = sorted((f for f in staging_path.iterdir() if f.is_file() and not f.name.endswith('.tmp')),
+                            key=lambda f: f.stat().st_atime)
+    for staged_file in existing_files:
+        size = staged_file.stat().st_size
+        cache['entries'][staged_file.name] = {'source': None, 'size': size, 'refcount': 0}
+        cache['total_bytes'] += size
+    _evict(cache)
+    return cache
+
+def _evict(cache, bytes_needed=0):
+    # remove unreferenced files, least recently used first, until 'bytes_needed' more will fit under the limit
+    if cache['max_bytes'] is None:
+        return
+    for name in list(cache['entries']):
+        if cache['total_bytes'] + bytes_needed <= cache['max_bytes']:
+            break
+        entry = cache['entries'][name]
+        if entry['refcount'] > 0:
+            continue
+        (cache['staging_dir'] / name).unlink(missing_ok=True)
+        cache['total_bytes'] -= entry['size']
+        del cache['entries'][name]
+        logger.info(f"removed staged file {name} ({entry['size'] / 1024**2:.1f} MB)")
+
+def _stage_file(cache, source):
+    # copy a file to the staging directory unless an up-to-date copy is already there; returns the staged path,
+    # or the source itself if it cannot be staged
+    name = staged_filename(source)
+    staged_path = cache['staging_dir'] / name
+    source_stat = os.stat(source)
+    entry = cache['entries'].get(name)
+    if entry is not None:
+        try:
+            staged_stat = staged_path.stat()
+            up_to_date = (staged_stat.st_size == source_stat.st_size
+                          and int(staged_stat.st_mtime) == int(source_stat.st_mtime))
+        except OSError:
+            up_to_date = False
+        if up_to_date:
+            entry['source'] = str(source)
+            entry['refcount'] += 1
+            cache['entries'].move_to_end(name)
+            return staged_path
+        if entry['refcount'] > 0:
+            logger.warning(f"{source} changed while its staged copy is in use; reading the original")
+            return Path(source)
+        staged_path.unlink(missing_ok=True)
+        cache['total_bytes'] -= entry['size']
+        del cache['entries'][name]
+
+    _evict(cache, source_stat.st_size)
+    if cache['max_bytes'] is not None and cache['total_bytes'] + source_stat.st_size > cache['max_bytes']:
+        logger.warning(f"no room to stage {source} ({source_stat.st_size / 1024**2:.1f} MB); reading the original")
+        return Path(source)
+
+    start = time.perf_counter()
+    tmp_path = staged_path.with_name(f"{name}.tmp")
+    try:
+        shutil.copy2(source, tmp_path)
+        os.replace(tmp_path, staged_path)
+    except OSError as e:
+        tmp_path.unlink(missing_ok=True)
+        logger.warning(f"could not stage {source}: {e}; reading the original")
+        return Path(source)
+    logger.info(f"staged {source} ({source_stat.st_size / 1024**2:.1f} MB) in {time.perf_counter() - start:.1f} s")
+    cache['entries'][name] = {'source': str(source), 'size': source_stat.st_size, 'refcount': 1}
+    cache['total_bytes'] += source_stat.st_size
+    return staged_path
+
+def acquire(cache, sources):
+    """Stage the input files of a simulation that is about to start, and take a reference to each.
+
+    Args:
+        cache (dict): staging cache, as returned by 'create_cache'
+        sources (list): names of the input files
+
+    Returns:
+        dict: path to read each input file from, keyed by the original file name; the original is given for any
+              file that could not be staged
+    """
+    staged_paths = {}
+    with cache['lock']:
+        for source in dict.fromkeys(str(source) for source in sources):
+            try:
+                staged_paths[source] = _stage_file(cache, source)
+            except OSError as e:
+                logger.warning(f"could not stage {source}: {e}")
+                staged_paths[source] = Path(source)
+    return staged_paths
+
+def release(cache, staged_paths):
+    """Drop the references taken by 'acquire' once a simulation has finished, and remove unused files if the
+    staging directory is over its size limit."""
+    with cache['lock']:
+        for staged_path in staged_paths.values():
+            entry = cache['entries'].get(Path(staged_path).name)
+            if entry is not None and Path(staged_path).parent == cache['staging_dir'] and entry['refcount'] > 0:
+                entry['refcount'] -= 1
+                cache['entries'].move_to_end(Path(staged_path).name)
+        _evict(cache)
+
+def rewrite_control_file_paths(control_file_text, staged_paths):
+    """Replace each original input file name in a control file with the name of its staged copy. Only whole
+    whitespace-separated words are replaced."""
+    for source, staged_path in staged_paths.items():
+        if str(staged_path) != source:
+            control_file_text = re.sub(rf"(?<=\s){re.escape(source)}(?=\s|$)", lambda _: str(staged_path),
+                                       control_file_text, flags=re.MULTILINE)
+    return control_file_text
@@ -1,14 +1,88 @@
 import xarray as xr
 import rioxarray as rio
-import xrspatial as xrs
 import numpy as np
 import pandas as pd
 import datetime as dt
 
-def summarize_array_values(xarray_dataset, variable_name, summary_type='monthly_sum', crs=None):
+def water_year_labels(times):
+    """Return the water year (October 1 through September 30, named for the year in which it ends) of each time."""
+    times = pd.DatetimeIndex(times)
+    return np.where(times.month >= 10, times.year + 1, times.year)
 
-# todo: resample is apparently just a fancy wrapper around 'groupby'; reformulating these to groupby 'water_year' 
-# should be possible
+def season_labels(times, start_doy, end_doy):
+    """Return, for each time, the year in which its season ends, or -1 for times outside of the season. The season
+    runs from day of year 'start_doy' through 'end_doy' (inclusive) and may span the end of a calendar year."""
+    times = pd.DatetimeIndex(times)
+    doy = np.asarray(times.dayofyear)
+    year = np.asarray(times.year)
+    if start_doy <= end_doy:
+        in_season = (doy >= start_doy) & (doy <= end_doy)
+        labels = year
+    else:
+        in_season = (doy >= start_doy) | (doy <= end_doy)
+        labels = np.where(doy >= start_doy, year + 1, year)
+    return np.where(in_season, labels, -1)
+
+def complete_labels(times, label_function):
+    """Return the labels (water years, season years, ...) for which every day is present in the daily 'times'."""
+    times = pd.DatetimeIndex(times)
+    calendar = pd.date_range(f"{times.min().year - 1}-01-01", f"{times.max().year + 1}-12-31", freq="D")
+    expected = pd.Series(label_function(calendar)).value_counts()
+    observed = pd.Series(label_function(times.normalize().unique())).value_counts()
+    complete = observed.index[(observed == expected.reindex(observed.index)).to_numpy()]
+    return np.sort(np.asarray(complete[complete >= 0]))
+
+def _reduce_by_labels(xarray_dataset, labels, label_name, keep_labels, operation):
+    # group the time axis by a precomputed integer label, keeping only the labels listed in 'keep_labels'
+    keep = np.isin(labels, keep_labels)
+    subset = xarray_dataset.isel(time=keep)
+    label_dataarray = xr.DataArray(labels[keep], dims='time', coords={'time': subset['time']}, name=label_name)
+    if operation == 'sum':
+        return subset.groupby(label_dataarray).reduce(np.nansum, dim="time")
+    return subset.groupby(label_dataarray).reduce(np.nanmean, dim="time")
+
+def summarize_by_labels(xarray_dataset, summary_type, seasons=None):
+    """Calculate water year or user-defined season summaries of a daily dataset with integer-label groupby
+    reductions. Only complete water years or seasons are included.
+
+    Summary types are 'water_year_sum', 'water_year_mean', 'mean_water_year_sum' and 'mean_water_year_mean', along
+    with '<season>_sum', '<season>_mean', 'mean_<season>_sum' and 'mean_<season>_mean' for each season defined in
+    'seasons' (ex. {'growing_season': {'start_doy': 133, 'end_doy': 268}}).
+
+    Returns:
+        xarray Dataset, or None if 'summary_type' is not a water year or season summary type
+    """
+    basetype, operation = summary_type.rsplit('_', 1)
+    if operation not in ['sum', 'mean']:
+        return None
+    period_name = basetype[len('mean_'):] if basetype.startswith('mean_') else basetype
+
+    if period_name == 'water_year':
+        label_function = water_year_labels
+        label_name = 'water_year'
+    elif seasons is not None and period_name in seasons:
+        season = seasons[period_name]
+        label_function = lambda times: season_labels(times, season['start_doy'], season['end_doy'])
+        label_name = 'year'
+    else:
+        return None
+
+    times = xarray_dataset['time'].values
+    result_dataset = _reduce_by_labels(xarray_dataset,
+                                       labels=label_function(times),
+                                       label_name=label_name,
+                                       keep_labels=complete_labels(times, label_function),
+                                       operation=operation)
+    if basetype.startswith('mean_'):
+        result_dataset = result_dataset.reduce(np.nanmean, dim=label_name)
+    return result_dataset
+
+def summarize_array_values(xarray_dataset, variable_name, summary_type='monthly_sum', crs=None, seasons=None):
+
+    # water year and user-defined season summaries are calculated by grouping on precomputed integer labels
+    result_dataset = summarize_by_labels(xarray_dataset, summary_type, seasons=seasons)
+    if result_dataset is not None:
+        return assign_crs(result_dataset, crs)
 
     match summary_type:
 
@@ -62,70 +136,383 @@ def summarize_array_values(xarray_dataset, variable_name, summary_type='monthly_
               print(f"unknown calculation_type '{summary_type}'")
               exit(1)
 
+    return assign_crs(result_dataset, crs)
+
+def assign_crs(result_dataset, crs=None):
     if crs is not None:
         result_dataset.rio.write_crs(crs)
         result_dataset['crs'] = crs
 
     return result_dataset
 
-def calculate_zonal_statistics(xarray_dataarray, mask_dataarray, summary_type='none', num_zone_chars=10):
+def _month_blocks(times):
+    # (start, stop) positions of each run of consecutive times that fall in the same calendar month
+    months = np.asarray(times.year) * 12 + np.asarray(times.month)
+    breaks = np.flatnonzero(np.diff(months)) + 1
+    return list(zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(times)]])))
+
+def _season_dataset(totals, keep_labels, operation, dims, coords, variable_name, dtype):
+    # user-defined season summaries, from the per-season-year sums and counts gathered while streaming
+    labels = [label for label in keep_labels if label in totals]
+    sums = np.stack([totals[label][0] for label in labels])
+    if operation == 'sum':
+        values = sums
+    else:
+        counts = np.stack([totals[label][1] for label in labels])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(counts > 0, sums / counts, np.nan)
+    return xr.Dataset({variable_name: (('year',) + dims, values.astype(dtype))},
+                      coords={'year': np.asarray(labels, dtype=np.int64), **coords})
+
+def summarize_array_values_multi(xarray_dataset, variable_name, summary_types, crs=None, seasons=None):
+    """Calculate several summaries of a daily dataset while reading the daily values only once.
+
+    The daily values are read one calendar month at a time, so that no more than a month of daily grids is ever
+    held in memory; a lazily opened dataset is read piece by piece. Each month is reduced to a monthly sum and a
+    monthly count of valid days (and, for user-defined seasons, added to the sums and counts of the season years
+    it falls in). Every summary is then derived from these grids rather than by resampling the daily values
+    again. Means are calculated as sum / count so that the results match those of 'summarize_array_values'.
+
+    Args:
+        xarray_dataset (xarray Dataset): dataset containing a daily time series of grids
+        variable_name (str): name of the variable to summarize
+        summary_types (list): summary types to calculate (ex. ['monthly_sum', 'mean_annual_sum'])
+        crs: coordinate reference system to assign to each of the results
+        seasons (dict): user-defined seasons, as described in 'summarize_by_labels'
+
+    Returns:
+        dict: summarized xarray Dataset for each of the requested summary types, keyed by summary type
     """
-    Iterate over the grids in a xarray dataarray. It is assumed that this dataarray has already been
-    summarized by resampling to a monthly or annual timestep. Zonal statistics are calculated for each of the
-    distinct zone numbers contained in the zone mask file.
+
+    dataarray = xarray_dataset[variable_name].transpose('time', ...)
+    times = pd.DatetimeIndex(dataarray['time'].values)
+    dims = dataarray.dims[1:]
+    coords = {name: coord.variable for name, coord in dataarray.coords.items() if 'time' not in coord.dims}
+    blocks = _month_blocks(times)
+
+    # user-defined seasons among the requested summary types; their days need not line up with months
+    season_names = set()
+    for summary_type in summary_types:
+        basetype = summary_type.rsplit('_', 1)[0]
+        period_name = basetype[len('mean_'):] if basetype.startswith('mean_') else basetype
+        if seasons is not None and period_name in seasons:
+            season_names.add(period_name)
+    season_label_functions = {name: (lambda t, season=seasons[name]: season_labels(t, season['start_doy'],
+                                                                                 season['end_doy']))
+                              for name in season_names}
+    day_labels = {name: label_function(times) for name, label_function in season_label_functions.items()}
+    season_totals = {name: {} for name in season_names}
+
+    monthly_sums = []
+    monthly_counts = []
+    for start, stop in blocks:
+        block = np.asarray(dataarray[start:stop].values)
+        if not np.issubdtype(block.dtype, np.floating):
+            block = block.astype(np.float64)
+        valid = ~np.isnan(block)
+        monthly_sums.append(np.nansum(block, axis=0))
+        monthly_counts.append(valid.sum(axis=0))
+        for name, labels in day_labels.items():
+            block_labels = labels[start:stop]
+            for label in np.unique(block_labels[block_labels >= 0]):
+                in_season = block_labels == label
+                totals = season_totals[name].setdefault(label, [0., 0])
+                totals[0] = totals[0] + np.nansum(block[in_season], axis=0, dtype=np.float64)
+                totals[1] = totals[1] + valid[in_season].sum(axis=0)
+        del block, valid
+
+    dtype = monthly_sums[0].dtype
+    # months are labeled by their last day, as by resample(time="ME")
+    month_labels = pd.DatetimeIndex([times[start] for start, _ in blocks]).to_period('M').to_timestamp(how='end').normalize()
+    monthly_sum = xr.Dataset({variable_name: (('time',) + dims, np.stack(monthly_sums))},
+                             coords={'time': month_labels, **coords})
+    monthly_count = xr.Dataset({variable_name: (('time',) + dims, np.stack(monthly_counts))},
+                               coords={'time': month_labels, **coords})
+    monthly_days = xr.DataArray([stop - start for start, stop in blocks], dims='time', coords={'time': month_labels})
+    del monthly_sums, monthly_counts
+
+    cache = {}
+
+    def monthly(operation):
+        key = f"monthly_{operation}"
+        if key not in cache:
+            if operation == 'sum':
+                cache[key] = monthly_sum
+            else:
+                cache[key] = monthly_sum / monthly_count.where(monthly_count > 0)
+        return cache[key]
+
+    def annual(operation):
+        key = f"annual_{operation}"
+        if key not in cache:
+            # monthly sums contain no NaNs (np.nansum of an all-NaN month is zero), so a plain sum is safe here
+            annual_sum = monthly_sum.resample(time="YE").reduce(np.sum, dim="time")
+            if operation == 'sum':
+                cache[key] = annual_sum
+            else:
+                annual_count = monthly_count.resample(time="YE").sum(dim="time")
+                cache[key] = annual_sum / annual_count.where(annual_count > 0)
+        return cache[key]
+
+    def water_year(operation):
+        key = f"water_year_{operation}"
+        if key not in cache:
+            # water years are built from the monthly grids; only water years with every day present are kept
+            monthly_labels = water_year_labels(monthly_sum['time'].values)
+            keep_labels = complete_labels(times, water_year_labels)
+            water_year_sum = _reduce_by_labels(monthly_sum, monthly_labels, 'water_year', keep_labels, 'sum')
+            if operation == 'sum':
+                cache[key] = water_year_sum
+            else:
+                water_year_count = _reduce_by_labels(monthly_count, monthly_labels, 'water_year', keep_labels, 'sum')
+                cache[key] = water_year_sum / water_year_count.where(water_year_count > 0)
+        return cache[key]
+
+    results = {}
+    for summary_type in summary_types:
+        operation = summary_type.split('_')[-1]
+        match summary_type:
+            case 'monthly_sum' | 'monthly_mean':
+                result_dataset = monthly(operation)
+            case 'mean_monthly_sum' | 'mean_monthly_mean':
+                result_dataset = monthly(operation).groupby("time.month").reduce(np.nanmean, dim="time")
+            case 'annual_sum' | 'annual_mean':
+                result_dataset = annual(operation)
+            case 'mean_annual_sum' | 'mean_annual_mean':
+                result_dataset = annual(operation).reduce(np.nanmean, dim="time")
+            case 'water_year_sum' | 'water_year_mean':
+                result_dataset = water_year(operation)
+            case 'mean_water_year_sum' | 'mean_water_year_mean':
+                result_dataset = water_year(operation).reduce(np.nanmean, dim="water_year")
+            case 'seasonal_sum' | 'seasonal_mean':
+                # DJF, MAM, JJA and SON from the monthly grids; as with np.sum and np.mean of the daily values, a
+                # quarter with any missing day is NaN
+                quarter_sum = monthly_sum.resample(time="QS-DEC").reduce(np.sum, dim="time")
+                quarter_count = monthly_count.resample(time="QS-DEC").reduce(np.sum, dim="time")
+                quarter_days = monthly_days.resample(time="QS-DEC").sum()
+                result_dataset = quarter_sum.where(quarter_count == quarter_days)
+                if operation == 'mean':
+                    result_dataset = result_dataset / quarter_days
+            case _:
+                basetype = summary_type.rsplit('_', 1)[0]
+                period_name = basetype[len('mean_'):] if basetype.startswith('mean_') else basetype
+                if period_name not in season_names:
+                    print(f"unknown calculation_type '{summary_type}'")
+                    exit(1)
+                # user-defined seasons; only complete seasons are included, as in 'summarize_by_labels'
+                result_dataset = _season_dataset(season_totals[period_name],
+                                                 complete_labels(times, season_label_functions[period_name]),
+                                                 operation, dims, coords, variable_name, dtype)
+                if basetype.startswith('mean_'):
+                    result_dataset = result_dataset.reduce(np.nanmean, dim='year')
+
+        results[summary_type] = assign_crs(result_dataset.copy(), crs)
+
+    return results
+
+# the statistics of each zone written to the zonal tables, as calculated by xrspatial's zonal.stats; the
+# 'majority' (most frequent value) of each zone is costly to find, and is only calculated when asked for
+ZONAL_STATISTICS = ['mean', 'max', 'min', 'sum', 'std', 'var', 'count']
+OPTIONAL_ZONAL_STATISTICS = ['majority']
+
+def build_zone_index(zones, valid=None):
+    """Flatten a zone grid once and group its cells by zone.
+
+    Args:
+        zones (numpy array): 2D grid of integer zone numbers
+        valid (numpy array): optional 2D boolean grid; cells that are False (no zone assigned) are left out
+
+    Returns:
+        dict: 'zone_ids' (sorted unique zone numbers), 'cell_order' (flat cell indices, grouped by zone) and
+              'zone_starts' (position in 'cell_order' at which the cells of each zone begin)
     """
+    flat_zones = np.asarray(zones).ravel()
+    if valid is None:
+        cells = np.arange(flat_zones.size)
+    else:
+        cells = np.flatnonzero(np.asarray(valid).ravel())
+    cell_order = cells[np.argsort(flat_zones[cells], kind='stable')]
+    zone_ids, zone_starts = np.unique(flat_zones[cell_order], return_index=True)
+    return {'zone_ids': zone_ids, 'cell_order': cell_order, 'zone_starts': zone_starts}
 
-    # idea here is that if there is a time series of grids, the 'time' dimension should be present, and
-    # the shape should be ('time', 'y', 'x'). if we are summarizing a 'mean annual sum' grid, no 'time'
-    # dimension will be present.
+def _zonal_majority(values, valid, zone_starts):
+    # smallest of the most frequent values in each zone, for each row of 'values'; this matches the
+    # 'majority' statistic calculated by xrspatial (np.unique followed by np.argmax)
+    n_rows, n_cells = values.shape
+    n_zones = len(zone_starts)
+    majority = np.full(n_rows * n_zones, np.nan)
+    if not valid.any():
+        return majority.reshape(n_rows, n_zones)
 
-    dims = list(xarray_dataarray.dims)
+    zone_of_cell = np.repeat(np.arange(n_zones), np.diff(np.append(zone_starts, n_cells)))
+    group = (np.arange(n_rows)[:, None] * n_zones + zone_of_cell[None, :])[valid]
+
+    # a single integer key orders the valid cells by (row, zone, value); each distinct key is one run
+    # of equal values within a zone, so counting keys gives the frequency of every value in every zone
+    if values.dtype.itemsize <= 4:
+        # adding zero turns -0.0 into 0.0, which np.unique treats as equal; the bit pattern of each float32 is
+        # then mapped to an unsigned integer with the same ordering and packed below the group number
+        bits = (values[valid].astype(np.float32) + np.float32(0)).view(np.uint32).astype(np.uint64)
+        bits = np.where(bits & 0x80000000, ~bits & 0xFFFFFFFF, bits | 0x80000000)
+        keys, run_lengths = np.unique((group.astype(np.uint64) << np.uint64(32)) | bits, return_counts=True)
+        run_groups = (keys >> np.uint64(32)).astype(np.int64)
+        run_bits = keys & np.uint64(0xFFFFFFFF)
+        run_bits = np.where(run_bits & 0x80000000, run_bits & 0x7FFFFFFF, ~run_bits & 0xFFFFFFFF)
+        run_values = run_bits.astype(np.uint32).view(np.float32)
+    else:
+        unique_values, value_rank = np.unique(values[valid], return_inverse=True)
+        keys, run_lengths = np.unique(group * len(unique_values) + value_rank.ravel(), return_counts=True)
+        run_groups = keys // len(unique_values)
+        run_values = unique_values[keys % len(unique_values)]
+
+    # order runs by group, then longest run first, then smallest value first; keep the first run of each group
+    best = np.lexsort((np.arange(len(keys)), -run_lengths, run_groups))
+    first = np.unique(run_groups[best], return_index=True)[1]
+    majority[run_groups[best][first]] = run_values[best][first]
+    return majority.reshape(n_rows, n_zones)
+
+def calculate_zonal_statistics_arrays(values, zone_index, block_size=24, statistics=None):
+    """Calculate zonal statistics for every zone and every grid in a stack of grids using array operations.
+
+    Cells are reordered once so that the cells belonging to each zone are contiguous; each statistic is then
+    a single 'reduceat' over the zone segments of a block of timesteps. Non-finite values are ignored.
+
+    Args:
+        values (numpy array): grid values, shaped (n_grids, n_cells) or (n_cells,); n_cells is the number of cells in
+                              the whole grid, not just those assigned to a zone
+        zone_index (dict): zone index, as returned by 'build_zone_index'
+        block_size (int): number of grids processed at once; bounds the memory used by temporary arrays
+        statistics (list): statistics to return, from ZONAL_STATISTICS and OPTIONAL_ZONAL_STATISTICS; those in
+                           ZONAL_STATISTICS if None
+
+    Returns:
+        dict: array of shape (n_grids, n_zones) for each statistic requested; 'count' is an integer array (0 for a
+              zone with no values), and the other statistics are NaN for a zone with no values
+    """
+    values = np.atleast_2d(values)
+    cell_order = zone_index['cell_order']
+    zone_starts = zone_index['zone_starts']
+    zone_sizes = np.diff(np.append(zone_starts, len(cell_order)))
+
+    statistics = ZONAL_STATISTICS if statistics is None else statistics
+    results = {stat: [] for stat in ZONAL_STATISTICS + OPTIONAL_ZONAL_STATISTICS}
+
+    for start in range(0, values.shape[0], block_size):
+        block_values = values[start:start + block_size][:, cell_order]
+        block = block_values.astype(np.float64)
+        valid = np.isfinite(block)
+
+        count = np.add.reduceat(valid, zone_starts, axis=1)
+        total = np.add.reduceat(np.where(valid, block, 0.), zone_starts, axis=1)
+        has_values = count > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(has_values, total / count, np.nan)
+            deviation = np.where(valid, block - np.repeat(mean, zone_sizes, axis=1), 0.)
+            var = np.where(has_values, np.add.reduceat(deviation**2, zone_starts, axis=1) / count, np.nan)
+
+        results['mean'].append(mean)
+        results['max'].append(np.where(has_values, np.maximum.reduceat(np.where(valid, block, -np.inf), zone_starts, axis=1), np.nan))
+        results['min'].append(np.where(has_values, np.minimum.reduceat(np.where(valid, block, np.inf), zone_starts, axis=1), np.nan))
+        results['sum'].append(np.where(has_values, total, np.nan))
+        results['std'].append(np.sqrt(var))
+        results['var'].append(var)
+        results['count'].append(count.astype(np.int64))
+        # the majority is by far the most costly statistic, so it is only calculated when asked for
+        if 'majority' in statistics:
+            results['majority'].append(_zonal_majority(block_values, valid, zone_starts))
+
+    return {stat: np.concatenate(results[stat], axis=0) for stat in statistics}
+
+def zonal_statistics_table(statistics, zone_ids, dims, coords, num_zone_chars=None, summary_type=None):
+    """Arrange zonal statistics calculated from a stack of grids as a table, with one row per zone (and per time,
+    month, water year or season year of the grids) and one column per statistic.
 
-    if ('time' in dims or 'month' in dims):
-        for i in range(xarray_dataarray.shape[0]):
-            df = xrs.zonal.stats(zones=mask_dataarray, values=xarray_dataarray[i,:,:])
-            if 'time' in dims:
-                t = xarray_dataarray['time'][i].values
-                year=pd.to_datetime(t).year
-                month=pd.to_datetime(t).month
-            elif 'month' in dims:
-                year = np.nan
-                month = xarray_dataarray['month'][i].values
+    Args:
+        statistics (dict): array of shape (n_grids, n_zones) for each statistic
+        zone_ids (numpy array): zone numbers, in the order of the columns of each array
+        dims (tuple): dimensions of the grids; a leading non-spatial dimension labels the rows of each array
+        coords (dict): coordinates of the grids
+        num_zone_chars (int): width to which zone labels are zero-padded
+        summary_type (str): summary type of the grids; monthly grids are dated the 15th of the month and annual
+                            grids June 1, otherwise grids along 'time' are dated by their time coordinate
+
+    Returns:
+        Pandas dataframe: 'zone', the statistics and the label columns ('year', 'month', 'date' and 'water_year'
+                          for a 'time' dimension, otherwise one named for the dimension)
+    """
+    n_grids = next(iter(statistics.values())).shape[0]
+    n_zones = len(zone_ids)
+    zone_table = pd.DataFrame({'zone': np.tile(zone_ids, n_grids)})
+    for name, value in statistics.items():
+        zone_table[name] = np.asarray(value).ravel()
+
+    # if there is a time series of grids, the leading dimension labels them; a 'mean annual sum' grid (for
+    # example) has no such dimension, and no meaningful timestamp, year or month
+    label_name = dims[0] if len(dims) == 3 else None
+    if label_name is not None:
+        labels = np.repeat(np.asarray(coords[label_name].values), n_zones)
+    match label_name:
+        case 'time':
+            times = pd.DatetimeIndex(labels)
+            year = np.asarray(times.year, dtype=np.int64)
+            month = np.asarray(times.month, dtype=np.int64)
             match summary_type:
                 case 'monthly_sum' | 'monthly_mean':
-                    df['month'] = month
-                    df['year'] = year
-                    df['date'] = dt.datetime.strptime(f"{year}-{month}-15", "%Y-%m-%d")
-                    df['water_year'] = df['year'].where(df['month'] < 10, df['year'] + 1)
-                case 'mean_monthly_sum' | 'mean_monthly_mean':
-                    # no 'year' or 'date' element, since this should summarize all values for a given month
-                    df['month'] = month
+                    dates = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': 15}))
                 case 'annual_sum' | 'annual_mean':
-                    df['month'] = 6
-                    df['year'] = year
-                    df['date'] = dt.datetime.strptime(f"{year}-06-01", "%Y-%m-%d")
-                    df['water_year'] = df['year'].where(df['month'] < 10, df['year'] + 1)
-                case 'mean_annual_sum' | 'mean_annual_mean':
-                    pass
-                    # for mean annual calculations there is no meaningful timestamp, year, or month value
+                    month = np.full_like(month, 6)
+                    dates = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': 1}))
                 case _:
-                    print(f"unknown calculation_type '{summary_type}'")
-                    exit(1) 
+                    dates = pd.Series(times)
+            zone_table['month'] = month
+            zone_table['year'] = year
+            zone_table['date'] = dates.to_numpy()
+            zone_table['water_year'] = water_year_labels(dates).astype(np.int64)
+        case 'month':
+            # no 'year' or 'date' element, since this should summarize all values for a given month
+            zone_table['month'] = labels
+        case 'water_year' | 'year':
+            # water year summaries, and user-defined season summaries (the year in which each season ends)
+            zone_table[label_name] = labels.astype(np.int64)
+        case None:
+            pass
+        case _:
+            zone_table[label_name] = labels
 
-            #df['zone'] = df['zone']
+    # convert zone labels to string, prepend '0' if desired
+    zone_table['zone'] = zone_table['zone'].apply(str)
+    if num_zone_chars is not None:
+        zone_table['zone'] = zone_table['zone'].apply(lambda x: f"{x:0>{num_zone_chars}}")
+    return zone_table
 
-            if i == 0:
-                zonal_stats = df.copy()
-            else:
-                zonal_stats = pd.concat([zonal_stats, df])
+def calculate_zonal_statistics(xarray_dataarray, mask_dataarray, summary_type='none', num_zone_chars=10, zone_index=None,
+                               majority=False):
+    """
+    Calculate zonal statistics for each of the grids in a xarray dataarray. It is assumed that this dataarray has
+    already been summarized by resampling to a monthly or annual timestep. Zonal statistics are calculated for each
+    of the distinct zone numbers contained in the zone mask file; all grids are processed together with array
+    operations (see 'calculate_zonal_statistics_arrays'), and labeled as in 'zonal_statistics_table'. The statistics
+    are those in ZONAL_STATISTICS, and the 'majority' of each zone as well if 'majority' is True.
+    """
 
+    # idea here is that if there is a time series of grids, the 'time' dimension should be present, and
+    # the shape should be ('time', 'y', 'x'). if we are summarizing a 'mean annual sum' grid, no 'time'
+    # dimension will be present.
+
+    # a precomputed zone index (see zone_index_functions) saves regrouping the mask cells on every call
+    if zone_index is None:
+        zone_index = build_zone_index(np.asarray(mask_dataarray))
+
+    dims = list(xarray_dataarray.dims)
+
+    if ('time' in dims or 'month' in dims or 'water_year' in dims or 'year' in dims):
+        n_grids = xarray_dataarray.shape[0]
     else:
-        zonal_stats = xrs.zonal.stats(zones=mask_dataarray, values=xarray_dataarray)
+        n_grids = 1
 
-    # convert zone labels to string, prepend '0' if desired
-    #zonal_stats['zone'] = fix_zone_labels(zonal_stats['zone'], num_zone_chars)
-    zonal_stats['zone'] = zonal_stats['zone'].apply(str)
-    if num_zone_chars is not None:
-        zonal_stats['zone'] = zonal_stats['zone'].apply(lambda x: f"{x:0>{num_zone_chars}}")
+    statistics = ZONAL_STATISTICS + (['majority'] if majority else [])
+    stats = calculate_zonal_statistics_arrays(np.asarray(xarray_dataarray).reshape(n_grids, -1), zone_index,
+                                              statistics=statistics)
 
-    return zonal_stats
+    return zonal_statistics_table({stat: stats[stat] for stat in statistics}, zone_index['zone_ids'],
+                                  dims, xarray_dataarray.coords, num_zone_chars, summary_type=summary_type)
@@ -0,0 +1,248 @@
+import logging
+from pathlib import Path
+from utility_functions import read_growing_season_from_template
+import make_summary_dataset as sd
+import zone_index_functions as zi
+import zonal_stats_store_functions as zs
+import executor_functions as xf
+
+"""
+Functions used to turn cataloged swb output files into summary tasks and to store what the tasks return. They are
+shared by outputrunner, which summarizes every selected file once all simulations are done, and by modelrunner's
+pipeline mode, which summarizes the output of each simulation as soon as it finishes.
+"""
+
+# summary grids are named for their summary type and the parts of the name of the swb output file they summarize:
+#   summary_type__scenario_name__weather_data_name__swb_variable_name__time_period__spatial_coverage.nc
+SUMMARY_GRID_FIELDS = ['summary_type', 'scenario_name', 'weather_data_name', 'swb_variable_name', 'time_period',
+                       'spatial_coverage']
+
+logger = logging.getLogger(__name__)
+
+def summary_grid_filename(summary_type, scenario_name, weather_data_name, swb_variable_name, time_period,
+                          spatial_coverage):
+    """Return the file name of a summary grid."""
+    return f"{summary_type}__{scenario_name}__{weather_data_name}__{swb_variable_name}__{time_period}__{spatial_coverage}.nc"
+
+def parse_summary_grid_filename(nc_filename):
+    """Split the file name of a summary grid into its parts.
+
+    Returns:
+        dict: the parts named in 'SUMMARY_GRID_FIELDS', or None if the name does not follow the naming convention
+    """
+    name = Path(nc_filename).name
+    if not name.endswith('.nc'):
+        return None
+    parts = name[:-len('.nc')].split('__')
+    if len(parts) != len(SUMMARY_GRID_FIELDS) or not all(parts):
+        return None
+    return dict(zip(SUMMARY_GRID_FIELDS, parts))
+
+def find_summary_grids(grid_stats_dir):
+    """Return the parts of the name of every summary grid in a directory, along with its 'path'."""
+    summary_grids = []
+    for nc_filename in sorted(Path(grid_stats_dir).glob('*.nc')):
+        fields = parse_summary_grid_filename(nc_filename)
+        if fields is not None:
+            summary_grids.append({**fields, 'path': nc_filename})
+    return summary_grids
+
+def read_summary_settings(run_control_dict, output_control_dict, base_dir, make_tifs=False):
+    """Gather the settings needed to summarize swb output from the run and output control files, creating the
+    output directories and the zone index along the way.
+
+    Args:
+        run_control_dict (dict): contents of the run control file
+        output_control_dict (dict): contents of the output control file
+        base_dir (Path): path to the git repo that holds these scripts; input paths are relative to it
+        make_tifs (bool): also write a cloud-optimized tif image for each summary grid
+
+    Returns:
+        dict: settings passed to 'make_summary_task' and 'collect_results'
+    """
+    top_level_dir = Path(run_control_dict['working_directories']['top_level_dir'])
+    gridded_data_dir = base_dir / run_control_dict['data_directories']['swb_gridded_data_dir']
+    templates_dir = base_dir / run_control_dict['data_directories']['swb_templates_dir']
+
+    data_summary_dir = top_level_dir / run_control_dict['working_directories']['data_summary_dir']
+    logger.info(f"creating directory to hold output statistics at {data_summary_dir}.")
+    data_summary_dir.mkdir(parents=True, exist_ok=True)
+
+    grid_stats_dir = top_level_dir / run_control_dict['working_directories']['grid_stats_dir']
+    logger.info(f"creating directory to hold output grids at {grid_stats_dir}.")
+    grid_stats_dir.mkdir(parents=True, exist_ok=True)
+
+    tif_image_dir = top_level_dir / run_control_dict['working_directories']['tif_image_dir']
+    logger.info(f"creating directory to hold output tif images at {tif_image_dir}.")
+    tif_image_dir.mkdir(parents=True, exist_ok=True)
+
+    summary_types = output_control_dict['scenarios_and_periods']['summary_types']
+
+    # user-defined seasons (by day of year) that may be used as summary types; a season given as a
+    # 'template_file' takes its days from the GROWING_SEASON line of that swb2 control file template
+    seasons = {}
+    for season_name, season in output_control_dict.get('seasons', {}).items():
+        if 'template_file' in season:
+            start_and_end = read_growing_season_from_template(templates_dir / season['template_file'])
+            if start_and_end is None:
+                logger.warning(f"no GROWING_SEASON day of year range found in {season['template_file']}; season '{season_name}' skipped")
+                continue
+            season = {'start_doy': start_and_end[0], 'end_doy': start_and_end[1]}
+        seasons[season_name] = season
+
+    # zonal statistics may be written to a partitioned Parquet store, to csv files, or both
+    zonal_stats_output = output_control_dict.get('zonal_stats_output', {})
+
+    # define a zone file
+    zone_filename = output_control_dict['input_grids']['zone_mask_file']
+    zone_path = str(Path(gridded_data_dir).resolve() / zone_filename)
+
+    # build (or refresh) the cached zone index once, before any task needs it, so that workers only
+    # ever memory-map it rather than each parsing the mask grid
+    zi.load_zone_index(zone_path, zonal_stats_output.get('nodata_zone', True))
+
+    return {'weather_data_names': output_control_dict['scenarios_and_periods']['weather_data_names'],
+            'scenario_names': output_control_dict['scenarios_and_periods']['scenario_names'],
+            'summary_types': summary_types,
+            'grid_vars': output_control_dict['variables']['grid_vars'],
+            'seasons': seasons,
+            'project_crs': output_control_dict['geospatial']['project_crs'],
+            'data_summary_dir': data_summary_dir,
+            'grid_stats_dir': grid_stats_dir,
+            'tif_image_dir': tif_image_dir if make_tifs else None,
+            # GDAL creation options (tile size, compression, overviews) for the tif images
+            'geotiff_options': output_control_dict.get('geotiff_output', {}),
+            # compression, data type and chunking of the summary grids written to the grid statistics directory
+            'netcdf_encodings': output_control_dict.get('netcdf_output', {}),
+            'zonal_stats_formats': zonal_stats_output.get('formats', ['parquet']),
+            'zonal_stats_store_dir': data_summary_dir / zonal_stats_output.get('store_dir', 'zonal_stats_store'),
+            'zonal_stats_csv_output_paths': {summary_basetype: data_summary_dir / f"{summary_basetype}_sum_zonal_stats.csv"
+                                             for summary_basetype in summary_types},
+            'zone_path': zone_path,
+            # summarize the cells where the zone mask is nodata as a zone of their own
+            'nodata_zone': zonal_stats_output.get('nodata_zone', True),
+            # add the costly 'majority' (most frequent value) of each zone to the zonal statistics
+            'zonal_majority': zonal_stats_output.get('majority', False),
+            'execution': output_control_dict.get('execution', {})}
+
+def make_summary_task(output_file, settings):
+    """Describe the summary task for one cataloged swb output file. The file is read once, and all of the requested
+    summary types are calculated from it within the task; the summary grids are written by the worker, and only
+    the zonal statistics come back.
+
+    Args:
+        output_file (dict): catalog entry of the file, as returned by 'catalog_functions.select_output_files'
+        settings (dict): as returned by 'read_summary_settings'
+
+    Returns:
+        tuple: keyword arguments for 'make_summary_dataset.write_spatial_statistics_multi', and the details needed
+               to store its result; None if the file is not among those selected for summary
+    """
+    file = Path(output_file['path'])
+    scenario_name = output_file['scenario_name']
+    weather_data_name = output_file['weather_data_name']
+    short_time_period = output_file['short_time_period']
+    swb_variable_name = output_file['swb_variable_name']
+    time_period = output_file['time_period']
+    spatial_coverage = output_file['spatial_coverage']
+
+    if not ((swb_variable_name in settings['grid_vars'])
+              and (scenario_name in settings['scenario_names'])
+              and (weather_data_name in settings['weather_data_names'])):
+        return None
+
+    logger.info(f"  munging data for weather_data_name: {weather_data_name};  time period: {short_time_period}; simulation name: {scenario_name}; ==> {swb_variable_name}.")
+    logger.info(f"    filename: {file.name}")
+
+    variable_operation = 'sum'
+    if (swb_variable_name=='tmin' or swb_variable_name=='tmax' or swb_variable_name=='soil_storage'):
+        variable_operation = 'mean'
+
+    output_grid_names = {}
+    for summary_basetype in settings['summary_types']:
+        summary_type = f"{summary_basetype}_{variable_operation}"
+        output_grid_names[summary_type] = settings['grid_stats_dir'] / summary_grid_filename(summary_type, scenario_name,
+                                                                                             weather_data_name,
+                                                                                             swb_variable_name,
+                                                                                             time_period,
+                                                                                             spatial_coverage)
+
+    task_kwargs = dict(netcdf_filename=file,
+                       mask_filename=settings['zone_path'],
+                       scenario_name=scenario_name,
+                       variable_name=swb_variable_name,
+                       weather_data_name=weather_data_name,
+                       summary_types=list(output_grid_names.keys()),
+                       output_grid_names=output_grid_names,
+                       zone_char_width=2,
+                       crs=settings['project_crs'],
+                       tif_image_dir=settings['tif_image_dir'],
+                       time_period=short_time_period,
+                       seasons=settings['seasons'],
+                       geotiff_options=settings['geotiff_options'],
+                       netcdf_encodings=settings['netcdf_encodings'],
+                       nodata_zone=settings['nodata_zone'],
+                       majority=settings['zonal_majority'])
+    return task_kwargs, {'variable_operation': variable_operation,
+                         'part_name': f"{time_period}__{spatial_coverage}",
+                         'netcdf_filename': file}
+
+def submit_summary_task(executor, futures, task_kwargs, details):
+    """Submit a summary task to an executor, recording its details in 'futures'."""
+    future = executor.submit(sd.write_spatial_statistics_multi, **task_kwargs)
+    futures[future] = details
+    return future
+
+def write_task_results(results, details, settings, csv_started):
+    """Append the zonal statistics returned by one summary task to the store and/or csv files. 'csv_started' holds
+    the summary types whose csv file has been started (and so already has a header)."""
+    for summary_basetype in settings['summary_types']:
+        grid_metadata, result_zonal_stat = results[f"{summary_basetype}_{details['variable_operation']}"]
+
+        if 'parquet' in settings['zonal_stats_formats']:
+            zs.append_zonal_stats(result_zonal_stat,
+                                  store_dir=settings['zonal_stats_store_dir'],
+                                  summary_type=f"{summary_basetype}_{details['variable_operation']}",
+                                  part_name=details['part_name'])
+
+        if 'csv' in settings['zonal_stats_formats']:
+            result_zonal_stat.to_csv(settings['zonal_stats_csv_output_paths'][summary_basetype],
+                                     mode='a' if summary_basetype in csv_started else 'w',
+                                     sep=",",
+                                     index=False,
+                                     header=summary_basetype not in csv_started,
+                                     na_rep=-999999)
+            csv_started.add(summary_basetype)
+
+        logger.info(f"  ...wrote {grid_metadata['output_grid_name']}")
+
+def collect_results(futures, settings, csv_started, wait=True, raise_errors=True):
+    """Store the results of finished summary tasks, removing them from 'futures'. Zonal statistics are appended as
+    each task finishes, so that the memory used here does not grow with the number of files processed.
+
+    Args:
+        futures (dict): details of each submitted task, keyed by its future
+        settings (dict): as returned by 'read_summary_settings'
+        csv_started (set): summary types whose csv file has been started
+        wait (bool): wait for every task to finish; otherwise only tasks already finished are collected
+        raise_errors (bool): raise the error of a failed task; otherwise it is logged and the task dropped
+
+    Returns:
+        int: number of tasks collected
+    """
+    finished = list(futures) if wait else [future for future in futures if future.done()]
+    if not finished:
+        return 0
+    for future in xf.as_completed(finished):
+        details = futures.pop(future)
+        try:
+            results = future.result()
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.error(f"  summary of {details['netcdf_filename']} failed: {e}")
+            continue
+        write_task_results(results, details, settings, csv_started)
+        logger.info(f"  ...finished with task: {future}")
+        xf.release(future)
+    return len(finished)
@@ -0,0 +1,99 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+"""
+Functions used to generate synthetic swb2 output for benchmarking: daily netCDF files named as swb2 names its
+output, and a matching zone mask grid in Arc ASCII format. Values are random but plausible (ex. precipitation is
+zero on most days, air temperatures follow the seasons), so that compression and the summary calculations behave
+much as they do on real output.
+"""
+
+# variables whose synthetic values look like air temperatures (degrees F); every other variable looks like a
+# daily flux (inches)
+TEMPERATURE_VARIABLES = ['tmax', 'tmin']
+
+def output_filename(scenario_name, weather_data_name, variable_name, start_date, end_date, nrows, ncols):
+    """Return the name swb2 gives an output file:
+
+      scenario_name__weather_data_name__short_time_period__swb_variable_name__time_period__spatial_coverage.nc
+    """
+    start_date = pd.Timestamp(start_date)
+    end_date = pd.Timestamp(end_date)
+    return (f"{scenario_name}__{weather_data_name}__{start_date.year}-{end_date.year}__{variable_name}__"
+            f"{start_date:%Y-%m-%d}_to_{end_date:%Y-%m-%d}__{ncols}_by_{nrows}.nc")
+
+def grid_coordinates(nrows, ncols, cellsize=1000.0, xllcorner=0.0, yllcorner=0.0):
+    """Return the cell-center x and y coordinates of a grid; y decreases from the top row, as in an ASCII grid."""
+    x = xllcorner + cellsize * (np.arange(ncols) + 0.5)
+    y = yllcorner + cellsize * (np.arange(nrows)[::-1] + 0.5)
+    return x, y
+
+def make_daily_dataset(variable_name, start_date, end_date, nrows, ncols, cellsize=1000.0, seed=0):
+    """Create a daily dataset of synthetic values for one swb2 variable.
+
+    Returns:
+        xarray dataset: 'variable_name' (float32), with 'time', 'y' and 'x' coordinates
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start_date, end_date, freq='D')
+    x, y = grid_coordinates(nrows, ncols, cellsize)
+
+    if variable_name in TEMPERATURE_VARIABLES:
+        seasonal = 45.0 - 30.0 * np.cos(2.0 * np.pi * (times.dayofyear.values - 15) / 365.25)
+        offset = 10.0 if variable_name == 'tmax' else -10.0
+        values = (seasonal[:, None, None] + offset
+                  + rng.normal(0.0, 6.0, size=(len(times), nrows, ncols))).astype('float32')
+    else:
+        wet = rng.random(size=(len(times), nrows, ncols)) < 0.3
+        values = np.where(wet, rng.gamma(0.8, 0.25, size=(len(times), nrows, ncols)), 0.0).astype('float32')
+
+    return xr.Dataset({variable_name: (('time', 'y', 'x'), values)},
+                      coords={'time': times, 'y': y, 'x': x})
+
+def write_output_file(output_dir, scenario_name, weather_data_name, variable_name, start_date, end_date,
+                      nrows, ncols, cellsize=1000.0, seed=0):
+    """Write a synthetic daily swb2 output file to 'output_dir'; returns the file name."""
+    filename = Path(output_dir) / output_filename(scenario_name, weather_data_name, variable_name,
+                                                  start_date, end_date, nrows, ncols)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    dataset = make_daily_dataset(variable_name, start_date, end_date, nrows, ncols, cellsize, seed)
+    dataset.to_netcdf(filename)
+    return filename
+
+def make_zone_mask(nrows, ncols, n_zones, nodata_fraction=0.05, seed=0):
+    """Create a zone grid with 'n_zones' irregular zones (each cell takes the zone of the nearest of 'n_zones'
+    random points), numbered from 1. Cells along the grid border, about 'nodata_fraction' of the grid, are left
+    without a zone.
+
+    Returns:
+        numpy array: zone of each cell, or -9999 where there is none
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.random(size=(n_zones, 2)) * [nrows, ncols]
+    rows, cols = np.mgrid[0:nrows, 0:ncols]
+    zones = np.empty((nrows, ncols), dtype='int32')
+    # assign cells to zones one block of rows at a time to bound memory use on large grids
+    block_rows = max(1, 2**22 // max(ncols * n_zones, 1))
+    for start in range(0, nrows, block_rows):
+        block = slice(start, start + block_rows)
+        distance = ((rows[block, :, None] - centers[:, 0])**2 + (cols[block, :, None] - centers[:, 1])**2)
+        zones[block] = np.argmin(distance, axis=2) + 1
+
+    border = int(round(min(nrows, ncols) * nodata_fraction / 4))
+    if border > 0:
+        zones[:border, :] = zones[-border:, :] = -9999
+        zones[:, :border] = zones[:, -border:] = -9999
+    return zones
+
+def write_zone_mask(filename, zones, cellsize=1000.0, xllcorner=0.0, yllcorner=0.0):
+    """Write a zone grid as an Arc ASCII grid."""
+    nrows, ncols = zones.shape
+    header = (f"ncols {ncols}\nnrows {nrows}\nxllcorner {xllcorner}\nyllcorner {yllcorner}\n"
+              f"cellsize {cellsize}\nNODATA_value -9999\n")
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    with open(filename, 'w') as f:
+        f.write(header)
+        np.savetxt(f, zones, fmt='%d')
+    return filename
@@ -7,3 +7,16 @@ def read_toml_file(filename):
   with open(filename, "rb") as f:
     toml_dict = tomli.load(f)
     return toml_dict
+
+def read_growing_season_from_template(filename):
+  """Return the (start_doy, end_doy) pair given on the GROWING_SEASON line of a swb2 control file
+  or template, or None if the file has no such line defined by day of year."""
+  with open(filename) as f:
+    for line in f:
+      fields = line.split()
+      if len(fields) >= 3 and fields[0].upper() == 'GROWING_SEASON':
+        try:
+          return int(fields[1]), int(fields[2])
+        except ValueError:
+          return None
+  return None
@@ -0,0 +1,86 @@
+import os
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+"""
+Functions used to keep zonal statistics in a Parquet dataset, partitioned (hive style) by summary type,
+scenario, weather driver and variable:
+
+  store_dir/summary_type=annual_sum/scenario_name=ssp245/weather_data_name=cesm2/swb_variable_name=runoff/<part>.parquet
+
+Each Dask task's zonal statistics are written as one new file, so appending never rewrites existing data;
+writing a part with the same name again replaces it. Reads can select columns and partitions, and filter rows
+(for example, on zone) without parsing every row of every run.
+"""
+
+PARTITION_COLUMNS = ['summary_type', 'scenario_name', 'weather_data_name', 'swb_variable_name']
+
+def _partitioning():
+    # every partition value is read back as a string, even those that look like numbers
+    return ds.HivePartitioning(pa.schema([(column, pa.string()) for column in PARTITION_COLUMNS[1:]]))
+
+def partition_filename(store_dir, summary_type, scenario_name, weather_data_name, swb_variable_name, part_name):
+    """Return the name of the file that holds one part of a partition of the store."""
+    return (Path(store_dir) / f"summary_type={summary_type}" / f"scenario_name={scenario_name}"
+            / f"weather_data_name={weather_data_name}" / f"swb_variable_name={swb_variable_name}"
+            / f"{part_name}.parquet")
+
+def append_zonal_stats(zonal_stats_df, store_dir, summary_type, part_name):
+    """Add a dataframe of zonal statistics to the store.
+
+    Args:
+        zonal_stats_df (Pandas dataframe): zonal statistics, including 'scenario_name', 'weather_data_name'
+                                           and 'swb_variable_name' columns
+        store_dir (Path): top-level directory of the store
+        summary_type (str): summary type of the statistics (ex. 'annual_sum')
+        part_name (str): name of the file written within each partition (ex. the time period); must be unique
+                         for each set of results written to a partition
+    """
+    for (scenario_name, weather_data_name, swb_variable_name), group_df in zonal_stats_df.groupby(PARTITION_COLUMNS[1:]):
+        part_filename = partition_filename(store_dir, summary_type, scenario_name, weather_data_name,
+                                           swb_variable_name, part_name)
+        part_filename.parent.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pandas(group_df.drop(columns=PARTITION_COLUMNS[1:]), preserve_index=False)
+        tmp_filename = part_filename.with_name(f".{part_name}.parquet.tmp")
+        pq.write_table(table, tmp_filename)
+        os.replace(tmp_filename, part_filename)
+
+def read_zonal_stats(store_dir, summary_type, columns=None, scenario_names=None, weather_data_names=None,
+                     swb_variable_names=None, zones=None):
+    """Read zonal statistics for one summary type from the store.
+
+    Args:
+        store_dir (Path): top-level directory of the store
+        summary_type (str): summary type to read (ex. 'annual_sum')
+        columns (list): columns to read; all columns if None
+        scenario_names, weather_data_names, swb_variable_names (list): partitions to read; all if None
+        zones (list): zone labels to read; all if None
+
+    Returns:
+        Pandas dataframe: the selected zonal statistics; empty if the store holds none for this summary type
+    """
+    summary_dir = Path(store_dir) / f"summary_type={summary_type}"
+    if not summary_dir.is_dir():
+        return pd.DataFrame(columns=columns)
+
+    dataset = ds.dataset(summary_dir, format='parquet', partitioning=_partitioning(), exclude_invalid_files=True)
+
+    selections = {'scenario_name': scenario_names,
+                  'weather_data_name': weather_data_names,
+                  'swb_variable_name': swb_variable_names,
+                  'zone': zones}
+    row_filter = None
+    for column, values in selections.items():
+        if values is not None:
+            expression = ds.field(column).isin([str(value) for value in values])
+            row_filter = expression if row_filter is None else row_filter & expression
+
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+def export_zonal_stats_csv(store_dir, summary_type, csv_filename):
+    """Write all of the zonal statistics held in the store for a summary type to a csv file."""
+    zonal_stats_df = read_zonal_stats(store_dir, summary_type)
+    zonal_stats_df.to_csv(csv_filename, sep=",", index=False, header=True, na_rep=-999999)
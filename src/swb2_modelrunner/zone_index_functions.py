@@ -0,0 +1,142 @@
+import errno
+import functools
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from pathlib import Path
+import numpy as np
+import xarray as xr
+import stats_functions as sf
+import grid_cache_functions as gc
+
+"""
+Functions used to build a zone index for a zone mask grid and cache it on disk next to the mask. The index
+holds the sorted zone ids, the cell indices grouped by zone, and a validity mask (cells with a zone assigned).
+It is stored as a directory of uncompressed .npy files so that any process can memory-map it rather than
+re-parsing the ASCII mask grid; an ASCII mask is itself read through the binary grid cache (grid_cache_functions).
+
+Cells where the mask is nodata are, by default, grouped as a zone of their own, numbered with the mask's nodata
+value, so that the zonal statistics hold a row for them as they did when calculated with xrspatial (which
+labeled them with whatever integer the nodata value was cast to). Passing 'nodata_zone=False' leaves them out;
+the two indexes are cached side by side.
+"""
+
+ZONE_INDEX_SUFFIX = '.zone_index'
+ZONE_INDEX_ARRAYS = ['zone_ids', 'cell_order', 'zone_starts', 'valid']
+# zone number given to nodata cells of a mask that does not state its nodata value
+NODATA_ZONE_ID = -9999
+# times an index is read (and, if missing or stale, built) before giving up
+ZONE_INDEX_ATTEMPTS = 3
+
+def zone_index_dir(mask_filename, nodata_zone=True):
+    """Return the name of the directory that holds the cached zone index for a mask file."""
+    if nodata_zone:
+        return Path(f"{mask_filename}{ZONE_INDEX_SUFFIX}")
+    return Path(f"{mask_filename}.valid_zones{ZONE_INDEX_SUFFIX}")
+
+def _source_description(mask_filename):
+    stat_result = os.stat(mask_filename)
+    return {'source': str(Path(mask_filename).resolve()),
+            'size': stat_result.st_size,
+            'mtime': stat_result.st_mtime}
+
+def build_zone_index_from_mask(mask_filename, nodata_zone=True):
+    """Read a zone mask grid and build its zone index. Cells with no zone (nodata) form a zone numbered with the
+    mask's nodata value (NODATA_ZONE_ID if it has none), or are excluded if 'nodata_zone' is False."""
+    if Path(mask_filename).suffix.lower() == '.asc':
+        # read through the binary grid cache rather than parsing the ASCII grid
+        mask_values, description = gc.load_grid(mask_filename)
+        nodata = description['nodata']
+        has_zone = np.isfinite(mask_values)
+        if nodata is not None:
+            has_zone &= (mask_values != nodata)
+    else:
+        mask_dataarray = xr.open_dataarray(mask_filename)[0,:,:]
+        mask_values = mask_dataarray.values
+        nodata = mask_dataarray.encoding.get('_FillValue')
+        has_zone = np.isfinite(mask_values)
+    nodata_id = int(nodata) if nodata is not None and np.isfinite(nodata) else NODATA_ZONE_ID
+    zones = np.where(has_zone, mask_values, nodata_id).astype('int')
+    valid = np.ones(zones.shape, dtype=bool) if nodata_zone else has_zone
+    zone_index = sf.build_zone_index(zones, valid=valid)
+    zone_index['valid'] = valid
+    return zone_index
+
+def write_zone_index(zone_index, mask_filename, nodata_zone=True):
+    """Write a zone index next to its mask file. The arrays are written to a uniquely named temporary directory
+    which is then renamed into place in one step, so that readers never see a partially written index and
+    processes building the same index at once do not remove each other's files. If another process has already
+    put an index in place, that index is kept and this one discarded; an index left from an older mask is first
+    renamed out of the way, then removed."""
+    index_dir = zone_index_dir(mask_filename, nodata_zone)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f"{index_dir.name}.", suffix='.tmp', dir=index_dir.parent))
+    stale_dir = None
+    try:
+        for name in ZONE_INDEX_ARRAYS:
+            np.save(tmp_dir / f"{name}.npy", np.ascontiguousarray(zone_index[name]))
+        description = _source_description(mask_filename)
+        description['shape'] = list(zone_index['valid'].shape)
+        description['nodata_zone'] = nodata_zone
+        with open(tmp_dir / 'source.json', 'w') as f:
+            json.dump(description, f)
+
+        if index_dir.exists() and _read_zone_index(mask_filename, nodata_zone) is None:
+            stale_dir = Path(f"{index_dir}.{uuid.uuid4().hex}.stale")
+            try:
+                os.replace(index_dir, stale_dir)
+            except FileNotFoundError:
+                # another process moved it first
+                stale_dir = None
+        try:
+            os.replace(tmp_dir, index_dir)
+        except OSError as error:
+            if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # another process put the index in place first; it was built from the same mask
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if stale_dir is not None:
+            shutil.rmtree(stale_dir, ignore_errors=True)
+
+def _read_zone_index(mask_filename, nodata_zone=True):
+    index_dir = zone_index_dir(mask_filename, nodata_zone)
+    try:
+        with open(index_dir / 'source.json') as f:
+            description = json.load(f)
+    except (OSError, ValueError):
+        return None
+    current = _source_description(mask_filename)
+    if (any(description.get(key) != current[key] for key in ['size', 'mtime'])
+          or description.get('nodata_zone') != nodata_zone):
+        return None
+    try:
+        return {name: np.load(index_dir / f"{name}.npy", mmap_mode='r') for name in ZONE_INDEX_ARRAYS}
+    except (OSError, ValueError):
+        return None
+
+@functools.lru_cache(maxsize=8)
+def _load_zone_index(mask_filename, size, mtime, nodata_zone):
+    # an index that cannot be read raises rather than returning None, so that a miss is never cached
+    for _ in range(ZONE_INDEX_ATTEMPTS):
+        zone_index = _read_zone_index(mask_filename, nodata_zone)
+        if zone_index is not None:
+            return zone_index
+        write_zone_index(build_zone_index_from_mask(mask_filename, nodata_zone), mask_filename, nodata_zone)
+    raise RuntimeError(f"could not read the zone index of {mask_filename} from "
+                       f"{zone_index_dir(mask_filename, nodata_zone)}")
+
+def load_zone_index(mask_filename, nodata_zone=True):
+    """Return the zone index for a mask file, building and caching it on disk if it is missing or older than the
+    mask. The arrays are memory-mapped, and each process keeps the index for the lifetime of the process.
+
+    Args:
+        mask_filename (str): name of the zone mask grid (ex. an Arc ASCII grid)
+        nodata_zone (bool): include the cells where the mask is nodata, as a zone of their own
+
+    Returns:
+        dict: memory-mapped arrays 'zone_ids', 'cell_order', 'zone_starts' and 'valid'
+    """
+    stat_result = os.stat(mask_filename)
+    return _load_zone_index(str(mask_filename), stat_result.st_size, stat_result.st_mtime, bool(nodata_zone))
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# the scripts in src/swb2_modelrunner import one another as top-level modules ('import stats_functions as sf'),
+# as they do when run from that directory
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'swb2_modelrunner'))
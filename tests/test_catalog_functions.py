@@ -0,0 +1,46 @@
+import shutil
+import numpy as np
+import pandas as pd
+import xarray as xr
+import catalog_functions as cat
+
+def write_output_file(work_dir, simulation_name, swb_variable_name):
+    output_dir = work_dir / simulation_name / 'output'
+    output_dir.mkdir(parents=True, exist_ok=True)
+    filename = output_dir / (f"ssp245__{simulation_name}__2040-2041__{swb_variable_name}__"
+                             f"2040-01-01_to_2041-12-31__3_by_2.nc")
+    times = pd.date_range('2040-01-01', periods=4, freq='D')
+    xr.Dataset({swb_variable_name: (('time', 'y', 'x'), np.zeros((4, 2, 3), dtype='float32'))},
+               coords={'time': times}).to_netcdf(filename)
+    return filename
+
+def cataloged_names(connection):
+    return sorted((entry['weather_data_name'], entry['swb_variable_name'])
+                  for entry in cat.select_output_files(connection))
+
+def test_reconcile_finds_new_removed_and_changed_files(tmp_path, monkeypatch):
+    write_output_file(tmp_path, 'gcm_a', 'runoff')
+    write_output_file(tmp_path, 'gcm_b', 'runoff')
+    connection = cat.open_catalog(tmp_path / cat.CATALOG_FILENAME)
+    cat.catalog_output_files(connection, tmp_path / 'gcm_a' / 'output', 'gcm_a')
+    assert cataloged_names(connection) == [('gcm_a', 'runoff')]
+
+    # a simulation never cataloged by modelrunner, and a file added to a cataloged one
+    write_output_file(tmp_path, 'gcm_a', 'net_infiltration')
+    n_files, n_changes = cat.reconcile_catalog(connection, tmp_path)
+    assert n_files == 3 and n_changes == 2
+    assert cataloged_names(connection) == [('gcm_a', 'net_infiltration'), ('gcm_a', 'runoff'), ('gcm_b', 'runoff')]
+
+    # nothing has changed, so no file is reopened
+    opened = []
+    monkeypatch.setattr(cat, 'read_time_extent', lambda filename: opened.append(filename) or (None, None, 0))
+    assert cat.reconcile_catalog(connection, tmp_path) == (3, 0)
+    assert opened == []
+
+    # a removed file, and a removed simulation
+    (tmp_path / 'gcm_a' / 'output').joinpath(
+        'ssp245__gcm_a__2040-2041__runoff__2040-01-01_to_2041-12-31__3_by_2.nc').unlink()
+    shutil.rmtree(tmp_path / 'gcm_b')
+    assert cat.reconcile_catalog(connection, tmp_path) == (1, 2)
+    assert cataloged_names(connection) == [('gcm_a', 'net_infiltration')]
+    connection.close()
@@ -0,0 +1,26 @@
+import logging
+from pathlib import Path
+import delta_functions as dl
+
+SETTINGS = {'summary_types': ['mean_annual'], 'scenario_names': ['ssp245'], 'weather_data_names': ['gcm_a', 'gcm_b'],
+            'grid_vars': ['runoff']}
+
+def summary_grid(scenario_name, weather_data_name, time_period):
+    name = f"mean_annual_sum__{scenario_name}__{weather_data_name}__runoff__{time_period}__3_by_2.nc"
+    return {'summary_type': 'mean_annual_sum', 'scenario_name': scenario_name, 'weather_data_name': weather_data_name,
+            'swb_variable_name': 'runoff', 'time_period': time_period, 'spatial_coverage': '3_by_2',
+            'path': Path(name)}
+
+def test_duplicate_baselines_are_not_paired(caplog):
+    grids = [summary_grid('historical', 'gcm_a', '1995-01-01_to_2014-12-31'),
+             summary_grid('ssp245', 'gcm_a', '2040-01-01_to_2059-12-31'),
+             # two baselines of the same years for gcm_b
+             summary_grid('historical', 'gcm_b', '1995-01-01_to_2014-12-31'),
+             summary_grid('historical', 'gcm_b', '1995-01-02_to_2014-12-30'),
+             summary_grid('ssp245', 'gcm_b', '2040-01-01_to_2059-12-31')]
+    with caplog.at_level(logging.WARNING, logger='delta_functions'):
+        pairs = dl.pair_summary_grids(grids, SETTINGS)
+
+    assert [(pair['weather_data_name'], pair['baseline_time_period']) for pair in pairs] == \
+           [('gcm_a', '1995-01-01_to_2014-12-31')]
+    assert '2 historical 1995-2014 baselines for mean_annual_sum__gcm_b__runoff__3_by_2' in caplog.text
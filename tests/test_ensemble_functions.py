@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import ensemble_functions as en
+
+def member_grids(n_members):
+    rng = np.random.default_rng(7)
+    return [rng.normal(size=(3, 4)) for _ in range(n_members)]
+
+def summarize_members(members, **reservoir_options):
+    accumulator = en.create_accumulator((3, 4), n_members=len(members), **reservoir_options)
+    for values in members:
+        en.update_accumulator(accumulator, values)
+    return accumulator, en.summarize_accumulator(accumulator, percentiles=[10, 90])
+
+def assert_exact_percentiles(statistics, members):
+    np.testing.assert_allclose(statistics['mean'], np.mean(members, axis=0))
+    for name, percentile in [('median', 50), ('p10', 10), ('p90', 90)]:
+        np.testing.assert_allclose(statistics[name], np.percentile(np.float32(members), percentile, axis=0),
+                                   rtol=1e-6, err_msg=name)
+
+def test_reservoir_is_never_larger_than_the_ensemble():
+    # a small ensemble fits in the reservoir, and its percentiles are exact
+    members = member_grids(5)
+    accumulator, statistics = summarize_members(members, reservoir_size=8)
+    assert accumulator['reservoir'].shape == (5, 3, 4)
+    assert_exact_percentiles(statistics, members)
+
+    # a larger one is sampled, and the memory held stays that of the reservoir
+    members = member_grids(12)
+    accumulator, statistics = summarize_members(members, reservoir_size=8)
+    assert accumulator['reservoir'].shape == (8, 3, 4)
+    assert np.all((statistics['median'] >= np.min(members, axis=0) - 1e-6)
+                  & (statistics['median'] <= np.max(members, axis=0) + 1e-6))
+
+def test_exact_percentiles_keep_every_member():
+    members = member_grids(12)
+    accumulator, statistics = summarize_members(members, reservoir_size=8, exact_percentiles=True)
+    assert accumulator['reservoir'].shape == (12, 3, 4)
+    assert_exact_percentiles(statistics, members)
+
+    with pytest.raises(ValueError, match='reservoir_size must be at least 1'):
+        en.reservoir_slots(5, reservoir_size=0)
@@ -0,0 +1,29 @@
+import numpy as np
+import metrics_functions as metrics
+
+def run_metrics(simulation_name, exit_code, **measured):
+    return {'simulation_name': simulation_name, 'start_time': '2026-01-01T00:00:00',
+            'end_time': '2026-01-01T01:00:00', 'wall_time_s': 3600.0, 'exit_code': exit_code, **measured}
+
+def test_summary_without_sacct_data(tmp_path):
+    # under SLURM without sacct, only the wall time and exit code are known
+    jsonl_filename = tmp_path / 'metrics.jsonl'
+    metrics.append_metrics(run_metrics('gcm_a', 0), jsonl_filename)
+    metrics.append_metrics(run_metrics('gcm_b', None), jsonl_filename)
+    summary_df = metrics.summarize_metrics(metrics.read_metrics(jsonl_filename)).set_index('simulation_name')
+
+    assert summary_df.loc['total', 'wall_time_h'] == 2.0
+    for column in ['cpu_time_h', 'cpu_utilization', 'peak_rss_gb', 'read_gb', 'write_gb']:
+        assert summary_df[column].isna().all(), column
+
+def test_unmeasured_runs_are_left_out_of_the_summary(tmp_path):
+    jsonl_filename = tmp_path / 'metrics.jsonl'
+    metrics.append_metrics(run_metrics('gcm_a', 0, cpu_user_s=3000.0, cpu_system_s=600.0,
+                                       peak_rss_bytes=2 * 1024**3, read_bytes=1024**3, write_bytes=0),
+                           jsonl_filename)
+    metrics.append_metrics(run_metrics('gcm_b', 1), jsonl_filename)
+    summary_df = metrics.summarize_metrics(metrics.read_metrics(jsonl_filename)).set_index('simulation_name')
+
+    assert summary_df.loc['mean', 'peak_rss_gb'] == 2.0
+    assert summary_df.loc['total', 'cpu_time_h'] == 1.0
+    np.testing.assert_allclose(summary_df.loc['max', 'cpu_utilization'], 1.0)
@@ -0,0 +1,46 @@
+import threading
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netcdf_io_functions as nio
+
+def write_daily_file(filename, n_days=60):
+    times = pd.date_range('2000-01-01', periods=n_days, freq='D')
+    values = np.arange(n_days * 3 * 4, dtype='float32').reshape(n_days, 3, 4)
+    xr.Dataset({'net_infiltration': (('time', 'y', 'x'), values)},
+               coords={'time': times, 'y': np.arange(3.), 'x': np.arange(4.)}).to_netcdf(filename)
+    return values
+
+def test_read_variable_is_lazy_and_reads_slices(tmp_path):
+    filename = tmp_path / 'daily.nc'
+    values = write_daily_file(filename)
+    dataset = nio.read_variable(filename, 'net_infiltration')
+    assert not dataset['net_infiltration'].variable._in_memory
+    np.testing.assert_array_equal(dataset['net_infiltration'][10:20].values, values[10:20])
+    nio.close_all()
+
+def test_slice_reads_wait_for_the_lock(tmp_path):
+    filename = tmp_path / 'daily.nc'
+    values = write_daily_file(filename)
+    dataset = nio.read_variable(filename, 'net_infiltration')
+    result = {}
+
+    def read_slice():
+        result['values'] = dataset['net_infiltration'][:5].values
+
+    with nio.netcdf_lock:
+        reader = threading.Thread(target=read_slice)
+        reader.start()
+        reader.join(timeout=0.5)
+        assert reader.is_alive()
+    reader.join(timeout=5)
+    np.testing.assert_array_equal(result['values'], values[:5])
+    nio.close_all()
+
+def test_lazy_dataset_survives_closed_handle(tmp_path):
+    filename = tmp_path / 'daily.nc'
+    values = write_daily_file(filename)
+    dataset = nio.read_variable(filename, 'net_infiltration')
+    nio.close_all()
+    np.testing.assert_array_equal(dataset['net_infiltration'][-5:].values, values[-5:])
+    nio.close_all()
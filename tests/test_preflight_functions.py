@@ -0,0 +1,38 @@
+import numpy as np
+import xarray as xr
+import preflight_functions as pre
+
+def write_weather_file(filename, time_units):
+    xr.Dataset({'prcp': (('time', 'y', 'x'), np.zeros((3, 4, 5), dtype='float32'))},
+               coords={'time': ('time', np.arange(3.0), {'units': time_units, 'calendar': 'standard'})}
+               ).to_netcdf(filename)
+    return filename
+
+def control_file_text(precipitation_filename):
+    return '\n'.join(['GRID 5 4 0.0 0.0 1000.0',
+                      'START_DATE 01/01/2000',
+                      'END_DATE 01/03/2000',
+                      f"PRECIPITATION NETCDF {precipitation_filename}",
+                      'IRRIGATION_MASK CONSTANT 1.0',
+                      'FOG_ZONE ARC_GRID NONE',
+                      'OUTPUT ENABLE runoff'])
+
+def test_constant_and_none_inputs_are_not_checked(tmp_path):
+    precipitation_filename = write_weather_file(tmp_path / 'prcp.nc', 'days since 2000-01-01')
+    control = pre.parse_control_file(control_file_text(precipitation_filename))
+    assert list(control['inputs']) == ['PRECIPITATION']
+    assert control['options']['IRRIGATION_MASK'] == 'CONSTANT 1.0'
+
+    results = pre.check_simulations([{'simulation_name': 'sim',
+                                      'control_file_text': control_file_text(precipitation_filename)}])
+    assert results['errors'] == [] and results['warnings'] == []
+
+def test_undecodable_time_axis_is_a_warning(tmp_path):
+    precipitation_filename = write_weather_file(tmp_path / 'prcp.nc', 'fortnights after the flood')
+    assert pre.read_netcdf_dimensions(precipitation_filename) == {'nx': 5, 'ny': 4,
+                                                                  'time_start': None, 'time_end': None}
+
+    results = pre.check_simulations([{'simulation_name': 'sim',
+                                      'control_file_text': control_file_text(precipitation_filename)}])
+    assert results['errors'] == []
+    assert results['warnings'] == [f"PRECIPITATION: no readable time axis in {precipitation_filename} (sim)"]
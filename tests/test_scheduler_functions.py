@@ -0,0 +1,75 @@
+import resource
+import sys
+import scheduler_functions as sch
+
+
+def make_simulation(tmp_path, name, code):
+    run_dir = tmp_path / name
+    (run_dir / 'logfile').mkdir(parents=True)
+    return {'simulation_name': name,
+            'swb_run_dir': str(run_dir),
+            'swb_arg_text': [sys.executable, '-c', code]}
+
+
+def test_on_complete_error_does_not_stop_other_runs(tmp_path):
+    simulations = [make_simulation(tmp_path, 'fails', 'import time; time.sleep(0.2)'),
+                   make_simulation(tmp_path, 'slow', 'import time; time.sleep(1.0)'),
+                   make_simulation(tmp_path, 'exit3', 'import sys; sys.exit(3)')]
+    completed = []
+
+    def on_complete(simulation, exit_code, metrics):
+        if simulation['simulation_name'] == 'fails':
+            raise OSError('manifest could not be written')
+        completed.append(simulation['simulation_name'])
+
+    results = sch.run_simulations(simulations, max_concurrent_runs=3, on_complete=on_complete,
+                                  sample_interval=0.1)
+
+    assert results == {'fails': 0, 'slow': 0, 'exit3': 3}
+    assert sorted(completed) == ['exit3', 'slow']
+
+
+def test_concurrency_is_bounded(tmp_path):
+    code = "import os, time; open(os.path.join(os.getcwd(), 'ran'), 'w').write(str(time.time())); time.sleep(0.3)"
+    simulations = [make_simulation(tmp_path, f"run{i}", code) for i in range(4)]
+    metrics = {}
+    sch.run_simulations(simulations, max_concurrent_runs=2,
+                        on_complete=lambda simulation, exit_code, m: metrics.update({m['simulation_name']: m}),
+                        sample_interval=0.1)
+
+    starts = sorted(float((tmp_path / name / 'ran').read_text()) for name in metrics)
+    # the third run starts only once one of the first two has finished
+    assert starts[2] - starts[0] >= 0.25
+
+
+def test_final_cpu_and_memory_come_from_the_exited_process(tmp_path):
+    # the run is over long before the first sample would be taken; its usage is read as it is reaped. its peak
+    # memory must be larger than this process's own to be told apart from it (see 'scheduler_functions._apply_rusage')
+    block_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * sch.RU_MAXRSS_BYTES + 200 * 1024**2
+    code = (f"import time; block = bytearray({block_bytes}); start = time.process_time()\n"
+            "while time.process_time() - start < 0.5: pass")
+    metrics = {}
+    results = sch.run_simulations([make_simulation(tmp_path, 'burn', code)], max_concurrent_runs=1,
+                                  on_complete=lambda simulation, exit_code, m: metrics.update(m),
+                                  sample_interval=60.0)
+
+    assert results == {'burn': 0}
+    assert metrics['cpu_user_s'] + metrics['cpu_system_s'] >= 0.5
+    assert metrics['peak_rss_bytes'] >= block_bytes
+
+
+def test_on_start_error_fails_only_that_simulation(tmp_path):
+    simulations = [make_simulation(tmp_path, 'unstaged', 'pass'),
+                   make_simulation(tmp_path, 'staged', 'pass')]
+    completed = {}
+
+    def on_start(simulation):
+        if simulation['simulation_name'] == 'unstaged':
+            raise OSError('control file could not be written')
+
+    results = sch.run_simulations(simulations, max_concurrent_runs=2, on_start=on_start,
+                                  on_complete=lambda simulation, exit_code, m: completed.update({m['simulation_name']: m}),
+                                  sample_interval=0.1)
+
+    assert results == {'unstaged': None, 'staged': 0}
+    assert completed['unstaged']['exit_code'] is None
@@ -0,0 +1,107 @@
+import sys
+from pathlib import Path
+import slurm_functions as sl
+
+STAND_INS = Path(__file__).parent / 'slurm_stand_ins'
+
+
+def make_simulation(tmp_path, name, code, **resources):
+    run_dir = tmp_path / 'runs' / name
+    (run_dir / 'logfile').mkdir(parents=True)
+    return {'simulation_name': name,
+            'swb_run_dir': str(run_dir),
+            'swb_arg_text': [sys.executable, '-c', code],
+            **resources}
+
+
+def make_simulations(tmp_path):
+    return [make_simulation(tmp_path, 'run0', 'print("1995-01-01")'),
+            make_simulation(tmp_path, 'run1', 'import sys; sys.exit(3)'),
+            make_simulation(tmp_path, 'big', 'pass', cores_per_run=2, memory_per_run_gb=8.5),
+            make_simulation(tmp_path, 'run3', 'pass'),
+            make_simulation(tmp_path, 'run4', 'pass')]
+
+
+def stand_in_options(tmp_path, monkeypatch, no_sacct=False):
+    state_dir = tmp_path / 'slurm_state'
+    state_dir.mkdir()
+    monkeypatch.setenv('SLURM_STAND_IN_DIR', str(state_dir))
+    if no_sacct:
+        monkeypatch.setenv('SLURM_STAND_IN_NO_SACCT', '1')
+    return state_dir, {'sbatch_command': str(STAND_INS / 'sbatch'),
+                       'squeue_command': str(STAND_INS / 'squeue'),
+                       'sacct_command': str(STAND_INS / 'sacct'),
+                       'poll_interval': 0.1,
+                       'sacct_retries': 2}
+
+
+def run_with_stand_ins(tmp_path, monkeypatch, simulations, no_sacct=False, **kwargs):
+    state_dir, slurm_options = stand_in_options(tmp_path, monkeypatch, no_sacct)
+    completed = {}
+    exit_codes = sl.run_simulations(simulations, tmp_path / 'slurm', slurm_options=slurm_options,
+                                    on_complete=lambda simulation, exit_code, metrics:
+                                        completed.update({simulation['simulation_name']: metrics}),
+                                    **kwargs)
+    sbatch_calls = (state_dir / 'sbatch_calls.txt').read_text().splitlines()
+    return exit_codes, completed, sbatch_calls
+
+
+def test_run_simulations_through_stand_ins(tmp_path, monkeypatch):
+    simulations = make_simulations(tmp_path)
+    exit_codes, completed, sbatch_calls = run_with_stand_ins(tmp_path, monkeypatch, simulations,
+                                                             max_concurrent_runs=3)
+
+    assert exit_codes == {'run0': 0, 'run1': 3, 'big': 0, 'run3': 0, 'run4': 0}
+    assert set(completed) == set(exit_codes)
+    # one job array per combination of cores and memory, sharing the limit of three tasks at once between them
+    assert sbatch_calls[0].startswith('--parsable --array=0-1,3-4%2 --cpus-per-task=1 --mem=4096M ')
+    assert sbatch_calls[1].startswith('--parsable --array=2%1 --cpus-per-task=2 --mem=8704M ')
+    # metrics come from sacct, with the peak memory and I/O of the batch step
+    assert completed['run0']['wall_time_s'] == 4.0
+    assert completed['run0']['cpu_user_s'] == 3.5
+    assert completed['run0']['peak_rss_bytes'] == int(1.5 * 1024**3)
+    assert completed['run0']['write_bytes'] == int(3.25 * 1024**2)
+    assert (Path(simulations[0]['swb_run_dir']) / 'logfile' / 'swb_stdout.txt').read_text().strip() == '1995-01-01'
+
+
+def test_exit_codes_are_read_from_files_without_sacct(tmp_path, monkeypatch):
+    simulations = make_simulations(tmp_path)
+    exit_codes, completed, _ = run_with_stand_ins(tmp_path, monkeypatch, simulations, no_sacct=True)
+
+    assert exit_codes == {'run0': 0, 'run1': 3, 'big': 0, 'run3': 0, 'run4': 0}
+    assert completed['run1']['exit_code'] == 3
+    assert completed['run1']['cpu_user_s'] is None
+
+
+def test_failed_completion_handler_does_not_stop_the_loop(tmp_path, monkeypatch):
+    simulations = make_simulations(tmp_path)
+    completed = []
+
+    def on_complete(simulation, exit_code, metrics):
+        completed.append(simulation['simulation_name'])
+        raise OSError('disk full')
+
+    _, slurm_options = stand_in_options(tmp_path, monkeypatch)
+    exit_codes = sl.run_simulations(simulations, tmp_path / 'slurm', slurm_options=slurm_options,
+                                    on_complete=on_complete)
+
+    assert exit_codes == {'run0': 0, 'run1': 3, 'big': 0, 'run3': 0, 'run4': 0}
+    assert sorted(completed) == sorted(exit_codes)
+
+
+def test_outcome_is_unknown_without_sacct_or_exit_code_file(tmp_path, monkeypatch):
+    # the task's shell is killed before it can write its exit code
+    simulations = [make_simulation(tmp_path, 'killed', 'import os, signal; os.kill(os.getppid(), signal.SIGKILL)')]
+    exit_codes, completed, _ = run_with_stand_ins(tmp_path, monkeypatch, simulations, no_sacct=True)
+
+    assert exit_codes == {'killed': None}
+    assert completed['killed']['exit_code'] is None
+
+
+def test_split_max_concurrent_runs():
+    assert sl.split_max_concurrent_runs([4, 1], 3) == [2, 1]
+    assert sl.split_max_concurrent_runs([10, 10, 5], 5) == [2, 2, 1]
+    assert sl.split_max_concurrent_runs([1, 1], 8) == [1, 1]
+    assert sl.split_max_concurrent_runs([3, 3], 0) == [0, 0]
+    # more arrays than the limit; each must be allowed one task
+    assert sl.split_max_concurrent_runs([2, 2, 2], 2) == [1, 1, 1]
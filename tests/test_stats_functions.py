@@ -0,0 +1,115 @@
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import xrspatial as xrs
+import netcdf_io_functions as nio
+import stats_functions as sf
+import synthetic_data_functions as sd
+import zone_index_functions as zi
+
+SEASONS = {'growing_season': {'start_doy': 133, 'end_doy': 268},
+           'winter': {'start_doy': 335, 'end_doy': 59}}
+
+SUMMARY_TYPES = ['monthly_sum', 'monthly_mean', 'mean_monthly_sum', 'mean_monthly_mean',
+                 'annual_sum', 'annual_mean', 'mean_annual_sum', 'mean_annual_mean',
+                 'water_year_sum', 'water_year_mean', 'mean_water_year_sum', 'mean_water_year_mean',
+                 'seasonal_sum', 'seasonal_mean',
+                 'growing_season_sum', 'growing_season_mean', 'mean_growing_season_sum', 'mean_winter_mean']
+
+
+def daily_dataset():
+    # a partial first and last water year, a cell that is always NaN and a cell with a run of NaN days
+    dataset = sd.make_daily_dataset('net_infiltration', '1999-11-15', '2003-02-10', nrows=6, ncols=5, seed=3)
+    values = dataset['net_infiltration'].values
+    values[:, 0, 0] = np.nan
+    values[100:140, 2, 3] = np.nan
+    return dataset
+
+
+def summaries_match(multi, dataset):
+    with warnings.catch_warnings():
+        # all-NaN cells
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for summary_type in SUMMARY_TYPES:
+            expected = sf.summarize_array_values(dataset, 'net_infiltration', summary_type, seasons=SEASONS)
+            xr.testing.assert_allclose(multi[summary_type]['net_infiltration'].astype('float64'),
+                                       expected['net_infiltration'].astype('float64'), rtol=1e-5)
+
+
+def test_multi_summary_matches_per_summary():
+    dataset = daily_dataset()
+    summaries_match(sf.summarize_array_values_multi(dataset, 'net_infiltration', SUMMARY_TYPES, seasons=SEASONS),
+                    dataset)
+
+
+def test_multi_summary_of_lazily_read_file_matches_per_summary(tmp_path):
+    dataset = daily_dataset()
+    dataset.to_netcdf(tmp_path / 'daily.nc')
+    lazy_dataset = nio.read_variable(tmp_path / 'daily.nc', 'net_infiltration')
+    summaries_match(sf.summarize_array_values_multi(lazy_dataset, 'net_infiltration', SUMMARY_TYPES,
+                                                    seasons=SEASONS), dataset)
+    nio.close_all()
+
+
+def xrspatial_statistics(values, zones):
+    # the zonal statistics as calculated before the batched reductions: one xrspatial call per grid, with its
+    # default statistics (recent versions of xrspatial add 'majority' to these)
+    zones_dataarray = xr.DataArray(zones, dims=('y', 'x'))
+    return [xrs.zonal.stats(zones=zones_dataarray, values=xr.DataArray(grid, dims=('y', 'x'))) for grid in values]
+
+def assert_statistic_matches(statistic, expected, stat, err_msg):
+    if stat == 'count':
+        # xrspatial gives NaN for a zone with no values; the count stays an integer, 0
+        assert statistic.dtype == np.int64
+        expected = np.nan_to_num(expected, nan=0.)
+    np.testing.assert_allclose(statistic, expected, rtol=1e-6, atol=1e-9, err_msg=err_msg)
+
+
+@pytest.mark.parametrize('variable_name', ['runoff', 'tmax'])
+def test_reduceat_zonal_statistics_match_xrspatial(variable_name):
+    zones = sd.make_zone_mask(40, 50, n_zones=7, nodata_fraction=0.2, seed=1)
+    values = sd.make_daily_dataset(variable_name, '2000-01-01', '2000-01-05', 40, 50, seed=2)[variable_name].values
+    # coarse values, so that the majority is decided by more than one cell; and some NaN cells
+    values = np.round(values * 2.0) / 2.0
+    values[1, 10:14, 20:30] = np.nan
+    # a grid with no values in any zone
+    values[3] = np.nan
+
+    zone_index = sf.build_zone_index(zones)
+    statistics = sf.calculate_zonal_statistics_arrays(values.reshape(len(values), -1), zone_index, block_size=2)
+    assert list(statistics) == sf.ZONAL_STATISTICS
+    majority = sf.calculate_zonal_statistics_arrays(values.reshape(len(values), -1), zone_index, block_size=2,
+                                                    statistics=['majority'])['majority']
+    for row, expected in enumerate(xrspatial_statistics(values, zones)):
+        for stat in sf.ZONAL_STATISTICS:
+            assert_statistic_matches(statistics[stat][row], expected[stat].to_numpy(dtype='float64'), stat,
+                                     f"{stat}, grid {row}")
+        np.testing.assert_allclose(majority[row], expected['majority'].to_numpy(dtype='float64'),
+                                   err_msg=f"majority, grid {row}")
+
+
+def test_zone_index_of_mask_file_matches_xrspatial(tmp_path):
+    zones = sd.make_zone_mask(30, 40, n_zones=5, nodata_fraction=0.2, seed=4)
+    mask_filename = sd.write_zone_mask(tmp_path / 'zones.asc', zones)
+    values = sd.make_daily_dataset('tmin', '2000-01-01', '2000-01-03', 30, 40, seed=5)['tmin']
+
+    # nodata cells are a zone of their own, numbered with the mask's nodata value, as xrspatial reports them
+    zone_index = zi.load_zone_index(mask_filename)
+    np.testing.assert_array_equal(zone_index['zone_ids'], np.unique(zones))
+    zonal_stats = sf.calculate_zonal_statistics(values, mask_dataarray=None, summary_type='annual_sum',
+                                                num_zone_chars=None, zone_index=zone_index)
+    expected = pd.concat(xrspatial_statistics(values.values, zones), ignore_index=True)
+    np.testing.assert_array_equal(zonal_stats['zone'], expected['zone'].astype(str))
+    assert [column for column in zonal_stats if column in expected] == ['zone'] + sf.ZONAL_STATISTICS
+    for stat in sf.ZONAL_STATISTICS:
+        assert_statistic_matches(zonal_stats[stat], expected[stat], stat, stat)
+
+    # without the nodata zone, the index holds exactly the cells of each zone
+    zone_index = zi.load_zone_index(mask_filename, nodata_zone=False)
+    assert -9999 not in zone_index['zone_ids']
+    for zone_id, start, stop in zip(zone_index['zone_ids'], zone_index['zone_starts'],
+                                    np.append(zone_index['zone_starts'][1:], len(zone_index['cell_order']))):
+        np.testing.assert_array_equal(np.sort(zone_index['cell_order'][start:stop]),
+                                      np.flatnonzero(zones.ravel() == zone_id))
@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import zone_index_functions as zi
+
+def write_mask(filename, rows):
+    with open(filename, 'w') as f:
+        f.write(f"ncols {len(rows[0])}\nnrows {len(rows)}\nxllcorner 0\nyllcorner 0\ncellsize 1\nNODATA_value -9999\n")
+        for row in rows:
+            f.write(' '.join(str(value) for value in row) + '\n')
+
+def test_concurrent_builds_leave_one_readable_index(tmp_path):
+    mask_filename = tmp_path / 'zones.asc'
+    write_mask(mask_filename, [[1, 1, 2], [3, -9999, 2]])
+    zone_index = zi.build_zone_index_from_mask(mask_filename)
+
+    def build(_):
+        zi.write_zone_index(zone_index, mask_filename)
+        return zi._read_zone_index(mask_filename)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(build, range(32)))
+    assert all(result is not None for result in results)
+    np.testing.assert_array_equal(results[0]['zone_ids'], [-9999, 1, 2, 3])
+    assert sorted(os.listdir(tmp_path)) == ['zones.asc', 'zones.asc.gridcache', 'zones.asc.zone_index']
+
+def test_stale_index_is_replaced(tmp_path):
+    mask_filename = tmp_path / 'zones.asc'
+    write_mask(mask_filename, [[1, 1, 2], [3, 3, 2]])
+    np.testing.assert_array_equal(zi.load_zone_index(mask_filename)['zone_ids'], [1, 2, 3])
+
+    write_mask(mask_filename, [[4, 4, 5], [5, 5, 5]])
+    os.utime(mask_filename, ns=(0, 10**9))
+    zone_index = zi.load_zone_index(mask_filename, nodata_zone=False)
+    np.testing.assert_array_equal(zone_index['zone_ids'], [4, 5])
+    np.testing.assert_array_equal(zi.load_zone_index(mask_filename)['zone_ids'], [4, 5])
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(('.tmp', '.stale'))]
+
+def test_unreadable_index_raises_rather_than_caching_none(tmp_path, monkeypatch):
+    mask_filename = tmp_path / 'zones.asc'
+    write_mask(mask_filename, [[1, 2]])
+    monkeypatch.setattr(zi, '_read_zone_index', lambda *args: None)
+    with pytest.raises(RuntimeError):
+        zi.load_zone_index(mask_filename)
+    monkeypatch.undo()
+    np.testing.assert_array_equal(zi.load_zone_index(mask_filename)['zone_ids'], [1, 2])